@@ -40,7 +40,8 @@ class pascal_voc(datasets.imdb):
         # PASCAL specific config options
         self.config = {'cleanup'  : True,
                        'use_salt' : True,
-                       'top_k'    : 2000}
+                       'top_k'    : 2000,
+                       'use_07_metric' : int(year) < 2010}
 
         assert os.path.exists(self._devkit_path), \
                 'VOCdevkit path does not exist: {}'.format(self._devkit_path)
@@ -104,6 +105,29 @@ class pascal_voc(datasets.imdb):
 
         return gt_roidb
 
+    def gt_difficult(self):
+        """
+        Return the per-image 'difficult' flags of the ground-truth boxes, in
+        the same order as the boxes of gt_roidb().
+
+        This function loads/saves from/to a cache file to speed up future calls.
+        """
+        cache_file = os.path.join(self.cache_path,
+                                  self.name + '_gt_difficult.pkl')
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as fid:
+                difficult = cPickle.load(fid)
+            print '{} gt difficult loaded from {}'.format(self.name, cache_file)
+            return difficult
+
+        difficult = [self._load_pascal_difficult(index)
+                     for index in self.image_index]
+        with open(cache_file, 'wb') as fid:
+            cPickle.dump(difficult, fid, cPickle.HIGHEST_PROTOCOL)
+        print 'wrote gt difficult to {}'.format(cache_file)
+
+        return difficult
+
     def selective_search_roidb(self,INCLUDE_GT=True):
         """
         Return the database of selective search regions of interest.
@@ -228,6 +252,22 @@ class pascal_voc(datasets.imdb):
                 'gt_overlaps' : overlaps,
                 'flipped' : False}
 
+    def _load_pascal_difficult(self, index):
+        """
+        Load the 'difficult' flag of every object from an XML file in the
+        PASCAL VOC format.
+        """
+        filename = os.path.join(self._data_path, 'Annotations', index + '.xml')
+        with open(filename) as f:
+            data = minidom.parseString(f.read())
+
+        difficult = []
+        for obj in data.getElementsByTagName('object'):
+            tags = obj.getElementsByTagName('difficult')
+            difficult.append(len(tags) > 0 and
+                             int(tags[0].childNodes[0].data) == 1)
+        return np.array(difficult, dtype=np.bool)
+
     def _write_voc_results_file(self, all_boxes):
         use_salt = self.config['use_salt']
         comp_id = 'comp4'
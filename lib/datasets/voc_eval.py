@@ -0,0 +1,146 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""PASCAL VOC detection AP computed in Python.
+
+pascal_voc.evaluate_detections (the MATLAB VOCdevkit) remains the reference
+evaluation. This module follows VOCevaldet.m and is meant for tools that
+evaluate many settings in one process, where writing result files and
+starting MATLAB for every setting would dominate.
+"""
+
+import numpy as np
+from utils.cython_bbox import bbox_overlaps
+
+def voc_ap(rec, prec, use_07_metric=True):
+    """Average precision from a precision/recall curve.
+
+    With use_07_metric the VOC2007 11-point interpolated AP is returned,
+    otherwise the area under the monotone precision envelope.
+    """
+    if use_07_metric:
+        ap = 0.
+        for t in np.arange(0., 1.1, 0.1):
+            if np.sum(rec >= t) == 0:
+                p = 0
+            else:
+                p = np.max(prec[rec >= t])
+            ap = ap + p / 11.
+        return ap
+
+    mrec = np.concatenate(([0.], rec, [1.]))
+    mpre = np.concatenate(([0.], prec, [0.]))
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
+    i = np.where(mrec[1:] != mrec[:-1])[0]
+    return np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
+
+class DetectionEval(object):
+    """Ground truth of an imdb together with the IoUs between it and a fixed
+    set of (pre-NMS) detections.
+
+    The IoUs are computed once; evaluate() then scores any subset of those
+    detections (e.g. the survivors of NMS at some threshold) at any overlap
+    threshold without touching box coordinates again.
+    """
+
+    def __init__(self, imdb, all_boxes):
+        self._num_classes = len(all_boxes)
+        self._num_images = len(all_boxes[0])
+        self._use_07_metric = imdb.config.get('use_07_metric', True)
+        gt_roidb = imdb.gt_roidb()
+        difficult = imdb.gt_difficult()
+
+        self._npos = np.zeros(self._num_classes, dtype=np.int)
+        # per class and image: detection scores, IoU of each detection with
+        # its best gt box, index of that box and whether it is difficult
+        self._scores = [[None] * self._num_images
+                        for _ in xrange(self._num_classes)]
+        self._ovmax = [[None] * self._num_images
+                       for _ in xrange(self._num_classes)]
+        self._jmax = [[None] * self._num_images
+                      for _ in xrange(self._num_classes)]
+        self._jdiff = [[None] * self._num_images
+                       for _ in xrange(self._num_classes)]
+        for cls_ind in xrange(1, self._num_classes):
+            for im_ind in xrange(self._num_images):
+                sel = gt_roidb[im_ind]['gt_classes'] == cls_ind
+                gt_boxes = gt_roidb[im_ind]['boxes'][sel].astype(np.float)
+                gt_difficult = difficult[im_ind][sel]
+                self._npos[cls_ind] += np.sum(~gt_difficult)
+
+                dets = all_boxes[cls_ind][im_ind]
+                if len(dets) == 0:
+                    dets = np.zeros((0, 5), dtype=np.float32)
+                self._scores[cls_ind][im_ind] = dets[:, -1]
+                num_dets = dets.shape[0]
+                if gt_boxes.shape[0] == 0 or num_dets == 0:
+                    self._ovmax[cls_ind][im_ind] = -np.ones(num_dets)
+                    self._jmax[cls_ind][im_ind] = np.zeros(num_dets,
+                                                           dtype=np.int)
+                    self._jdiff[cls_ind][im_ind] = np.zeros(num_dets,
+                                                            dtype=np.bool)
+                    continue
+                ious = bbox_overlaps(dets[:, :4].astype(np.float), gt_boxes)
+                jmax = ious.argmax(axis=1)
+                self._ovmax[cls_ind][im_ind] = ious[np.arange(num_dets), jmax]
+                self._jmax[cls_ind][im_ind] = jmax
+                self._jdiff[cls_ind][im_ind] = gt_difficult[jmax]
+
+    def _class_ap(self, cls_ind, keep, overlap):
+        scores = []
+        ovmax = []
+        jmax = []
+        jdiff = []
+        image = []
+        for im_ind in xrange(self._num_images):
+            inds = keep[cls_ind][im_ind] if keep is not None else \
+                    slice(None)
+            if len(self._scores[cls_ind][im_ind][inds]) == 0:
+                continue
+            scores.append(self._scores[cls_ind][im_ind][inds])
+            ovmax.append(self._ovmax[cls_ind][im_ind][inds])
+            jmax.append(self._jmax[cls_ind][im_ind][inds])
+            jdiff.append(self._jdiff[cls_ind][im_ind][inds])
+            image.append(im_ind * np.ones(len(scores[-1]), dtype=np.int))
+        if len(scores) == 0 or self._npos[cls_ind] == 0:
+            return 0.
+
+        order = np.argsort(-np.concatenate(scores), kind='mergesort')
+        ovmax = np.concatenate(ovmax)[order]
+        jmax = np.concatenate(jmax)[order]
+        jdiff = np.concatenate(jdiff)[order]
+        image = np.concatenate(image)[order]
+
+        # a detection matching a gt box is a true positive only if it is the
+        # highest scoring detection matching that box; matches to difficult
+        # boxes are ignored altogether
+        matched = ovmax >= overlap
+        ignore = matched & jdiff
+        cand = np.where(matched & ~jdiff)[0]
+        keys = image[cand] * (jmax.max() + 1) + jmax[cand]
+        _, first = np.unique(keys, return_index=True)
+        tp = np.zeros(len(order))
+        tp[cand[first]] = 1
+        fp = 1 - tp
+        fp[ignore] = 0
+
+        tp = np.cumsum(tp)
+        fp = np.cumsum(fp)
+        rec = tp / float(self._npos[cls_ind])
+        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+        return voc_ap(rec, prec, self._use_07_metric)
+
+    def evaluate(self, keep=None, overlap=0.5):
+        """Return the per-class AP (background excluded).
+
+        Arguments:
+            keep (list): keep[cls][image] indexes the detections to score,
+                e.g. the output of NMS; None scores every detection
+            overlap (float): minimum IoU for a detection to match a gt box
+        """
+        return np.array([self._class_ap(cls_ind, keep, overlap)
+                         for cls_ind in xrange(1, self._num_classes)])
@@ -123,6 +123,13 @@ __C.TRAIN.PAIRWISE_WEIGHT = 0.0
 # Bridge loss uses Normalized scores?
 __C.TRAIN.BRIDGE_NORM = False
 
+# Weakly supervised training: collapse the sampled RoIs that map to the same
+# RoI on the feature map (see DEDUP_BOXES) into one RoI and add a roi_weights
+# top with the multiplicity of each RoI. The MIL layers (MySumLayer,
+# MySoftMaxLayer, ExpSoftMaxLayer, ExpSoftMaxSumLayer) take it as an optional
+# last bottom and give the same losses and gradients as without deduplication
+__C.TRAIN.DEDUP_ROIS = False
+
 
 #
 # Testing options
@@ -141,6 +148,9 @@ __C.TEST.MAX_SIZE = 1000
 # IoU >= this threshold)
 __C.TEST.NMS = 0.3
 
+# Number of threads that apply non-maximum suppression to different images
+__C.TEST.NMS_WORKERS = 4
+
 # Experimental: treat the (K+1) units in the cls_score layer as linear
 # predictors (trained, eg, with one-vs-rest SVMs).
 __C.TEST.SVM = False
@@ -148,9 +158,58 @@ __C.TEST.SVM = False
 # Test using bounding-box regressors
 __C.TEST.BBOX_REG = True
 
-# Use horizontally-flipped images during test?
+# Use horizontally-flipped images during test? Each image and its mirror image
+# go through the net together (one after the other when a MIL layer of the net
+# has no rois bottom), and the detections of both are merged
 __C.TEST.USE_FLIPPED = False
 
+# Checkpoint the raw per-image detections of test_net into an append-only
+# store (see fast_rcnn.detstore), so that an interrupted run resumes where it
+# stopped and thresholds or NMS can change without re-running the network
+__C.TEST.DET_STORE = True
+
+# Number of images between two flushes of the detection store
+__C.TEST.DET_STORE_FLUSH = 100
+
+# Overlap image loading and post-processing with the network forward pass in
+# test_net (ignored when visualizing detections)
+__C.TEST.PIPELINE = True
+
+# Number of threads that load images and build input blobs in the pipeline
+__C.TEST.PIPELINE_READERS = 4
+
+# Maximum number of images queued between two stages of the pipeline
+__C.TEST.PIPELINE_DEPTH = 8
+
+# Memory budget (in MB) of the net blobs when im_detect_batch packs several
+# images into one forward pass
+__C.TEST.BATCH_MEMORY = 2048
+
+# Number of RoIs pushed through the RoI pooling and fc layers at once. Images
+# with more proposals (e.g. the voc_*_top_10000 imdbs) run the conv layers
+# once and the head in chunks of this size; 0 runs all RoIs at once. Only for
+# nets without MIL layers (e.g. not the weakly supervised ones), whose scores
+# depend on all the RoIs of an image
+__C.TEST.ROI_CHUNK = 0
+
+# Name of the RoI pooling layer where the net is split for ROI_CHUNK
+__C.TEST.ROI_POOL_LAYER = 'roi_pool5'
+
+# Features saved by test_net --feat (see fast_rcnn.featstore): the blob to
+# save and the dtype of the saved rows
+__C.TEST.FEAT_LAYER = 'fc7'
+__C.TEST.FEAT_DTYPE = 'float16'
+
+# Only save the features of the top FEAT_TOP_K proposals of each image by
+# their best foreground score (0 saves all of them)
+__C.TEST.FEAT_TOP_K = 0
+
+# Project the saved features on their FEAT_PCA leading principal components
+# (0 saves them as is), fitted on the features of the first FEAT_PCA_IMAGES
+# images
+__C.TEST.FEAT_PCA = 0
+__C.TEST.FEAT_PCA_IMAGES = 50
+
 #
 # MISC
 #
@@ -0,0 +1,171 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Append-only on-disk store of raw per-image detections.
+
+test_net checkpoints the raw (pre-threshold, pre-NMS) scores and boxes returned
+by im_detect into a DetectionStore. An interrupted run resumes from the last
+flushed image, and a finished run can be re-thresholded or re-NMSed without
+running the network again.
+
+A store is a directory named after a fingerprint of the model and a
+fingerprint of the proposal set. It holds two append-only files:
+    raw.pkl     concatenated cPickle records, one per image
+    index.txt   one "<image> <offset> <length>" line per record in raw.pkl
+A record only counts as present once its index line has been flushed; any
+trailing bytes of raw.pkl past the last indexed record, and a partially
+written last line of index.txt, are dropped on open (see read_index).
+"""
+
+import os
+import hashlib
+import cPickle
+import numpy as np
+from fast_rcnn.config import cfg
+
+def _md5_file(md5, filename, chunk_size=1 << 20):
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            md5.update(chunk)
+
+def model_fingerprint(prototxt, caffemodel):
+    """Fingerprint of a network definition and its weights."""
+    md5 = hashlib.md5()
+    _md5_file(md5, prototxt)
+    _md5_file(md5, caffemodel)
+    return md5.hexdigest()[:16]
+
+def proposal_fingerprint(imdb):
+    """Fingerprint of the proposals of an imdb and of the test-time options
+    that change the raw network outputs for them.
+    """
+    md5 = hashlib.md5()
+    md5.update(imdb.name)
+    md5.update(repr((cfg.TEST.SCALES, cfg.TEST.MAX_SIZE, cfg.TEST.SVM,
+                     cfg.TEST.BBOX_REG, cfg.TEST.USE_FLIPPED,
+                     cfg.DEDUP_BOXES, cfg.PIXEL_MEANS.tolist())))
+    for entry in imdb.roidb:
+        boxes = np.ascontiguousarray(entry['boxes'])
+        md5.update(boxes.dtype.str)
+        md5.update(boxes.tostring())
+        md5.update(np.ascontiguousarray(entry['gt_classes']).tostring())
+        md5.update('f' if entry['flipped'] else 'o')
+    return md5.hexdigest()[:16]
+
+def read_index(index_file, num_fields, truncate=True):
+    """Fields of the complete lines of an append-only index file, each line
+    holding num_fields of them.
+
+    Reading stops at the first incomplete line, left by a run interrupted
+    while writing it, and unless truncate is False (readers of a file that
+    may still be written) the file is truncated there, so that the next
+    appended line does not run into it.
+    """
+    lines = []
+    if not os.path.exists(index_file):
+        return lines
+    end = 0
+    with open(index_file, 'rb') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != num_fields or not line.endswith('\n'):
+                break
+            lines.append(fields)
+            end += len(line)
+    if truncate and os.path.getsize(index_file) > end:
+        with open(index_file, 'r+b') as f:
+            f.truncate(end)
+    return lines
+
+class DetectionStore(object):
+    """Raw im_detect outputs of one model on one proposal set."""
+
+    def __init__(self, output_dir, model_fp, proposal_fp):
+        self._path = os.path.join(output_dir, 'detstore',
+                                  '{}_{}'.format(model_fp, proposal_fp))
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+        self._raw_file = os.path.join(self._path, 'raw.pkl')
+        self._index_file = os.path.join(self._path, 'index.txt')
+        self._index = {}
+        self._pending = []
+        end = 0
+        for fields in read_index(self._index_file, 3):
+            i, offset, length = [int(x) for x in fields]
+            self._index[i] = (offset, length)
+            end = max(end, offset + length)
+        if os.path.exists(self._raw_file) and \
+                os.path.getsize(self._raw_file) > end:
+            # drop records written after the last flushed index line
+            with open(self._raw_file, 'r+b') as f:
+                f.truncate(end)
+        self._raw = open(self._raw_file, 'ab')
+        self._reader = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, i):
+        return i in self._index
+
+    def append(self, i, scores, boxes):
+        """Append the raw detections of image i. Records become visible to
+        later runs after the next flush.
+        """
+        # without bbox regression the boxes are the proposals tiled once per
+        # class, so only the proposals are stored
+        tiled = not cfg.TEST.BBOX_REG
+        if tiled:
+            boxes = boxes[:, :4]
+        record = cPickle.dumps((scores.astype(np.float32, copy=False),
+                                boxes.astype(np.float32, copy=False), tiled),
+                               cPickle.HIGHEST_PROTOCOL)
+        self._raw.seek(0, os.SEEK_END)
+        offset = self._raw.tell()
+        self._raw.write(record)
+        self._pending.append((i, offset, len(record)))
+        if len(self._pending) >= cfg.TEST.DET_STORE_FLUSH:
+            self.flush()
+
+    def flush(self):
+        """Make all appended records durable."""
+        if len(self._pending) == 0:
+            return
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        with open(self._index_file, 'a') as f:
+            for i, offset, length in self._pending:
+                f.write('{:d} {:d} {:d}\n'.format(i, offset, length))
+                self._index[i] = (offset, length)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = []
+
+    def get(self, i):
+        """Return the (scores, boxes) stored for image i."""
+        offset, length = self._index[i]
+        if self._reader is None:
+            self._reader = open(self._raw_file, 'rb')
+        self._reader.seek(offset)
+        scores, boxes, tiled = cPickle.loads(self._reader.read(length))
+        if tiled:
+            boxes = np.tile(boxes, (1, scores.shape[1]))
+        return scores, boxes
+
+    def close(self):
+        self.flush()
+        self._raw.close()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
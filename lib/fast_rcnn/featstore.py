@@ -0,0 +1,266 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Streaming on-disk store of per-proposal features (e.g. fc7).
+
+test_net --feat appends the feature rows of every image to a FeatureWriter
+while detection runs, so the features of a whole test set never have to fit
+in memory. A FeatureReader memory-maps them back.
+
+A feature store is a directory holding:
+    meta.pkl    dtype, dimension, top-k and PCA (mean, components) of the rows
+    feats.bin   raw C-order rows of all images, one after the other
+    rois.bin    int32 proposal index of every row
+    index.txt   one "<image> <first row> <number of rows>" line per image
+As in fast_rcnn.detstore, an image only counts as present once its index line
+has been flushed, and trailing rows past the last indexed image (and a
+partially written index line) are dropped on open, so an interrupted run
+resumes where it stopped.
+
+Two options bound the disk usage (see cfg.TEST.FEAT_*): keeping only the top-k
+proposals of each image by their best foreground score, and projecting the
+rows on the leading principal components, fitted on the rows of the first
+images. The fit only keeps the D x D scatter matrix of these rows in memory;
+the rows themselves wait in pca.tmp until the components are known.
+"""
+
+import os
+import cPickle
+import numpy as np
+from fast_rcnn.config import cfg
+from fast_rcnn.detstore import read_index
+
+def _read_index(index_file, truncate=True):
+    """{image: (first row, number of rows)} and the number of rows of the
+    images of index.txt (see fast_rcnn.detstore.read_index).
+    """
+    index = {}
+    end = 0
+    for fields in read_index(index_file, 3, truncate):
+        i, start, count = [int(x) for x in fields]
+        index[i] = (start, count)
+        end = max(end, start + count)
+    return index, end
+
+def fit_pca(count, total, scatter, dim):
+    """Mean and dim x D leading principal components of count rows x, given
+    their sum and the D x D sum of the x x^T.
+    """
+    mean = total / max(count, 1)
+    cov = scatter / max(count, 1) - np.outer(mean, mean)
+    # eigenvalues in ascending order
+    _, vecs = np.linalg.eigh(cov)
+    return mean.astype(np.float32), vecs[:, ::-1][:, :dim].T.astype(np.float32)
+
+class FeatureWriter(object):
+    """Append the feature rows of the images of a test set to a directory."""
+
+    def __init__(self, path, dtype=None, top_k=None, pca_dim=None,
+                 pca_images=None):
+        if dtype is None:
+            dtype = cfg.TEST.FEAT_DTYPE
+        if top_k is None:
+            top_k = cfg.TEST.FEAT_TOP_K
+        if pca_dim is None:
+            pca_dim = cfg.TEST.FEAT_PCA
+        if pca_images is None:
+            pca_images = cfg.TEST.FEAT_PCA_IMAGES
+        self._path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._meta_file = os.path.join(path, 'meta.pkl')
+        self._index_file = os.path.join(path, 'index.txt')
+        self._meta = {'dtype' : np.dtype(dtype).str, 'dim' : None,
+                      'top_k' : top_k, 'pca_dim' : pca_dim,
+                      'pca_mean' : None, 'pca_components' : None}
+        if os.path.exists(self._meta_file):
+            with open(self._meta_file, 'rb') as f:
+                meta = cPickle.load(f)
+            for key in ('dtype', 'top_k', 'pca_dim'):
+                if meta[key] != self._meta[key]:
+                    raise ValueError('feature store {} was written with {} = '
+                                     '{}, not {}'.format(path, key, meta[key],
+                                                         self._meta[key]))
+            self._meta = meta
+        self._dtype = np.dtype(self._meta['dtype'])
+        self._pca_images = pca_images
+
+        self._index, end = _read_index(self._index_file)
+        self._num_rows = end
+        self._files = []
+        for name, dtype in (('feats.bin', self._dtype),
+                            ('rois.bin', np.dtype(np.int32))):
+            filename = os.path.join(path, name)
+            row_bytes = dtype.itemsize
+            if name == 'feats.bin' and self._meta['dim'] is not None:
+                row_bytes *= self._meta['dim']
+            if os.path.exists(filename) and \
+                    os.path.getsize(filename) > end * row_bytes:
+                # drop rows written after the last flushed index line
+                with open(filename, 'r+b') as f:
+                    f.truncate(end * row_bytes)
+            self._files.append(open(filename, 'ab'))
+        self._pending = []
+        # images held back until there are enough rows to fit the PCA: their
+        # (index, rois), their rows in pca.tmp and [count, sum, scatter]
+        self._pca_held = []
+        self._pca_file = os.path.join(path, 'pca.tmp')
+        self._pca_spill = None
+        self._pca_stats = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, i):
+        return i in self._index
+
+    def append(self, i, feats, scores):
+        """Append the R x D features of the R proposals of image i, given
+        their R x K class scores (used by the top-k filter).
+        """
+        rois = np.arange(feats.shape[0], dtype=np.int32)
+        top_k = self._meta['top_k']
+        if top_k > 0 and feats.shape[0] > top_k:
+            # best foreground score of every proposal
+            best = scores[:, 1:].max(axis=1)
+            rois = np.sort(np.argpartition(-best, top_k - 1)[:top_k])
+            rois = rois.astype(np.int32)
+            feats = feats[rois]
+        feats = feats.reshape(feats.shape[0], -1)
+
+        if self._meta['pca_dim'] > 0 and self._meta['pca_mean'] is None:
+            self._hold(i, feats, rois)
+            if len(self._pca_held) >= self._pca_images:
+                self._fit_pca()
+            return
+        self._write(i, feats, rois)
+
+    def _hold(self, i, feats, rois):
+        feats = np.ascontiguousarray(feats, dtype=np.float32)
+        if self._pca_stats is None:
+            dim = feats.shape[1]
+            self._pca_stats = [0, np.zeros(dim), np.zeros((dim, dim))]
+            # an earlier interrupted fit left nothing indexed
+            self._pca_spill = open(self._pca_file, 'wb')
+        x = feats.astype(np.float64)
+        self._pca_stats[0] += x.shape[0]
+        self._pca_stats[1] += x.sum(axis=0)
+        self._pca_stats[2] += np.dot(x.T, x)
+        self._pca_spill.write(feats.tostring())
+        self._pca_held.append((i, rois))
+
+    def _fit_pca(self):
+        count, total, scatter = self._pca_stats
+        self._meta['pca_mean'], self._meta['pca_components'] = \
+                fit_pca(count, total, scatter, self._meta['pca_dim'])
+        self._pca_spill.close()
+        if count > 0:
+            spilled = np.memmap(self._pca_file, dtype=np.float32, mode='r',
+                                shape=(count, total.shape[0]))
+        else:
+            # np.memmap cannot map an empty file
+            spilled = np.zeros((0, total.shape[0]), dtype=np.float32)
+        start = 0
+        for i, rois in self._pca_held:
+            self._write(i, spilled[start:start + len(rois)], rois)
+            start += len(rois)
+        spilled = None
+        os.remove(self._pca_file)
+        self._pca_held = []
+        self._pca_spill = None
+        self._pca_stats = None
+
+    def _write(self, i, feats, rois):
+        if self._meta['pca_mean'] is not None:
+            feats = np.dot(feats - self._meta['pca_mean'],
+                           self._meta['pca_components'].T)
+        if self._meta['dim'] is None:
+            self._meta['dim'] = feats.shape[1]
+            self._write_meta()
+        assert feats.shape[1] == self._meta['dim'], \
+            'feature dimension {} != {}'.format(feats.shape[1],
+                                                self._meta['dim'])
+        self._files[0].write(np.ascontiguousarray(feats, dtype=self._dtype)
+                             .tostring())
+        self._files[1].write(rois.tostring())
+        self._pending.append((i, self._num_rows, feats.shape[0]))
+        self._num_rows += feats.shape[0]
+        if len(self._pending) >= cfg.TEST.DET_STORE_FLUSH:
+            self.flush()
+
+    def _write_meta(self):
+        tmp_file = self._meta_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            cPickle.dump(self._meta, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self._meta_file)
+
+    def flush(self):
+        """Make all written images durable."""
+        if len(self._pending) == 0:
+            return
+        for f in self._files:
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self._index_file, 'a') as f:
+            for i, start, count in self._pending:
+                f.write('{:d} {:d} {:d}\n'.format(i, start, count))
+                self._index[i] = (start, count)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = []
+
+    def close(self):
+        if len(self._pca_held) > 0:
+            # fewer images than FEAT_PCA_IMAGES in the whole run
+            self._fit_pca()
+        self.flush()
+        for f in self._files:
+            f.close()
+
+class FeatureReader(object):
+    """Memory-mapped read access to a store written by FeatureWriter."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+            self._meta = cPickle.load(f)
+        self._index, num_rows = _read_index(os.path.join(path, 'index.txt'),
+                                            truncate=False)
+        dim = self._meta['dim']
+        if num_rows == 0:
+            self._feats = np.zeros((0, dim), dtype=self._meta['dtype'])
+            self._rois = np.zeros(0, dtype=np.int32)
+        else:
+            self._feats = np.memmap(os.path.join(path, 'feats.bin'),
+                                    dtype=self._meta['dtype'], mode='r',
+                                    shape=(num_rows, dim))
+            self._rois = np.memmap(os.path.join(path, 'rois.bin'),
+                                   dtype=np.int32, mode='r',
+                                   shape=(num_rows,))
+
+    @property
+    def pca(self):
+        """(mean, components) of the projection, or None."""
+        if self._meta['pca_mean'] is None:
+            return None
+        return self._meta['pca_mean'], self._meta['pca_components']
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, i):
+        return i in self._index
+
+    def __getitem__(self, i):
+        """Return (feats, rois) of image i: the stored feature rows and the
+        index of the proposal of every row in roidb[i]['boxes'].
+        """
+        start, count = self._index[i]
+        return (self._feats[start:start + count],
+                self._rois[start:start + count])
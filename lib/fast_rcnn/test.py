@@ -8,17 +8,31 @@
 """Test a Fast R-CNN network on an imdb (image database)."""
 
 from fast_rcnn.config import cfg, get_output_dir
+from fast_rcnn.detstore import DetectionStore, model_fingerprint, \
+    proposal_fingerprint
+from fast_rcnn.featstore import FeatureWriter
+from datasets.voc_eval import DetectionEval
 import argparse
 from utils.timer import Timer
 import numpy as np
 import cv2
 import caffe
 from utils.cython_nms import nms
+from utils.cython_bitmask_nms import nms_segments
 import cPickle
-import heapq
 from utils.blob import im_list_to_blob
+from utils.dedup import unique_rois
 import os
-import PIL
+import sys
+import Queue
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+# number of RoIs before and after deduplication, over all calls to
+# _prepare_inputs (which can run in several threads)
+_dedup_counts = [0, 0]
+_dedup_lock = threading.Lock()
 
 def _get_image_blob(im):
     """Converts an image into a network input.
@@ -152,77 +166,335 @@ def _clip_boxes(boxes, im_shape):
     boxes[:, 3::4] = np.minimum(boxes[:, 3::4], im_shape[0] - 1)
     return boxes
 
-def im_detect(net, im, boxes, feat_file=None, eval_segm=False):
-    """Detect object classes in an image given object proposals.
+def _flip_boxes(boxes, width):
+    """Mirror R x (4*K) boxes horizontally in an image of the given width."""
+    flipped = boxes.copy()
+    flipped[:, 0::4] = width - boxes[:, 2::4] - 1
+    flipped[:, 2::4] = width - boxes[:, 0::4] - 1
+    return flipped
 
-    Arguments:
-        net (caffe.Net): Fast R-CNN network to use
-        im (ndarray): color image to test (in BGR order)
-        boxes (ndarray): R x 4 array of object proposals
+def _prepare_inputs(im, boxes, flip=False):
+    """Build the network inputs of an image and its object proposals.
+
+    This is the part of im_detect that does not touch the network, so it can
+    run ahead of net.forward (see _detect_pipelined).
+
+    With flip, the inputs pack the image and its mirror image into one 2-image
+    batch (unless the net mixes images, see _forward), and _postprocess
+    returns the detections of both in the coordinates of the image: the R
+    proposals, then their R mirrored copies.
 
     Returns:
-        scores (ndarray): R x K array of object class scores (K includes
-            background as object category 0)
-        boxes (ndarray): R x (4*K) array of predicted bounding boxes
+        inputs (dict): network input blobs plus what _postprocess needs
     """
+    if flip:
+        parts = [_prepare_inputs(im, boxes),
+                 _prepare_inputs(im[:, ::-1, :], _flip_boxes(boxes,
+                                                             im.shape[1]))]
+        inputs = _stack_inputs(parts)
+        inputs['parts'] = parts
+        inputs['width'] = im.shape[1]
+        return inputs
+
     blobs, unused_im_scale_factors = _get_blobs(im, boxes)
+    inputs = {'blobs' : blobs, 'boxes' : boxes, 'im_shape' : im.shape,
+              'inv_index' : None}
 
     # When mapping from image ROIs to feature map ROIs, there's some aliasing
     # (some distinct image ROIs get mapped to the same feature ROI).
     # Here, we identify duplicate feature ROIs, so we only compute features
     # on the unique subset.
     if cfg.DEDUP_BOXES > 0:
-        v = np.array([1, 1e3, 1e6, 1e9, 1e12])
-        hashes = np.round(blobs['rois'] * cfg.DEDUP_BOXES).dot(v)
-        _, index, inv_index = np.unique(hashes, return_index=True,
-                                        return_inverse=True)
+        index, inv_index = unique_rois(blobs['rois'], cfg.DEDUP_BOXES)
         blobs['rois'] = blobs['rois'][index, :]
-        boxes = boxes[index, :]
-        
-    if feat_file!=None:
-        feat=[]
-        feat_layer=['fc7']
+        inputs['boxes'] = boxes[index, :]
+        inputs['inv_index'] = inv_index
+        with _dedup_lock:
+            _dedup_counts[0] += len(inv_index)
+            _dedup_counts[1] += len(index)
+    return inputs
+
+def _net_outputs(net, blobs_out, feat_layer):
+    """Copy the blobs needed by _postprocess (and the feature blobs in
+    feat_layer) out of the net after a forward pass.
+    """
+    outputs = {}
+    for name in feat_layer:
+        outputs[name] = blobs_out[name].copy()
+    if cfg.TEST.SVM:
+        # use the raw scores before softmax under the assumption they
+        # were trained as linear SVMs
+        outputs['scores'] = net.blobs['cls_score'].data.copy()
     else:
-        feat_layer=[]
-        
+        # use softmax estimated probabilities
+        outputs['scores'] = net.blobs['cls_prob'].data.copy()
+    if cfg.TEST.BBOX_REG:
+        outputs['bbox_pred'] = blobs_out['bbox_pred'].copy()
+    return outputs
+
+def _forward_chunked(net, inputs, feat_layer=[]):
+    """Run the conv trunk once and stream the RoIs through the RoI pooling
+    and fc head in chunks of cfg.TEST.ROI_CHUNK, bounding the memory of the
+    head blobs independently of the number of proposals.
+
+    The net is split at cfg.TEST.ROI_POOL_LAYER: the layers before it form
+    the trunk, the layer itself and all layers after it form the head. This
+    is only valid if every head layer treats each RoI independently, so nets
+    with MIL layers (see roi_data_layer.sum.pools_images) are refused.
+    """
+    if any(getattr(layer, 'pools_rois', False) for layer in net.layers):
+        raise Exception("TEST.ROI_CHUNK cannot split the RoIs of a net "
+                        "whose MIL layers reduce over them; set it to 0.")
+    blobs = inputs['blobs']
+    layer_names = list(net._layer_names)
+    pool_ind = layer_names.index(cfg.TEST.ROI_POOL_LAYER)
+
+    net.blobs['data'].reshape(*(blobs['data'].shape))
+    net.blobs['data'].data[...] = blobs['data']
+    net._forward(0, pool_ind - 1)
+
+    chunk_outputs = []
+    rois = blobs['rois'].astype(np.float32, copy=False)
+    for start in xrange(0, rois.shape[0], cfg.TEST.ROI_CHUNK):
+        chunk = rois[start:start + cfg.TEST.ROI_CHUNK]
+        net.blobs['rois'].reshape(*(chunk.shape))
+        net.blobs['rois'].data[...] = chunk
+        net._forward(pool_ind, len(layer_names) - 1)
+        blobs_out = dict((name, net.blobs[name].data)
+                         for name in net.outputs + feat_layer)
+        chunk_outputs.append(_net_outputs(net, blobs_out, feat_layer))
+
+    return dict((name, np.vstack([out[name] for out in chunk_outputs]))
+                for name in chunk_outputs[0])
+
+def _mixes_images(net):
+    """Whether a layer of net reduces over all the RoIs of a forward pass at
+    once (a MIL layer without a rois bottom, see
+    roi_data_layer.sum.pools_images), so that images packed into one forward
+    would change each other's scores.
+    """
+    return any(getattr(layer, 'mixes_images', False) for layer in net.layers)
+
+def _forward(net, inputs, feat_layer=[]):
+    """Run the network on inputs built by _prepare_inputs.
+
+    The image and mirror image of flipped inputs run as separate forward
+    passes when the net mixes the RoIs of the images of a batch.
+
+    Returns:
+        outputs (dict): copies of the output blobs needed by _postprocess
+            (and of the feature blobs in feat_layer), which stay valid after
+            the next forward pass
+    """
+    if 'parts' in inputs and _mixes_images(net):
+        part_outputs = [_forward(net, part, feat_layer)
+                        for part in inputs['parts']]
+        return dict((name, np.vstack([out[name] for out in part_outputs]))
+                    for name in part_outputs[0])
+
+    blobs = inputs['blobs']
+    if cfg.TEST.ROI_CHUNK > 0 and \
+            blobs['rois'].shape[0] > cfg.TEST.ROI_CHUNK:
+        return _forward_chunked(net, inputs, feat_layer)
+
     # reshape network inputs
     net.blobs['data'].reshape(*(blobs['data'].shape))
     net.blobs['rois'].reshape(*(blobs['rois'].shape))
     blobs_out = net.forward(data=blobs['data'].astype(np.float32, copy=False),
                             rois=blobs['rois'].astype(np.float32, copy=False),
                             blobs=feat_layer)
-                                
-    if feat_file!=None:
-        feat = blobs_out[feat_layer[0]].copy()
+    return _net_outputs(net, blobs_out, feat_layer)
 
-    if eval_segm:
-        pass
-    
-    if cfg.TEST.SVM:
-        # use the raw scores before softmax under the assumption they
-        # were trained as linear SVMs
-        scores = net.blobs['cls_score'].data
-    else:
-        # use softmax estimated probabilities
-        scores = net.blobs['cls_prob'].data#blobs_out['cls_prob']
+def _postprocess(inputs, outputs):
+    """Turn network outputs into per-proposal scores and boxes."""
+    if 'parts' in inputs:
+        (scores, pred_boxes), (flip_scores, flip_boxes) = \
+                [_postprocess(part, part_outputs) for part, part_outputs
+                 in zip(inputs['parts'], _split_parts(inputs, outputs))]
+        return (np.vstack((scores, flip_scores)),
+                np.vstack((pred_boxes, _flip_boxes(flip_boxes,
+                                                   inputs['width']))))
+
+    scores = outputs['scores']
+    boxes = inputs['boxes']
 
     if cfg.TEST.BBOX_REG:
         # Apply bounding-box regression deltas
-        box_deltas = blobs_out['bbox_pred']
+        box_deltas = outputs['bbox_pred']
         pred_boxes = _bbox_pred(boxes, box_deltas)
-        pred_boxes = _clip_boxes(pred_boxes, im.shape)
+        pred_boxes = _clip_boxes(pred_boxes, inputs['im_shape'])
     else:
         # Simply repeat the boxes, once for each class
         pred_boxes = np.tile(boxes, (1, scores.shape[1]))
 
-    if cfg.DEDUP_BOXES > 0:
+    if inputs['inv_index'] is not None:
         # Map scores and predictions back to the original set of boxes
-        scores = scores[inv_index, :]
-        pred_boxes = pred_boxes[inv_index, :]
+        scores = scores[inputs['inv_index'], :]
+        pred_boxes = pred_boxes[inputs['inv_index'], :]
+    return scores, pred_boxes
+
+def _split_parts(inputs, outputs):
+    """Outputs of each part of flipped inputs (see _prepare_inputs)."""
+    return _split_outputs(outputs, [part['blobs']['rois'].shape[0]
+                                    for part in inputs['parts']])
+
+def _features(inputs, outputs, feat_layer):
+    """The feat_layer blob of every proposal, mapped back like the scores."""
+    if 'parts' in inputs:
+        return np.vstack([_features(part, part_outputs, feat_layer)
+                          for part, part_outputs
+                          in zip(inputs['parts'],
+                                 _split_parts(inputs, outputs))])
+    feats = outputs[feat_layer]
+    if inputs['inv_index'] is not None:
+        feats = feats[inputs['inv_index']]
+    return feats
+
+def im_detect(net, im, boxes, feat_file=None, eval_segm=False, flip=False):
+    """Detect object classes in an image given object proposals.
+
+    Arguments:
+        net (caffe.Net): Fast R-CNN network to use
+        im (ndarray): color image to test (in BGR order)
+        boxes (ndarray): R x 4 array of object proposals
+        flip (bool): also detect on the mirror image, in the same forward
+            pass when the net allows it; the results then have 2R rows (see
+            _prepare_inputs)
+
+    Returns:
+        scores (ndarray): R x K array of object class scores (K includes
+            background as object category 0)
+        boxes (ndarray): R x (4*K) array of predicted bounding boxes
+        feats (ndarray): R x D array of cfg.TEST.FEAT_LAYER features, only
+            returned if feat_file is set
+    """
+    inputs = _prepare_inputs(im, boxes, flip)
+
+    if feat_file!=None:
+        feat_layer=[cfg.TEST.FEAT_LAYER]
+    else:
+        feat_layer=[]
+
+    outputs = _forward(net, inputs, feat_layer)
+
+    if eval_segm:
+        pass
+
+    scores, pred_boxes = _postprocess(inputs, outputs)
     if feat_file!=None:
-        return scores, pred_boxes, feat
+        return scores, pred_boxes, _features(inputs, outputs, feat_layer[0])
     else:
-	return scores, pred_boxes
+        return scores, pred_boxes
+
+def _stack_inputs(inputs_list):
+    """Pack the inputs of several images into the inputs of one forward.
+
+    The data blobs are zero padded to a common size and stacked, and the
+    batch index of every RoI is shifted to the image it belongs to.
+    """
+    datas = [inputs['blobs']['data'] for inputs in inputs_list]
+    max_shape = np.array([data.shape for data in datas]).max(axis=0)
+    num_levels = sum(data.shape[0] for data in datas)
+    data_blob = np.zeros((num_levels, max_shape[1], max_shape[2],
+                          max_shape[3]), dtype=np.float32)
+    rois = []
+    level = 0
+    for inputs, data in zip(inputs_list, datas):
+        data_blob[level:level + data.shape[0], :, :data.shape[2],
+                  :data.shape[3]] = data
+        im_rois = inputs['blobs']['rois'].copy()
+        im_rois[:, 0] += level
+        rois.append(im_rois)
+        level += data.shape[0]
+    return {'blobs' : {'data' : data_blob, 'rois' : np.vstack(rois)}}
+
+def _split_outputs(outputs, counts):
+    """Split the outputs of a batched forward back into per-image outputs."""
+    splits = np.cumsum(counts)[:-1]
+    per_image = [{} for _ in counts]
+    for name, blob in outputs.iteritems():
+        for k, part in enumerate(np.split(blob, splits)):
+            per_image[k][name] = part
+    return per_image
+
+def _blob_costs(net, num_rois):
+    """Bytes of net blobs per input pixel and per RoI, measured on the
+    shapes of the last forward pass.
+
+    Blobs whose first axis has one row per RoI belong to the RoI head and
+    grow with the number of proposals, the others grow with the image area.
+    """
+    data = net.blobs['data'].data
+    num_pixels = float(data.shape[0] * data.shape[2] * data.shape[3])
+    pixel_bytes = 0.
+    roi_bytes = 0.
+    for name, blob in net.blobs.iteritems():
+        if blob.data.ndim > 0 and blob.data.shape[0] == num_rois:
+            roi_bytes += blob.data.nbytes
+        else:
+            pixel_bytes += blob.data.nbytes
+    return pixel_bytes / num_pixels, roi_bytes / max(num_rois, 1)
+
+def _batch_bytes(batch, costs):
+    """Estimated memory of the net blobs for a batch of inputs."""
+    pixel_bytes, roi_bytes = costs
+    shapes = np.array([inputs['blobs']['data'].shape for inputs in batch])
+    num_rois = sum(inputs['blobs']['rois'].shape[0] for inputs in batch)
+    return pixel_bytes * shapes[:, 0].sum() * shapes[:, 2].max() * \
+            shapes[:, 3].max() + roi_bytes * num_rois
+
+def _detect_stacked(net, batch):
+    """Run one forward pass over a batch of inputs from _prepare_inputs."""
+    counts = [inputs['blobs']['rois'].shape[0] for inputs in batch]
+    outputs = _forward(net, _stack_inputs(batch))
+    return [_postprocess(inputs, im_outputs) for inputs, im_outputs
+            in zip(batch, _split_outputs(outputs, counts))]
+
+def im_detect_batch(net, ims, boxes_list):
+    """Detect object classes in several images, packing as many images into
+    one forward pass as fit in cfg.TEST.BATCH_MEMORY.
+
+    The first image is run alone to measure the memory the net needs per
+    input pixel and per RoI; the remaining images are then grouped greedily
+    in order. Images of one batch are zero padded to the same size, as
+    im_list_to_blob already does for the scales of one image, so features
+    close to the right and bottom borders of the smaller images can differ
+    slightly from those of im_detect.
+
+    Every layer after the RoI pooling must treat the RoIs of each image on
+    their own: the MIL layers of weakly supervised nets need their rois
+    bottom, or they would normalize the scores over all the images of a
+    batch (see _mixes_images).
+
+    Arguments:
+        net (caffe.Net): Fast R-CNN network to use
+        ims (list): color images to test (in BGR order)
+        boxes_list (list): R_i x 4 arrays of object proposals, one per image
+
+    Returns:
+        dets (list): one (scores, boxes) pair per image, as returned by
+            im_detect
+    """
+    assert len(ims) == len(boxes_list)
+    if _mixes_images(net):
+        raise Exception("im_detect_batch needs a rois bottom in the MIL "
+                        "layers of the net; use im_detect instead.")
+    budget = cfg.TEST.BATCH_MEMORY * 1024. * 1024.
+    dets = []
+    costs = None
+    batch = []
+    for i in xrange(len(ims)):
+        inputs = _prepare_inputs(ims[i], boxes_list[i])
+        if len(batch) > 0 and \
+                (costs is None or _batch_bytes(batch + [inputs], costs) > budget):
+            dets.extend(_detect_stacked(net, batch))
+            if costs is None:
+                costs = _blob_costs(net, batch[0]['blobs']['rois'].shape[0])
+            batch = []
+        batch.append(inputs)
+    if len(batch) > 0:
+        dets.extend(_detect_stacked(net, batch))
+    return dets
 
 from utils.cython_bbox import bbox_overlaps
 
@@ -263,6 +535,10 @@ def evalCorLoc(imdb,nms_dets,overlap=0.5):
                 continue
             if np.all(gt[im_ind]['gt_classes']!=cls_ind):
                 continue
+            if len(dets) == 0:
+                # every detection was thresholded away: a miss
+                tot[cls_ind] += 1
+                continue
             sel = gt[im_ind]['gt_classes'] == cls_ind
             gtdet = (gt[im_ind]['boxes'][sel]).astype(np.float, copy=False)
             dets = dets.astype(np.float, copy=False)
@@ -312,74 +588,74 @@ def vis_detections(im, class_name, dets, thresh=0.3):
             #plt.show()
     #plt.show()
 
-def merge_detections(all_boxes,imdb):
-    """Apply non-maximum suppression to all predicted boxes output by the
-    test_net method.
+def _nms_image(dets_list, thresh):
+    """Apply nms to the detections of every class of one image at once.
+
+    Arguments:
+        dets_list (list): dets_list[cls] = N x 5 array of detections (or [])
+
+    Returns:
+        keep (list): keep[cls] = indices of the kept detections of cls, the
+            same (and in the same order) as nms(dets_list[cls], thresh)
+    """
+    keep = [[] for _ in dets_list]
+    classes = [cls for cls, dets in enumerate(dets_list) if len(dets) > 0]
+    if len(classes) == 0:
+        return keep
+    dets = np.vstack([dets_list[cls] for cls in classes]) \
+            .astype(np.float32, copy=False)
+    sizes = np.array([len(dets_list[cls]) for cls in classes])
+    offsets = np.hstack((0, np.cumsum(sizes)))
+    # the exact visiting order of nms, class by class
+    order = np.hstack([dets_list[cls][:, 4].argsort()[::-1] + offset
+                       for cls, offset in zip(classes, offsets)])
+    cls_keep, num_keep = nms_segments(dets, order.astype(np.intp),
+                                      offsets.astype(np.intp), thresh)
+    splits = np.cumsum(num_keep)[:-1]
+    for cls, offset, inds in zip(classes, offsets,
+                                 np.split(cls_keep, splits)):
+        keep[cls] = inds - offset
+    return keep
+
+def nms_keep(all_boxes, thresh, num_workers=None):
+    """Indices of the detections of test_net kept by non-maximum
+    suppression.
+
+    All classes of an image go through nms in one call that releases the
+    GIL, and images are spread over cfg.TEST.NMS_WORKERS threads.
+
+    Returns:
+        keep (list): keep[cls][image] = indices into all_boxes[cls][image]
+            (or [] when there are no detections)
     """
     num_classes = len(all_boxes)
     num_images = len(all_boxes[0])
-    new_boxes = [[[] for _ in xrange(num_images/2)]
-                 for _ in xrange(num_classes)]
-    for cls_ind in xrange(num_classes):
-        #cls_ind=7
-        print "Class",cls_ind
-        for im_ind in xrange(num_images/2):
-            dets_left = all_boxes[cls_ind][im_ind]
-            dets_right = all_boxes[cls_ind][im_ind+num_images/2]
-            if dets_right == []:
-                continue
-            width = PIL.Image.open(imdb.image_path_at(im_ind)).size[0]
-            if 0:
-                if len(dets_left)>0 and len(dets_right)>0:
-                    import pylab
-                    im = cv2.imread(imdb.image_path_at(im_ind))
-                    pylab.figure(0)
-                    pylab.clf()
-                    pylab.imshow(im)
-                    pylab.draw()
-                    pylab.show()
-                    pylab.figure(1)
-                    pylab.clf()
-                    pylab.plot([0,width],[0,400]) #ylim((25,250))
-                    for l in range(len(dets_left)):
-                        if dets_left[l,4]>0.1:
-                            x1=dets_left[l,0];x2=dets_left[l,2]
-                            y1=dets_left[l,1];y2=dets_left[l,3]
-                            pylab.plot([x1,x1,x2,x2,x1],[y1,y2,y2,y1,y1],lw=3)
-                    pylab.draw()
-                    pylab.show()
-                    pylab.figure(2)
-                    pylab.clf()
-                    pylab.plot([0,width],[0,400]) #ylim((25,250))
-                    for l in range(len(dets_right)):
-                        if dets_right[l,4]>0.1:
-                            x1=dets_right[l,0];x2=dets_right[l,2]
-                            y1=dets_right[l,1];y2=dets_right[l,3]
-                            pylab.plot([x1,x1,x2,x2,x1],[y1,y2,y2,y1,y1],lw=3)
-                    pylab.draw()
-                    pylab.show()
-                    #raw_input()            
-            oldx1 = dets_right[:, 0].copy()
-            oldx2 = dets_right[:, 2].copy()
-            dets_right[:,0] = width - oldx2 - 1
-            dets_right[:,2] = width - oldx1 - 1
-            assert (dets_right[:,2] >= dets_right[:,0]).all()        
-            new_boxes[cls_ind][im_ind] = np.concatenate((dets_left,dets_right),0)
-            if 0:
-                if len(dets_right)>0:
-                    import pylab
-                    pylab.figure(3)
-                    pylab.clf()
-                    pylab.plot([0,width],[0,400]) #ylim((25,250))
-                    for l in range(len(dets_right)):
-                        if dets_right[l,4]>0.1:
-                            x1=dets_right[l,0];x2=dets_right[l,2]
-                            y1=dets_right[l,1];y2=dets_right[l,3]
-                            pylab.plot([x1,x1,x2,x2,x1],[y1,y2,y2,y1,y1],lw=3)
-                    pylab.draw()
-                    pylab.show()
-                    raw_input()
-    return new_boxes
+    if num_workers is None:
+        num_workers = cfg.TEST.NMS_WORKERS
+
+    def run(im_inds):
+        return [_nms_image([all_boxes[cls_ind][im_ind]
+                            for cls_ind in xrange(num_classes)], thresh)
+                for im_ind in im_inds]
+
+    # a few chunks of images per thread keeps the threads busy without
+    # paying the pool overhead for every image
+    chunks = np.array_split(np.arange(num_images),
+                            max(min(4 * num_workers, num_images), 1))
+    if num_workers > 1:
+        pool = ThreadPool(num_workers)
+        results = pool.map(run, chunks)
+        pool.close()
+        pool.join()
+    else:
+        results = map(run, chunks)
+
+    keep = [[[] for _ in xrange(num_images)] for _ in xrange(num_classes)]
+    for im_inds, im_keeps in zip(chunks, results):
+        for im_ind, im_keep in zip(im_inds, im_keeps):
+            for cls_ind in xrange(num_classes):
+                keep[cls_ind][im_ind] = im_keep[cls_ind]
+    return keep
 
 def apply_nms(all_boxes, thresh):
     """Apply non-maximum suppression to all predicted boxes output by the
@@ -389,31 +665,213 @@ def apply_nms(all_boxes, thresh):
     num_images = len(all_boxes[0])
     nms_boxes = [[[] for _ in xrange(num_images)]
                  for _ in xrange(num_classes)]
+    keep = nms_keep(all_boxes, thresh)
     for cls_ind in xrange(num_classes):
         for im_ind in xrange(num_images):
-            dets = all_boxes[cls_ind][im_ind]
-            if dets == []:
-                continue
-            keep = nms(dets, thresh)
-            if len(keep) == 0:
+            if len(keep[cls_ind][im_ind]) == 0:
                 continue
-            nms_boxes[cls_ind][im_ind] = dets[keep, :].copy()
+            dets = all_boxes[cls_ind][im_ind]
+            nms_boxes[cls_ind][im_ind] = dets[keep[cls_ind][im_ind], :].copy()
     return nms_boxes
 
-def test_net(net, imdb ,args):
-    """Test a Fast R-CNN network on an image database."""
-    num_images = len(imdb.image_index)
+class _ScoreBuffer(object):
+    """The max_size largest detection scores of one class seen so far.
+
+    Scores are kept in an array sorted in descending order plus a pending
+    array of recent scores. The max_size-th largest score is found exactly
+    after every push with np.partition over the pending scores and as many
+    of the smallest kept scores, and pending scores are merged into the
+    sorted array only once they outnumber max_size / 8.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._top = np.zeros(0, dtype=np.float32)
+        self._pending = np.zeros(0, dtype=np.float32)
+
+    def __len__(self):
+        return min(len(self._top) + len(self._pending), self._max_size)
+
+    def _merge(self):
+        scores = np.concatenate((self._top, self._pending))
+        if len(scores) > self._max_size:
+            scores = np.partition(scores, len(scores) - self._max_size)
+            scores = scores[len(scores) - self._max_size:]
+        self._top = np.sort(scores)[::-1]
+        self._pending = np.zeros(0, dtype=np.float32)
+
+    def push(self, scores):
+        """Add scores and return the max_size-th largest score seen so far,
+        or None if at most max_size scores were seen.
+        """
+        if len(scores) == 0:
+            return None
+        self._pending = np.concatenate((self._pending, scores))
+        num_pending = len(self._pending)
+        if len(self._top) + num_pending <= self._max_size:
+            return None
+        if len(self._top) < self._max_size or \
+                num_pending > max(self._max_size / 8, 1):
+            self._merge()
+            return self._top[-1]
+        # at most num_pending kept scores can fall out of the top max_size,
+        # so the max_size-th largest score is the (num_pending + 1)-th
+        # largest of the pending scores and the num_pending + 1 smallest
+        # kept scores
+        cand = np.concatenate((self._top[-(num_pending + 1):],
+                               self._pending))
+        return np.partition(cand, num_pending)[num_pending]
+
+def _select_detections(scores, boxes, gt_classes, thresh, top_scores,
+                       max_per_image, max_per_set, update_thresh=True):
+    """Keep the top scoring detections of each class in one image.
+
+    thresh and top_scores (one _ScoreBuffer of size max_per_set per class)
+    hold the adaptive per-class score thresholds that enforce max_per_set
+    over the whole imdb; they are updated in place, so images must be passed
+    in order. Detections of equal score are ordered by proposal index.
+
+    Returns:
+        dets (list): dets[j] = N x 5 array of detections of class j in
+            (x1, y1, x2, y2, score) for j >= 1
+    """
+    num_rois, num_classes = scores.shape
+    dets = [[] for _ in xrange(num_classes)]
+    # candidates of all classes at once: above the class threshold and, if
+    # there are more than max_per_image of them, at least as high as the
+    # max_per_image-th largest score of the class
+    cand = (scores[:, 1:] > thresh[np.newaxis, 1:]) & \
+            (gt_classes == 0)[:, np.newaxis]
+    if num_rois > max_per_image:
+        masked = np.where(cand, scores[:, 1:], -np.inf)
+        kth = -np.partition(-masked, max_per_image - 1, axis=0)[max_per_image - 1]
+        cand &= masked >= kth[np.newaxis, :]
+    for j in xrange(1, num_classes):
+        inds = np.where(cand[:, j - 1])[0]
+        cls_scores = scores[inds, j]
+        top_inds = np.argsort(-cls_scores, kind='mergesort')[:max_per_image]
+        inds = inds[top_inds]
+        cls_scores = cls_scores[top_inds]
+        cls_boxes = boxes[inds, j*4:(j+1)*4]
+        # if we've collected more than the max number of detections, then
+        # update the class threshold
+        top_score = top_scores[j].push(cls_scores)
+        if top_score is not None and update_thresh:
+            thresh[j] = top_score
+
+        dets[j] = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
+                .astype(np.float32, copy=False)
+    return dets
+
+def _read_inputs(imdb, i):
+    """Decode image i of an imdb and build its network inputs."""
+    im = cv2.imread(imdb.image_path_at(i))
+    if imdb.roidb[i]['flipped']:
+        im = im[:, ::-1, :]
+    return _prepare_inputs(im, imdb.roidb[i]['boxes'], cfg.TEST.USE_FLIPPED)
+
+def _detection_budget(num_images):
+    """(max_per_set, max_per_image) detections kept per class before NMS."""
     # heuristic: keep an average of 40 detections per class per images prior
     # to NMS
     max_per_set = 40 * num_images #changed from 40
     # heuristic: keep at most 100 detection per class per image prior to NMS
     max_per_image = 100
+    if cfg.TEST.USE_FLIPPED:
+        # the detections of the mirror image come on top of those of the
+        # image, with the same budget as a separate pass over them
+        max_per_set *= 2
+        max_per_image *= 2
+    return max_per_set, max_per_image
+
+def _detect_pipelined(net, imdb, store, collect, timer, features=None):
+    """Run detection over an imdb as a three-stage pipeline.
+
+    A pool of reader threads decodes images and builds their input blobs
+    ahead of the network, the calling thread only runs net.forward, and a
+    single worker thread post-processes the network outputs and passes them
+    to collect(i, scores, boxes). Both queues are bounded by
+    cfg.TEST.PIPELINE_DEPTH and every stage handles images in order, so the
+    result is the same as the sequential loop in test_net.
+
+    With a FeatureWriter, the cfg.TEST.FEAT_LAYER features of every image
+    are appended to it from the worker thread as well.
+    """
+    roidb = imdb.roidb
+    num_images = len(imdb.image_index)
+    depth = cfg.TEST.PIPELINE_DEPTH
+    feat_layer = [] if features is None else [cfg.TEST.FEAT_LAYER]
+
+    def read(i):
+        if store is not None and i in store and \
+                (features is None or i in features):
+            return None
+        return _read_inputs(imdb, i)
+
+    errors = []
+    post_queue = Queue.Queue(depth)
+    def post():
+        while True:
+            item = post_queue.get()
+            if item is None:
+                return
+            if len(errors) > 0:
+                # keep draining so the main thread never blocks
+                continue
+            try:
+                i, inputs, outputs = item
+                if inputs is None:
+                    scores, boxes = store.get(i)
+                else:
+                    scores, boxes = _postprocess(inputs, outputs)
+                    if store is not None and i not in store:
+                        store.append(i, scores, boxes)
+                    if features is not None and i not in features:
+                        features.append(i, _features(inputs, outputs,
+                                                     feat_layer[0]), scores)
+                collect(i, scores, boxes)
+            except Exception:
+                errors.append(sys.exc_info())
+    worker = threading.Thread(target=post)
+    worker.daemon = True
+    worker.start()
+
+    pool = ThreadPool(cfg.TEST.PIPELINE_READERS)
+    pending = collections.deque()
+    next_i = 0
+    try:
+        for i in xrange(num_images):
+            while next_i < num_images and len(pending) < depth:
+                pending.append(pool.apply_async(read, (next_i,)))
+                next_i += 1
+            inputs = pending.popleft().get()
+            if inputs is None:
+                post_queue.put((i, None, None))
+            else:
+                timer.tic()
+                outputs = _forward(net, inputs, feat_layer)
+                timer.toc()
+                post_queue.put((i, inputs, outputs))
+            if len(errors) > 0:
+                break
+    finally:
+        post_queue.put(None)
+        worker.join()
+        pool.terminate()
+        pool.join()
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+def test_net(net, imdb ,args):
+    """Test a Fast R-CNN network on an image database."""
+    num_images = len(imdb.image_index)
+    max_per_set, max_per_image = _detection_budget(num_images)
     # detection thresold for each class (this is adaptively set based on the
     # max_per_set constraint)
     thresh = -np.inf * np.ones(imdb.num_classes)
-    # top_scores will hold one minheap of scores per class (used to enforce
-    # the max_per_set constraint)
-    top_scores = [[] for _ in xrange(imdb.num_classes)]
+    # top_scores will hold the top max_per_set scores per class (used to
+    # enforce the max_per_set constraint)
+    top_scores = [_ScoreBuffer(max_per_set) for _ in xrange(imdb.num_classes)]
     # all detections are collected into:
     #    all_boxes[cls][image] = N x 5 array of detections in
     #    (x1, y1, x2, y2, score)
@@ -425,7 +883,7 @@ def test_net(net, imdb ,args):
         os.makedirs(output_dir)
 
     flip_str=''
-    if args.use_flip:
+    if cfg.TEST.USE_FLIPPED:
         flip_str='flip'
 
     #print "--------",args.reusedet
@@ -442,87 +900,91 @@ def test_net(net, imdb ,args):
         _t = {'im_detect' : Timer(), 'misc' : Timer()}
 
         roidb = imdb.roidb
-        lfeat = []
-        for i in xrange(num_images):
-            im = cv2.imread(imdb.image_path_at(i))
-            if roidb[i]["flipped"]:
-                im = im[:,::-1,:]
-            _t['im_detect'].tic()
-            scores, boxes = im_detect(net, im, roidb[i]['boxes'],args.feat_file,args.eval_segm)
-            _t['im_detect'].toc()
-            #lfeat.append(feat)
-
-            if args.visdet:
-                import pylab
-                pylab.figure(1)
-                pylab.clf()
-                pylab.imshow(im)
-
+        store = None
+        if cfg.TEST.DET_STORE:
+            store = DetectionStore(output_dir,
+                                   model_fingerprint(args.prototxt,
+                                                     args.caffemodel),
+                                   proposal_fingerprint(imdb))
+            print 'Detection store {} holds {:d}/{:d} images' \
+                  .format(store.path, len(store), num_images)
+        features = None
+        if args.feat_file is not None:
+            features = FeatureWriter(os.path.join(output_dir,
+                                                  args.feat_file))
+            print 'Saving the {} features in {} ({:d}/{:d} images done)' \
+                  .format(cfg.TEST.FEAT_LAYER, features.path, len(features),
+                          num_images)
+        _dedup_counts[:] = [0, 0]
+        def collect(i, scores, boxes):
             _t['misc'].tic()
+            dets = _select_detections(scores, boxes, roidb[i]['gt_classes'],
+                                      thresh, top_scores, max_per_image,
+                                      max_per_set,
+                                      args.imdb_name!='voc_2007_trainval')
             for j in xrange(1, imdb.num_classes):
-                inds = np.where((scores[:, j] > thresh[j]) &
-                                (roidb[i]['gt_classes'] == 0))[0]
-                cls_scores = scores[inds, j]
-                cls_boxes = boxes[inds, j*4:(j+1)*4]
-                top_inds = np.argsort(-cls_scores)[:max_per_image]
-                cls_scores = cls_scores[top_inds]
-                cls_boxes = cls_boxes[top_inds, :]
-                # push new scores onto the minheap
-                for val in cls_scores:
-                    heapq.heappush(top_scores[j], val)
-                # if we've collected more than the max number of detection,
-                # then pop items off the minheap and update the class threshold
-                if len(top_scores[j]) > max_per_set:
-                    while len(top_scores[j]) > max_per_set:
-                        heapq.heappop(top_scores[j])
-                        if args.imdb_name!='voc_2007_trainval':#test
-                            thresh[j] = top_scores[j][0]
-
-                all_boxes[j][i] = \
-                        np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                        .astype(np.float32, copy=False)
-                        
-                if args.visdet:
-                    keep = nms(all_boxes[j][i], 0.3)
-                    #import pylab
-                    #pylab.figure(1)
-                    vis_detections(im, imdb.classes[j], all_boxes[j][i][keep, :],0.3)
-                    #pylab.draw()
-                    #pylab.show()
-                    #raw_input()
+                all_boxes[j][i] = dets[j]
             _t['misc'].toc()
 
             print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
                   .format(i + 1, num_images, _t['im_detect'].average_time,
                           _t['misc'].average_time)
-            
-            if args.visdet:
-                pylab.draw()
-                pylab.show()
-                raw_input()
+
+        if cfg.TEST.PIPELINE and not args.visdet:
+            _detect_pipelined(net, imdb, store, collect, _t['im_detect'],
+                              features)
+        else:
+            for i in xrange(num_images):
+                if store is not None and i in store and not args.visdet \
+                        and (features is None or i in features):
+                    scores, boxes = store.get(i)
+                else:
+                    im = cv2.imread(imdb.image_path_at(i))
+                    if roidb[i]["flipped"]:
+                        im = im[:,::-1,:]
+                    _t['im_detect'].tic()
+                    if features is not None:
+                        scores, boxes, feats = im_detect(net, im, roidb[i]['boxes'],args.feat_file,args.eval_segm,cfg.TEST.USE_FLIPPED)
+                    else:
+                        scores, boxes = im_detect(net, im, roidb[i]['boxes'],args.feat_file,args.eval_segm,cfg.TEST.USE_FLIPPED)
+                    _t['im_detect'].toc()
+                    if store is not None and i not in store:
+                        store.append(i, scores, boxes)
+                    if features is not None and i not in features:
+                        features.append(i, feats, scores)
+
+                collect(i, scores, boxes)
+
+                if args.visdet:
+                    import pylab
+                    pylab.figure(1)
+                    pylab.clf()
+                    pylab.imshow(im)
+                    for j in xrange(1, imdb.num_classes):
+                        keep = nms(all_boxes[j][i], 0.3)
+                        vis_detections(im, imdb.classes[j], all_boxes[j][i][keep, :],0.3)
+                    pylab.draw()
+                    pylab.show()
+                    raw_input()
+
+        if store is not None:
+            store.close()
+        if features is not None:
+            features.close()
+        if _dedup_counts[0] > 0:
+            print 'RoI dedup kept {:d}/{:d} RoIs ({:.1%})' \
+                  .format(_dedup_counts[1], _dedup_counts[0],
+                          float(_dedup_counts[1]) / _dedup_counts[0])
 
         for j in xrange(1, imdb.num_classes):
             for i in xrange(num_images):
                 inds = np.where(all_boxes[j][i][:, -1] > thresh[j])[0]
                 all_boxes[j][i] = all_boxes[j][i][inds, :]
-                
-        if args.feat_file!=None:
-            print 'Saving the features in ',os.path.join(output_dir,args.feat_file)
-            with open(os.path.join(output_dir,args.feat_file), 'wb') as f:
-                cPickle.dump(lfeat, f, cPickle.HIGHEST_PROTOCOL)
-                
+
         det_file = os.path.join(output_dir, 'detections%s%s.pkl'%(flip_str,itr))
         with open(det_file, 'wb') as f:
             cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
 
-    if args.use_flip:
-        print "Merging Left Right Detections"
-        all_boxes2 = all_boxes
-        #all_boxes=merge_detections(all_boxes2,imdb)
-        all_boxes=merge_detections(all_boxes2,imdb)
-        from datasets.factory import get_imdb
-        imdb = get_imdb(args.imdb_name)
-
     print 'Applying NMS to all detections'
     nms_dets = apply_nms(all_boxes, cfg.TEST.NMS)
 
@@ -545,3 +1007,134 @@ def test_net(net, imdb ,args):
     else:
         print 'Evaluating detections'
         imdb.evaluate_detections(nms_dets, output_dir, args.overlap)
+
+def _net_weights(net):
+    """Copy of the parameters of net, {layer: [blob data]}."""
+    return dict((name, [blob.data.copy() for blob in blobs])
+                for name, blobs in net.params.iteritems())
+
+def _set_net_weights(net, weights):
+    """Copy parameters saved by _net_weights back into net."""
+    for name, blobs in net.params.iteritems():
+        for blob, data in zip(blobs, weights[name]):
+            blob.data[...] = data
+
+def test_snapshots(net, imdb, prototxt, caffemodels, chunk_size=100,
+                   num_images=None, update_thresh=True):
+    """Test several snapshots of one network on an image database, reading
+    and preprocessing every image only once.
+
+    The images are handled in chunks of chunk_size: the input blobs of a
+    chunk are built once (by cfg.TEST.PIPELINE_READERS threads) and kept in
+    memory while the weights of every snapshot in turn are copied into net
+    and run on them. The caffemodel of a snapshot is read only once: its
+    weights are kept in memory (one copy of the net parameters per
+    snapshot) and copied back into net for each chunk. Each snapshot gets its own output directory, detection
+    store and detections.pkl, as test_net would write them; images already
+    in the store of a snapshot are not run again. With num_images, only the
+    first num_images images are tested (and evaluated). update_thresh is
+    the flag test_net passes to _select_detections (False on
+    voc_2007_trainval, where all detections are kept for CorLoc), so that
+    both report the same results for a snapshot.
+
+    Returns:
+        results (list): one (name, mAP, CorLoc) tuple per snapshot, with the
+            Python VOC AP (see datasets.voc_eval) at 0.5 overlap
+    """
+    if num_images is None or num_images > len(imdb.image_index):
+        num_images = len(imdb.image_index)
+    max_per_set, max_per_image = _detection_budget(num_images)
+    proposal_fp = proposal_fingerprint(imdb)
+    roidb = imdb.roidb
+
+    snapshots = []
+    for caffemodel in caffemodels:
+        name = os.path.splitext(os.path.basename(caffemodel))[0]
+        output_dir = os.path.join(get_output_dir(imdb, None), name)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        store = DetectionStore(output_dir,
+                               model_fingerprint(prototxt, caffemodel),
+                               proposal_fp)
+        print 'Snapshot {}: store holds {:d}/{:d} images' \
+              .format(name, len(store), num_images)
+        weights = None
+        if any(i not in store for i in xrange(num_images)):
+            net.copy_from(caffemodel)
+            weights = _net_weights(net)
+        snapshots.append({
+            'name' : name, 'caffemodel' : caffemodel, 'weights' : weights,
+            'output_dir' : output_dir, 'store' : store,
+            'thresh' : -np.inf * np.ones(imdb.num_classes),
+            'top_scores' : [_ScoreBuffer(max_per_set)
+                            for _ in xrange(imdb.num_classes)],
+            'all_boxes' : [[[] for _ in xrange(num_images)]
+                           for _ in xrange(imdb.num_classes)]})
+
+    # the snapshot whose weights net holds
+    loaded = None
+    for snap in reversed(snapshots):
+        if snap['weights'] is not None:
+            loaded = snap['name']
+            break
+    _t = {'read' : Timer(), 'im_detect' : Timer()}
+    pool = ThreadPool(cfg.TEST.PIPELINE_READERS)
+    for start in xrange(0, num_images, chunk_size):
+        inds = range(start, min(start + chunk_size, num_images))
+        todo = [i for i in inds
+                if any(i not in snap['store'] for snap in snapshots)]
+        _t['read'].tic()
+        inputs = dict(zip(todo, pool.map(lambda i: _read_inputs(imdb, i),
+                                         todo)))
+        _t['read'].toc()
+        for snap in snapshots:
+            if loaded != snap['name'] and \
+                    any(i not in snap['store'] for i in inds):
+                _set_net_weights(net, snap['weights'])
+                loaded = snap['name']
+            for i in inds:
+                if i in snap['store']:
+                    scores, boxes = snap['store'].get(i)
+                else:
+                    _t['im_detect'].tic()
+                    outputs = _forward(net, inputs[i])
+                    _t['im_detect'].toc()
+                    scores, boxes = _postprocess(inputs[i], outputs)
+                    snap['store'].append(i, scores, boxes)
+                dets = _select_detections(scores, boxes,
+                                          roidb[i]['gt_classes'],
+                                          snap['thresh'], snap['top_scores'],
+                                          max_per_image, max_per_set,
+                                          update_thresh)
+                for j in xrange(1, imdb.num_classes):
+                    snap['all_boxes'][j][i] = dets[j]
+        print 'im_detect: {:d}/{:d} x {:d} snapshots {:.3f}s read ' \
+              '{:.3f}s net'.format(inds[-1] + 1, num_images, len(snapshots),
+                                   _t['read'].average_time,
+                                   _t['im_detect'].average_time)
+        del inputs
+    pool.close()
+    pool.join()
+
+    results = []
+    for snap in snapshots:
+        snap['store'].close()
+        all_boxes = snap['all_boxes']
+        for j in xrange(1, imdb.num_classes):
+            for i in xrange(num_images):
+                inds = np.where(all_boxes[j][i][:, -1] > snap['thresh'][j])[0]
+                all_boxes[j][i] = all_boxes[j][i][inds, :]
+        det_file = os.path.join(snap['output_dir'], 'detections.pkl')
+        with open(det_file, 'wb') as f:
+            cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
+
+        print 'Evaluating snapshot {}'.format(snap['name'])
+        keep = nms_keep(all_boxes, cfg.TEST.NMS)
+        aps = DetectionEval(imdb, all_boxes).evaluate(keep)
+        nms_dets = [[all_boxes[j][i][keep[j][i]] if len(keep[j][i]) > 0
+                     else all_boxes[j][i][:0]
+                     for i in xrange(num_images)]
+                    for j in xrange(imdb.num_classes)]
+        corloc = evalCorLoc(imdb, nms_dets)
+        results.append((snap['name'], aps.mean(), corloc.mean()))
+    return results
@@ -86,7 +86,10 @@ class SolverWrapper(object):
                     '_iter_{:d}'.format(self.solver.iter) + '.caffemodel')
         filename = os.path.join(self.output_dir, filename)
 
-        net.save(str(filename))
+        # write under a temporary name first, so that a snapshot that shows
+        # up under its final name is complete (see tools/watch_snapshots.py)
+        net.save(str(filename + '.tmp'))
+        os.rename(filename + '.tmp', filename)
         print 'Wrote snapshot to: {:s}'.format(filename)
 
         if cfg.TRAIN.BBOX_REG:
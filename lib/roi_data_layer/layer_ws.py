@@ -35,8 +35,10 @@ class RoIDataLayer(caffe.Layer):
         return db_inds
 
     def _get_next_minibatch_inds_pair(self):
-        """Return the roidb indices for the next minibatch."""
-        assert(cfg.TRAIN.IMS_PER_BATCH==2)
+        """Return the roidb indices for the next minibatch: the next image
+        and IMS_PER_BATCH - 1 of the following images that share one of its
+        classes.
+        """
         if self._cur + cfg.TRAIN.IMS_PER_BATCH >= len(self._roidb):
             self._shuffle_roidb_inds()
 
@@ -45,21 +47,24 @@ class RoIDataLayer(caffe.Layer):
         #select one of the classes in the image
         allcls=self._cls[self._perm[self._cur]]
         cls=np.random.choice(allcls)
-        #find the next image of the same class 
+        #find the next images of the same class 
         #it is ok because the samples are shuffled
         idx = self._cur
         #print "Perm",self._perm[:10]
         #print "S1",self._cur,allcls,cls
         #print "S1+1",self._cur,self._cls[self._perm[self._cur+1]]
-        while True:
-            idx+=1
-            if idx >= len(self._roidb):
-                idx=0
-            if cls in self._cls[self._perm[idx]]:
-                db_inds[-1]=self._perm[idx]
-                #print "S2",idx,self._cls[self._perm[idx]]
-                #print self._roidb[self._perm[idx]]['gt_classes']
-                break
+        for k in xrange(1, cfg.TRAIN.IMS_PER_BATCH):
+            while True:
+                idx+=1
+                if idx >= len(self._roidb):
+                    idx=0
+                # (an image comes back when fewer than IMS_PER_BATCH images
+                # have the class)
+                if cls in self._cls[self._perm[idx]]:
+                    db_inds[k]=self._perm[idx]
+                    #print "S2",idx,self._cls[self._perm[idx]]
+                    #print self._roidb[self._perm[idx]]['gt_classes']
+                    break
         #print "Current",self._cur
         self._cur += 1#cfg.TRAIN.IMS_PER_BATCH
         #raw_input()
@@ -160,6 +165,12 @@ class RoIDataLayer(caffe.Layer):
             # thisbinary vector sepcifies the subset of active targets
             top[4].reshape(1, self._num_classes * 4)
 
+        if cfg.TRAIN.WEAKLY_SUP and cfg.TRAIN.DEDUP_ROIS:
+            # roi_weights blob: R multiplicities of the deduplicated RoIs
+            roi_weights_ind = len(self._name_to_top_map)
+            self._name_to_top_map['roi_weights'] = roi_weights_ind
+            top[roi_weights_ind].reshape(1)
+
     def forward(self, bottom, top):
         """Get blobs and copy them into this layer's top blob vector."""
         if 1:#not self.done:
@@ -12,6 +12,7 @@ import numpy.random as npr
 import cv2
 from fast_rcnn.config import cfg
 from utils.blob import prep_im_for_blob, im_list_to_blob
+from utils.dedup import unique_rois
 
 def get_minibatch(roidb, num_classes):
     """Given a roidb, construct a minibatch sampled from it."""
@@ -69,6 +70,11 @@ def get_minibatch(roidb, num_classes):
                  'rois': rois_blob,
                  #'labels': labels_blob,
                  'labels_im': labels_im_blob}
+        if cfg.TRAIN.DEDUP_ROIS and cfg.DEDUP_BOXES > 0:
+            # the regression targets of the copies of a RoI differ
+            assert not cfg.TRAIN.BBOX_REG, \
+                'DEDUP_ROIS does not support bounding-box regression'
+            blobs['rois'], blobs['roi_weights'] = _dedup_rois(rois_blob)
     else:
         blobs = {'data': im_blob,
              'rois': rois_blob,
@@ -82,6 +88,16 @@ def get_minibatch(roidb, num_classes):
 
     return blobs
 
+def _dedup_rois(rois_blob):
+    """Collapse the RoIs that pool the same feature map cells.
+
+    Returns the unique RoIs and the number of sampled RoIs each of them
+    stands for.
+    """
+    index, inv_index = unique_rois(rois_blob, cfg.DEDUP_BOXES)
+    roi_weights = np.bincount(inv_index).astype(np.float32)
+    return rois_blob[index, :], roi_weights
+
 def _sample_rois(roidb, fg_rois_per_image, rois_per_image, num_classes):
     """Generate a random sample of RoIs comprising foreground and background
     examples.
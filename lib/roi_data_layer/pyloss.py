@@ -4,6 +4,8 @@ import yaml
 import os
 
 from fast_rcnn.config import cfg
+from utils.integral import integral_image, box_sums, box_scatter
+from utils.buffers import layer_buffer
 
 #deprecated: use the PlotSeg with the right parameters
 class PlotSegAll(caffe.Layer):
@@ -149,13 +151,13 @@ class EuclideanLossLayer(caffe.Layer):
         if bottom[0].count != bottom[1].count:
             raise Exception("Inputs must have the same dimension.")
         # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
+        layer_buffer(self, 'diff', bottom[0].data.shape)
         # loss output is scalar
         top[0].reshape(1)
 
     def forward(self, bottom, top):
-        self.diff[...] = bottom[0].data - bottom[1].data
-        top[0].data[...] = np.sum(self.diff**2) / bottom[0].num / 2.
+        np.subtract(bottom[0].data, bottom[1].data, out=self.diff)
+        top[0].data[...] = np.vdot(self.diff, self.diff) / bottom[0].num / 2.
         if 0:
             print "out",bottom[0].data.squeeze() 
             print "gt",bottom[1].data.squeeze()
@@ -171,7 +173,7 @@ class EuclideanLossLayer(caffe.Layer):
                 sign = 1
             else:
                 sign = -1
-            bottom[i].diff[...] = sign * self.diff / bottom[i].num
+            np.multiply(self.diff, sign / float(bottom[i].num), out=bottom[i].diff)
 
 def softmax(x,axis=-1):
     #e_x = np.exp(x - np.max(x,axis=axis))
@@ -203,13 +205,15 @@ class LogLoss(caffe.Layer):
         if bottom[0].count != bottom[1].count:
             raise Exception("Inputs must have the same dimension.")
         # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
+        layer_buffer(self, 'diff', bottom[0].data.shape)
         # loss output is scalar
         top[0].reshape(1)
 
     def forward(self, bottom, top):
         #p = weights(bottom[0].data)
-        self.diff[...] =  - bottom[1].data/(bottom[0].data+0.00001)
+        np.add(bottom[0].data, 0.00001, out=self.diff)
+        np.divide(bottom[1].data, self.diff, out=self.diff)
+        np.negative(self.diff, out=self.diff)
         top[0].data[...] = -np.sum(np.log(bottom[0].data)*bottom[1].data)#/bottom[0].count# / bottom[0].num / 2.
         if 0:
             print "out",bottom[0].data.squeeze() 
@@ -227,7 +231,7 @@ class LogLoss(caffe.Layer):
                 sign = 1
             else:
                 sign = -1
-            bottom[i].diff[...] = sign * self.diff #/ bottom[i].count
+            np.multiply(self.diff, sign, out=bottom[i].diff) #/ bottom[i].count
 
 class PlotSeg(caffe.Layer):
     """
@@ -319,6 +323,28 @@ class PlotSeg(caffe.Layer):
         pass
 
 
+def hinge(layer, scores, labels):
+    """Sum of the hinge losses max(0, 1 - scores*y) of the labels as binary
+    targets y = 1 (label > 0) or -1, leaving the labels unchanged. Fills
+    layer.diff with the gradient w.r.t. the scores, working in float32
+    buffers of the layer.
+    """
+    labels = labels.reshape(scores.shape)
+    y = layer_buffer(layer, 'sign', scores.shape)
+    act = layer_buffer(layer, 'act', scores.shape)
+    diff = layer_buffer(layer, 'diff', scores.shape)
+    np.greater(labels, 0, out=y)
+    y *= 2
+    y -= 1
+    np.multiply(scores, y, out=act)
+    np.subtract(1, act, out=act)
+    # -y where the hinge is active
+    np.greater(act, 0, out=diff)
+    diff *= y
+    np.negative(diff, out=diff)
+    np.maximum(act, 0, out=act)
+    return act.sum(dtype=np.float64)
+
 class HingeLoss(caffe.Layer):
     """
     Compute multiclass Hinge Loss 
@@ -342,20 +368,16 @@ class HingeLoss(caffe.Layer):
         if bottom[0].count != bottom[1].count:
             raise Exception("Inputs must have the same dimension.")
         # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
+        layer_buffer(self, 'diff', bottom[0].data.shape)
         # loss output is scalar
         top[0].reshape(1)
 
     def forward(self, bottom, top):
         #p = weights(bottom[0].data)
-        bottom[1].data[bottom[1].data[...]>0]=1 #restore to a binary measure
-        y = bottom[1].data*2-1
-        act = 1-bottom[0].data*y
-        self.diff=np.zeros(y.shape)
-        self.diff[act>0] = - y[act>0] 
-        top[0].data[...] = self.myloss_weight*np.sum(np.maximum(0,act))#/bottom[0].count# / bottom[0].num / 2.
-        if np.any(np.isnan(act)):
-            dsfsdf
+        loss = hinge(self, bottom[0].data, bottom[1].data)
+        top[0].data[...] = self.myloss_weight*loss#/bottom[0].count# / bottom[0].num / 2.
+        if np.isnan(loss):
+            raise Exception("NaN loss in HingeLoss")
         if 0:
             if self.myloss_weight>0:
                 print "out",bottom[0].data.squeeze() 
@@ -374,7 +396,8 @@ class HingeLoss(caffe.Layer):
                 sign = 1
             else:
                 sign = -1
-            bottom[i].diff[...] = self.myloss_weight*sign * self.diff #/ bottom[i].count
+            np.multiply(self.diff, self.myloss_weight*sign,
+                        out=bottom[i].diff.reshape(self.diff.shape)) #/ bottom[i].count
 
 class HingeLossLoc(caffe.Layer):
     """
@@ -401,41 +424,34 @@ class HingeLossLoc(caffe.Layer):
         # check input dimensions match
         if bottom[1].num != bottom[2].num:
             raise Exception("Score and proposals should have the same num")
-        # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
         # loss output is scalar
         top[0].reshape(1)
 
+    def _box_means(self, segm, boxes):
+        """Mean of the segmentation inside (pos) and outside (neg) of every
+        box, B x C, from a summed-area table. Boxes without inside or
+        outside get pos 0 and neg -1.
+        """
+        inside_sum = box_sums(integral_image(segm), boxes)
+        pos = inside_sum/np.where(self.empty, 1, self.inside)[:,np.newaxis]
+        neg = (segm.sum(2).sum(1)-inside_sum)/np.where(self.empty, 1, self.outside)[:,np.newaxis]
+        pos[self.empty] = 0
+        neg[self.empty] = -1
+        return pos, neg
+
     def forward(self, bottom, top):
         h=bottom[0].data.shape[2]
         w=bottom[0].data.shape[3]
         fbox = np.round(bottom[2].data[:,1:]*self.spatial_scale).astype(np.int)
-        self.fbox = fbox
-        #for each box
-        loss=0
-        fullneg=bottom[0].data.sum(3).sum(2)
-        num_proposals = bottom[1].data.shape[0]
-        num_classes = bottom[1].data.shape[1]
-        self.act=np.zeros(num_proposals)
-        self.hinge=np.zeros(num_proposals)
-        pos = np.zeros((num_proposals,num_classes))
-        neg = np.zeros((num_proposals,num_classes))
-        for b in np.arange(num_proposals):
-            #for the moment assume only 1 image per batch            
-            wb=fbox[b,2]-fbox[b,0]
-            hb=fbox[b,3]-fbox[b,1]
-            if hb==0 or wb==0:
-                pos[b]=0
-                neg[b]=-1     
-            elif h==hb and w==wb: #bounding box with size of the image
-                pos[b]=0
-                neg[b]=-1              
-            else:
-		if h*w-hb*wb==0:
-		    sdfsd
-                pos[b] = (bottom[0].data[0,:,fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1]).sum(2).sum(1)#/(hb*wb+1e-8)
-                neg[b] = (fullneg-pos[b])/(h*w-hb*wb)
-                pos[b] /= (hb*wb)
+        wb=fbox[:,2]-fbox[:,0]
+        hb=fbox[:,3]-fbox[:,1]
+        # the normalizations use the unclipped sizes
+        self.inside = (hb*wb).astype(np.float64)
+        self.outside = (h*w-hb*wb).astype(np.float64)
+        self.empty = (hb==0) | (wb==0) | (self.outside==0)
+        # inside sums over the part of the box on the map
+        self.boxes = np.minimum(fbox, [w-1,h-1,w-1,h-1])
+        pos, neg = self._box_means(bottom[0].data[0], self.boxes)
         self.act = neg-pos+1>0
         self.hinge = np.clip(neg-pos+1,0,np.inf)
         top[0].data[...] = self.myloss_weight*np.sum(bottom[1].data[:]*self.hinge)
@@ -453,29 +469,42 @@ class HingeLossLoc(caffe.Layer):
     def backward(self, top, propagate_down, bottom):
         h=bottom[0].data.shape[2]
         w=bottom[0].data.shape[3]
-        num_proposals = bottom[1].data.shape[0]
-        fbox = self.fbox
-        bottom[0].diff[...] = 0
-        for b in np.arange(num_proposals):
-            if np.any(self.act[b]==True):
-                wb=fbox[b,2]-fbox[b,0]
-                hb=fbox[b,3]-fbox[b,1]
-                if hb==0 or wb==0: #bounding box with size 0
-                    pass
-                elif h==hb and w==wb: #bounding box with size of the image
-                    pass
-                else:
-                    bottom[0].diff[0,self.act[b],:,:] += bottom[1].data[b,self.act[b],np.newaxis,np.newaxis]/(h*w-hb*wb) #negative
-                    bottom[0].diff[0,self.act[b],fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1] += -bottom[1].data[b,self.act[b],np.newaxis,np.newaxis]/(h*w-hb*wb) #negative
-                    bottom[0].diff[0,self.act[b],fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1] += -bottom[1].data[b,self.act[b],np.newaxis,np.newaxis]/(hb*wb) #positive
-        bottom[0].diff[...] *= self.myloss_weight
+        # weight of the active hinges (empty boxes are never active)
+        coef = np.where(self.act, bottom[1].data, 0)
+        outside = np.where(self.empty, 1, self.outside)[:,np.newaxis]
+        inside = np.where(self.empty, 1, self.inside)[:,np.newaxis]
+        # negative: the whole map, minus the inside of the box
+        diff = -box_scatter(coef/outside+coef/inside, self.boxes, (h,w))
+        diff += (coef/outside).sum(0)[:,np.newaxis,np.newaxis]
+        bottom[0].diff[0] = diff*self.myloss_weight
         bottom[1].diff[...] = self.myloss_weight*self.hinge
-        if np.any(np.isnan(bottom[0].diff)):
-            print "Nan error"
-            dsfsf
-        if np.any(np.isnan(bottom[1].diff)):
-            print "Nan error"
-            dsfsf
+        if cfg.TRAIN.CHECK_GRAD:
+            if np.any(np.isnan(bottom[0].diff)) or np.any(np.isnan(bottom[1].diff)):
+                raise Exception("NaN gradient in HingeLossLoc")
+            err = self._check_grad(bottom)
+            print "Testing Gradient HingeLossLoc",err
+            if err>1e-3:
+                raise Exception("Error in the gradient!")
+
+    def _check_grad(self, bottom, epsilon=1e-3, num_checks=20):
+        """Compare the gradient w.r.t. the segmentation with finite
+        differences of the loss on random pixels.
+        """
+        segm = bottom[0].data[0].astype(np.float64)
+        def loss():
+            pos, neg = self._box_means(segm, self.boxes)
+            return self.myloss_weight*np.sum(bottom[1].data*np.clip(neg-pos+1,0,np.inf))
+        err = 0.
+        for _ in xrange(num_checks):
+            c, y, x = [np.random.randint(n) for n in segm.shape]
+            segm[c,y,x] += epsilon
+            fp = loss()
+            segm[c,y,x] -= 2*epsilon
+            fn = loss()
+            segm[c,y,x] += epsilon
+            num_diff = (fp-fn)/(2*epsilon)
+            err += (num_diff-bottom[0].diff[0,c,y,x])**2
+        return err
 
 
 class HingeLoss2(caffe.Layer):
@@ -493,18 +522,14 @@ class HingeLoss2(caffe.Layer):
 #        if bottom[0].count != bottom[1].count:
 #            raise Exception("Inputs must have the same dimension.")
         # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
+        layer_buffer(self, 'diff', bottom[0].data.shape)
         # loss output is scalar
         top[0].reshape(1)
 
     def forward(self, bottom, top):
         #p = weights(bottom[0].data)
-        bottom[1].data[bottom[1].data[...]>0]=1 #restore to a binary measure
-        y = bottom[1].data*2-1
-        act = 1-bottom[0].data*y
-        self.diff=np.zeros(y.shape)
-        self.diff[act>0] = - y[act>0] 
-        top[0].data[...] = np.sum(np.maximum(0,act))/bottom[0].num#/bottom[0].count# / bottom[0].num / 2.
+        loss = hinge(self, bottom[0].data, bottom[1].data)
+        top[0].data[...] = loss/bottom[0].num#/bottom[0].count# / bottom[0].num / 2.
         if 0:
             print "out",bottom[0].data.squeeze() 
             print "gt",bottom[1].data.squeeze()
@@ -522,7 +547,60 @@ class HingeLoss2(caffe.Layer):
                 sign = 1
             else:
                 sign = -1
-            bottom[i].diff[...] = sign * self.diff/bottom[0].num #/ bottom[i].count
+            np.multiply(self.diff, sign/float(bottom[0].num),
+                        out=bottom[i].diff.reshape(self.diff.shape)) #/ bottom[i].count
+
+def _pair_inputs(bottom, acl):
+    """R x D features, R x K' weights of the K' classes in acl and the image
+    (0 or 1) of the R regions of the pairwise layers.
+    """
+    num = bottom[0].num
+    feats = bottom[0].data.reshape(num,-1)
+    weights = bottom[1].data.reshape(num,-1)[:,acl]
+    images = bottom[2].data[:,0]
+    return feats, weights, images
+
+def image_class_sums(feats, weights, images, num_images=2):
+    """K' x D class-weighted feature sums of each of the images (image 0 and
+    image 1 of a pair by default): one (K' x R_i) x (R_i x D) product per
+    image.
+    """
+    return [np.dot(weights[images==i].T, feats[images==i])
+            for i in xrange(num_images)]
+
+def pair_diffs(feats, weights, images, grads):
+    """Gradients w.r.t. the features and the weights of a loss of the class
+    sums of the two images, given its gradients w.r.t. the sums.
+    """
+    dfeats = np.zeros(feats.shape, dtype=np.float32)
+    dweights = np.zeros(weights.shape, dtype=np.float32)
+    for i, grad in enumerate(grads):
+        grad = grad.astype(np.float32)
+        sel = images==i
+        dfeats[sel] = np.dot(weights[sel], grad)
+        dweights[sel] = np.dot(feats[sel], grad.T)
+    return dfeats, dweights
+
+def check_pair_grad(loss, feats, weights, dfeats, dweights, epsilon=1e-3,
+                    num_checks=20):
+    """Squared error of the gradients of loss(feats, weights) against finite
+    differences on random features and weights.
+    """
+    x = [feats.astype(np.float64), weights.astype(np.float64)]
+    dx = [dfeats, dweights]
+    err = 0.
+    for _ in xrange(num_checks):
+        k = np.random.randint(2)
+        if x[k].size == 0:
+            continue
+        r, c = [np.random.randint(n) for n in x[k].shape]
+        x[k][r,c] += epsilon
+        fp = loss(*x)
+        x[k][r,c] -= 2*epsilon
+        fn = loss(*x)
+        x[k][r,c] += epsilon
+        err += ((fp-fn)/(2*epsilon)-dx[k][r,c])**2
+    return err
 
 class MyDistance(caffe.Layer):
     #   bottom[0]: "fc7"       features
@@ -543,48 +621,41 @@ class MyDistance(caffe.Layer):
     def reshape(self, bottom, top):
         bottom[0].reshape(bottom[0].num, bottom[0].channels,bottom[0].height, bottom[0].width)
         top[0].reshape(1)#cfg.TRAIN.IMS_PER_BATCH, bottom[0].channels,bottom[0].height, bottom[0].width)
+        self.channels = bottom[0].channels
+
+    def _loss(self, a, b):
+        """Loss and its gradients w.r.t. the class sums a and b of the two
+        images: half the squared distance of the sums of every shared class.
+        """
+        diff = a-b
+        scale = self.myloss_weight/self.channels
+        return scale*0.5*np.sum(diff**2), [scale*diff, -scale*diff]
 
     def forward(self, bottom, top):
         self.acl=((bottom[3].data[0]+bottom[3].data[1])==2).squeeze()
         if cfg.TRAIN.SAME_CLASS_PAIR:
             assert(np.any(self.acl))
-        cls=np.arange(self.num_cl)[self.acl]
-        self.diff=np.zeros((self.num_cl,bottom[0].data.shape[1],1))
-        self.dist=np.zeros(self.num_cl)
-        for cl in cls: 
-            aux=(bottom[0].data.T*bottom[1].data[:,cl]).T
-            dsr0=(aux[bottom[2].data[:,0]==0]).sum(0)
-            dsr1=(aux[bottom[2].data[:,0]==1]).sum(0)
-            self.diff[cl] = (dsr0-dsr1).reshape((-1,1))
-            self.dist[cl]=0.5*np.sum((self.diff)**2)
-        top[0].data[0]=self.myloss_weight * self.dist.sum()/bottom[0].channels
+        feats, weights, images = _pair_inputs(bottom, self.acl)
+        loss, self.grads = self._loss(*image_class_sums(feats, weights, images))
+        top[0].data[0]=loss
         #print " DisLoss",top[0].data[0],
         
 
     def backward(self, top, propagate_down, bottom):
         #acl=(bottom[3].data[0]-bottom[3].data[1])==0
-        bottom[0].diff[...]=0
+        feats, weights, images = _pair_inputs(bottom, self.acl)
+        dfeats, dweights = pair_diffs(feats, weights, images, self.grads)
+        bottom[0].diff[...]=dfeats.reshape(bottom[0].diff.shape)
         bottom[1].diff[...]=0
-        if 1:#top[0].data[0]<0.1:
-            cls=(np.arange(self.num_cl)[self.acl])
-            for cl in cls:
-                #bottom[0].diff[:,:,0,0] = bottom[0].diff[:,:,0,0] + self.myloss_weight * np.dot((bottom[1].data[:,cl]).reshape((-1,1)),self.diff[cl].T)
-                #bottom[1].diff[:,cl] = bottom[1].diff[:,cl] + self.myloss_weight * (np.dot(bottom[0].data[:,:,0,0],self.diff[cl])[:,0])
-                bottom[0].diff[:,:,0,0] += self.myloss_weight * np.dot((bottom[1].data[:,cl]).reshape((-1,1)),self.diff[cl].T)/bottom[0].channels
-                bottom[1].diff[:,cl] += self.myloss_weight * (np.dot(bottom[0].data[:,:,0,0],self.diff[cl])[:,0])/bottom[0].channels
-            sel = bottom[2].data[:,0]==1
-            bottom[0].diff[sel] = -bottom[0].diff[sel]
-            bottom[1].diff[sel] = -bottom[1].diff[sel]
+        bottom[1].diff.reshape(bottom[1].num,-1)[:,self.acl]=dweights
                   
         if cfg.TRAIN.CHECK_GRAD:
-            x = bottom[0].data[sel]
-            err=check_grad(f,g,x,1e-4)
-            print "Testing Gradient Sum",err
+            loss = lambda f, w: self._loss(*image_class_sums(f, w, images))[0]
+            err=check_pair_grad(loss,feats,weights,dfeats,dweights)
+            print "Testing Gradient MyDistance",err
             if err>1e-3:
-                dsfsd
-                print "Error in the gradient!"
+                raise Exception("Error in the gradient!")
 
-import math
 class MyCosSim(caffe.Layer):
     #   bottom[0]: "fc7"       features
     #   bottom[1]: "soft_max"  weights
@@ -614,55 +685,140 @@ class MyCosSim(caffe.Layer):
         #raw_input()
         #bottom[1][0] tells from which image every layer comes from
 
+    def _loss(self, a, b):
+        """Loss and its gradients w.r.t. the class sums a and b of the two
+        images: 1 - the cosine similarity of the sums of every shared class.
+        """
+        a = a.astype(np.float64)
+        b = b.astype(np.float64)
+        ab = (a*b).sum(1)[:,np.newaxis]
+        na = (a*a).sum(1)[:,np.newaxis]+1e-8
+        nb = (b*b).sum(1)[:,np.newaxis]+1e-8
+        sqab = np.sqrt(na)*np.sqrt(nb)
+        grad_a = -(b-a*ab/na)/sqab
+        grad_b = -(a-b*ab/nb)/sqab
+        return (self.myloss_weight*np.sum(1-ab/sqab),
+                [self.myloss_weight*grad_a, self.myloss_weight*grad_b])
+
     def forward(self, bottom, top):
         self.acl=((bottom[3].data[0]+bottom[3].data[1])==2).squeeze()
         if cfg.TRAIN.SAME_CLASS_PAIR:
             assert(np.any(self.acl))
-        cls=np.arange(self.num_cl)[self.acl]
-        self.diff=np.zeros((self.num_cl,2,bottom[0].data.shape[1],1))
-        self.dist=np.zeros(self.num_cl)
-        for cl in cls: 
-            #if truncated sample don't do anything
-            #bestbb=bottom[1].data[:,cl]>self.thr_trunc
-            aux=(bottom[0].data.T*bottom[1].data[:,cl]).T
-            a=(aux[bottom[2].data[:,0]==0]).sum(0).squeeze()
-            b=(aux[bottom[2].data[:,0]==1]).sum(0).squeeze()
-            ab = np.dot(a,b)
-            na = np.dot(a,a)+1e-8
-            nb = np.dot(b,b)+1e-8
-            sqab = math.sqrt(na)*math.sqrt(nb)
-            self.diff[cl,0] = -(-a*ab/(na**2./3.*nb)+b/sqab).reshape((-1,1))
-            self.diff[cl,1] = -(-b*ab/(nb**2./3.*na)+a/sqab).reshape((-1,1))
-            self.dist[cl] = 1-ab/(sqab)
-        top[0].data[0]=self.myloss_weight * self.dist.sum()#/bottom[0].channels
+        feats, weights, images = _pair_inputs(bottom, self.acl)
+        loss, self.grads = self._loss(*image_class_sums(feats, weights, images))
+        top[0].data[0]=loss#/bottom[0].channels
         #print " DisLoss",top[0].data[0],
         
 
     def backward(self, top, propagate_down, bottom):
         #acl=(bottom[3].data[0]-bottom[3].data[1])==0
-        bottom[0].diff[...]=0
+        feats, weights, images = _pair_inputs(bottom, self.acl)
+        dfeats, dweights = pair_diffs(feats, weights, images, self.grads)
+        bottom[0].diff[...]=dfeats.reshape(bottom[0].diff.shape)
         bottom[1].diff[...]=0
-        if 1:#top[0].data[0]<0.1:
-            cls=(np.arange(self.num_cl)[self.acl])
-            for cl in cls:
-                #if truncated sample don't do anything
-                sel = bottom[2].data[:,0]==0
-                bottom[0].diff[sel,:,0,0] += self.myloss_weight * np.dot((bottom[1].data[sel,cl]).reshape((-1,1)),self.diff[cl,0].T)#/bottom[0].channels
-                bottom[1].diff[sel,cl] += self.myloss_weight * (np.dot(bottom[0].data[sel,:,0,0],self.diff[cl,0])[:,0])#/bottom[0].channels
-                sel = bottom[2].data[:,0]==1
-                bottom[0].diff[sel,:,0,0] += self.myloss_weight * np.dot((bottom[1].data[sel,cl]).reshape((-1,1)),self.diff[cl,1].T)#/bottom[0].channels
-                bottom[1].diff[sel,cl] += self.myloss_weight * (np.dot(bottom[0].data[sel,:,0,0],self.diff[cl,1])[:,0])#/bottom[0].channels
-            
-        #sel = bottom[2].data[:,0]==cl
-        #bottom[0].diff[sel] = np.dot(bottom[1].data,top[0].diff[cl])
+        bottom[1].diff.reshape(bottom[1].num,-1)[:,self.acl]=dweights
         
         if cfg.TRAIN.CHECK_GRAD:
-            x = bottom[0].data[sel]
-            err=check_grad(f,g,x,1e-4)
-            print "Testing Gradient Sum",err
+            loss = lambda f, w: self._loss(*image_class_sums(f, w, images))[0]
+            err=check_pair_grad(loss,feats,weights,dfeats,dweights)
+            print "Testing Gradient MyCosSim",err
+            if err>1e-3:
+                raise Exception("Error in the gradient!")
+
+
+class MyPairwise(caffe.Layer):
+    """
+    Pairwise similarity of all the images of a batch: for every class that
+    two or more images share, the class-weighted feature sums of every pair
+    of them are pulled together, with half their squared distance over the
+    number of channels ('dist', as MyDistance) or 1 - their cosine
+    similarity ('cos', as MyCosSim). All the pairs of a class come from
+    the K x K Gram matrix of the sums of the K = IMS_PER_BATCH images, so
+    with two images it is MyDistance or MyCosSim.
+    """
+    #   bottom[0]: "fc7"       features
+    #   bottom[1]: "soft_max"  weights
+    #   bottom[2]: "rois"      image
+    #   bottom[3]: "labels_im" image classes
+
+    def setup(self, bottom, top):
+        if len(bottom) != 4:
+            raise Exception("Need features, weights, rois and image labels.")
+        layer_params = yaml.load(self.param_str_)
+        if layer_params.has_key('myloss_weight'):
+            self.myloss_weight = layer_params['myloss_weight']
+        else:
+            self.myloss_weight = cfg.TRAIN.PAIRWISE_WEIGHT
+        if layer_params.has_key('mode'):
+            self.mode = layer_params['mode']
+        else:
+            self.mode = 'cos'
+        if self.mode not in ('dist', 'cos'):
+            raise Exception("Unknown pairwise mode {}".format(self.mode))
+        print "Pairwise",self.mode,"loss weight",self.myloss_weight
+
+    def reshape(self, bottom, top):
+        top[0].reshape(1)
+        self.channels = bottom[0].channels
+
+    def _loss(self, sums, members):
+        """Loss and its gradients w.r.t. the K' x D class sums of each of the
+        K images, given the K x K' image labels of the K' classes. The K' x
+        K x K Gram matrices of all the classes come from one batched product.
+        """
+        # class-major K' x K x D sums
+        a = np.array(sums, dtype=np.float64).transpose(1,0,2)
+        m = members.T
+        pairs = np.triu(m[:,:,np.newaxis]*m[:,np.newaxis,:], 1)
+        gram = np.matmul(a, a.transpose(0,2,1))
+        norms = np.diagonal(gram, axis1=1, axis2=2)
+        eye = np.eye(len(members))
+        if self.mode == 'dist':
+            dist = norms[:,:,np.newaxis]+norms[:,np.newaxis,:]-2*gram
+            loss = 0.5*np.sum(pairs*dist)/self.channels
+            deg = 0.5*(pairs.sum(1)+pairs.sum(2))
+            dgram = (eye*deg[:,:,np.newaxis]-pairs)/self.channels
+        else:
+            norms = norms+1e-8
+            sq = np.sqrt(norms)
+            sqab = sq[:,:,np.newaxis]*sq[:,np.newaxis,:]
+            cos = gram/sqab
+            loss = np.sum(pairs*(1-cos))
+            deg = 0.5*((pairs+pairs.transpose(0,2,1))*cos).sum(2)/norms
+            dgram = -pairs/sqab+eye*deg[:,:,np.newaxis]
+        grads = np.matmul(dgram+dgram.transpose(0,2,1), a).transpose(1,0,2)
+        return self.myloss_weight*loss, list(self.myloss_weight*grads)
+
+    def _inputs(self, bottom):
+        feats, weights, images = _pair_inputs(bottom, self.acl)
+        members = self.labels[:,self.acl]
+        return feats, weights, images, members
+
+    def forward(self, bottom, top):
+        num_images = bottom[3].num
+        self.labels = (bottom[3].data.reshape(num_images,-1)>0).astype(np.float64)
+        self.acl = self.labels.sum(0)>=2
+        if cfg.TRAIN.SAME_CLASS_PAIR:
+            assert(np.any(self.acl))
+        feats, weights, images, members = self._inputs(bottom)
+        sums = image_class_sums(feats, weights, images, num_images)
+        loss, self.grads = self._loss(sums, members)
+        top[0].data[0]=loss
+
+    def backward(self, top, propagate_down, bottom):
+        feats, weights, images, members = self._inputs(bottom)
+        dfeats, dweights = pair_diffs(feats, weights, images, self.grads)
+        bottom[0].diff[...]=dfeats.reshape(bottom[0].diff.shape)
+        bottom[1].diff[...]=0
+        bottom[1].diff.reshape(bottom[1].num,-1)[:,self.acl]=dweights
+
+        if cfg.TRAIN.CHECK_GRAD:
+            num_images = len(self.grads)
+            loss = lambda f, w: self._loss(image_class_sums(f, w, images, num_images), members)[0]
+            err=check_pair_grad(loss,feats,weights,dfeats,dweights)
+            print "Testing Gradient MyPairwise",self.mode,err
             if err>1e-3:
-                dsfsd
-                print "Error in the gradient!"
+                raise Exception("Error in the gradient!")
 
 
 class HingeLossNorm(caffe.Layer):
@@ -680,18 +836,14 @@ class HingeLossNorm(caffe.Layer):
         if bottom[0].count != bottom[1].count:
             raise Exception("Inputs must have the same dimension.")
         # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
+        layer_buffer(self, 'diff', bottom[0].data.shape)
         # loss output is scalar
         top[0].reshape(1)
 
     def forward(self, bottom, top):
         #p = weights(bottom[0].data)
-        bottom[1].data[bottom[1].data[...]>0]=1 #restore to a binary measure
-        y = bottom[1].data*2-1
-        act = 1-bottom[0].data*y
-        self.diff=np.zeros(y.shape,dtype=np.float32)
-        self.diff[act>0] = - y[act>0] 
-        top[0].data[...] = np.sum(np.maximum(0,act))/bottom[0].channels# / bottom[0].num / 2.
+        loss = hinge(self, bottom[0].data, bottom[1].data)
+        top[0].data[...] = loss/bottom[0].channels# / bottom[0].num / 2.
         if 0:
             print "out",bottom[0].data.squeeze() 
             print "gt",bottom[1].data.squeeze()
@@ -711,7 +863,8 @@ class HingeLossNorm(caffe.Layer):
                 sign = 1
             else:
                 sign = -1
-            bottom[i].diff[...] = sign * self.diff/ bottom[i].channels
+            np.multiply(self.diff, sign/float(bottom[i].channels),
+                        out=bottom[i].diff.reshape(self.diff.shape))
 
 class SoftMaxLogLoss(caffe.Layer):
     """
@@ -730,14 +883,14 @@ class SoftMaxLogLoss(caffe.Layer):
         if bottom[0].count != bottom[1].count:
             raise Exception("Inputs must have the same dimension.")
         # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
+        layer_buffer(self, 'diff', bottom[0].data.shape)
         # loss output is scalar
         top[0].reshape(1)
 
     def forward(self, bottom, top):
         p = weights(bottom[0].data)
         y = bottom[1].data/np.sum(bottom[1].data)
-        self.diff[...] =  p - y
+        np.subtract(p, y, out=self.diff)
         top[0].data[...] = -np.sum(np.log(p)*y)
         if 0:
             print "out",bottom[0].data.squeeze() 
@@ -755,7 +908,7 @@ class SoftMaxLogLoss(caffe.Layer):
                 sign = 1
             else:
                 sign = -1
-            bottom[i].diff[...] = sign * self.diff #/ bottom[i].count
+            np.multiply(self.diff, sign, out=bottom[i].diff) #/ bottom[i].count
 
 class SoftMaxChanLogLoss(caffe.Layer):
     """
@@ -774,7 +927,7 @@ class SoftMaxChanLogLoss(caffe.Layer):
         if bottom[0].count != bottom[1].count:
             raise Exception("Inputs must have the same dimension.")
         # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
+        layer_buffer(self, 'diff', bottom[0].data.shape)
         # loss output is scalar
         top[0].reshape(1)
 
@@ -782,7 +935,8 @@ class SoftMaxChanLogLoss(caffe.Layer):
         p = weights(bottom[0].data,1)
         y = bottom[1].data/np.sum(bottom[1].data,1)
         num_pix = bottom[0].height*bottom[0].width
-        self.diff[...] =  (p - y)/(num_pix)
+        np.subtract(p, y, out=self.diff)
+        self.diff /= num_pix
         top[0].data[...] = -np.sum(np.log(p)*y)/num_pix
         if 0:
             print "out",np.abs(bottom[0].data[0]).sum(2).sum(1)
@@ -802,7 +956,7 @@ class SoftMaxChanLogLoss(caffe.Layer):
                 sign = 1
             else:
                 sign = -1
-            bottom[i].diff[...] = sign * self.diff #/ bottom[i].count
+            np.multiply(self.diff, sign, out=bottom[i].diff) #/ bottom[i].count
 
 
 class HingeChanLoss(caffe.Layer):
@@ -822,18 +976,14 @@ class HingeChanLoss(caffe.Layer):
         if bottom[0].count != bottom[1].count:
             raise Exception("Inputs must have the same dimension.")
         # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
+        layer_buffer(self, 'diff', bottom[0].data.shape)
         # loss output is scalar
         top[0].reshape(1)
 
     def forward(self, bottom, top):
-        bottom[1].data[bottom[1].data[...]>0]=1 #restore to a binary measure
-        y = bottom[1].data*2-1
-        act = 1-bottom[0].data*y
+        loss = hinge(self, bottom[0].data, bottom[1].data)
         num_pix = bottom[0].height*bottom[0].width
-        self.diff=np.zeros(y.shape,dtype=np.float32)/num_pix
-        self.diff[act>0] = - y[act>0] 
-        top[0].data[...] = np.sum(np.maximum(0,act))/num_pix# / bottom[0].num / 2.
+        top[0].data[...] = loss/num_pix# / bottom[0].num / 2.
         if 0:
             print "out",bottom[0].data.squeeze() 
             print "gt",bottom[1].data.squeeze()
@@ -851,7 +1001,7 @@ class HingeChanLoss(caffe.Layer):
                 sign = 1
             else:
                 sign = -1
-            bottom[i].diff[...] = sign * self.diff #/ bottom[i].count
+            np.multiply(self.diff, sign, out=bottom[i].diff) #/ bottom[i].count
 
 
 #class SoftMaxLogLoss(caffe.Layer):
@@ -915,14 +1065,14 @@ class SoftMaxLogCurrLoss(caffe.Layer):
         if bottom[0].count != bottom[1].count:
             raise Exception("Inputs must have the same dimension.")
         # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
+        layer_buffer(self, 'diff', bottom[0].data.shape)
         # loss output is scalar
         top[0].reshape(1)
         self.it+=1
 
     def forward(self, bottom, top):
         p = weights(bottom[0].data)
-        self.diff[...] =  p - bottom[1].data
+        np.subtract(p, bottom[1].data, out=self.diff)
         top[0].data[...] = -np.sum(np.log(p)*bottom[1].data)
         if 0:
             print "out",bottom[0].data.squeeze() 
@@ -953,4 +1103,4 @@ class SoftMaxLogCurrLoss(caffe.Layer):
                 sign = 1
             else:
                 sign = -1
-            bottom[i].diff[...] = sign * self.diff #/ bottom[i].count
+            np.multiply(self.diff, sign, out=bottom[i].diff) #/ bottom[i].count
@@ -12,12 +12,16 @@ RoIDataLayer implements a Caffe Python layer.
 
 #bottom[0]=(128,21,1,1) #classification scores
 #bottom[1]=(21) #image labels
-#for the moment I assume an image for each batch, but not a good assumption!!! 
+#several images per batch need the rois as an extra bottom (see roi_segments)
 
 import yaml
 import caffe
 import numpy as np
 from fast_rcnn.config import cfg
+from roi_data_layer.sum import roi_weights, roi_segments, segment_ids, \
+        layer_segments, pools_images, segment_sums, segment_softmax
+from utils.integral import integral_image, box_sums, box_scatter
+from utils.buffers import layer_buffer
 
 def softmax(x,axis=-1):
     #e_x = np.exp(x - np.max(x,axis=axis))
@@ -38,8 +42,7 @@ def betaweights(x,beta,axis=-1):
     #print e_x
     ssum=e_x.sum(axis=axis,keepdims=True)
     out = e_x / ssum
-    entr = np.sum(e_x*x,axis=axis,keepdims=True)
-    return out,ssum,entr
+    return out,ssum
 
 #def betaweights2(x,beta,axis=-1):
 #    e_x = (x - np.max(x,axis=axis,keepdims=True))**beta
@@ -57,6 +60,129 @@ def betaweights2(x,beta,axis=-1):
     #entr = np.sum(e_x*x,axis=axis,keepdims=True)
     return out
 
+# float32 elements of one batch of padded crops (classes x boxes x crop) in
+# the softmax mode of ScoreSegmBoxesLayer
+SEGM_CROP_ELEMENTS = 1 << 22
+
+# boxes whose softmax normalizer is below this fraction of the normalizer of
+# the whole map lose too many digits in the summed-area tables and are
+# computed on their crops instead
+SEGM_SAT_MIN = 1e-8
+
+def _crop_bucket(n):
+    """Smallest of 1, 2, 3, 4, 6, 8, 12, 16, ... not below n: crops are padded
+    to these sizes, by at most 50% per side.
+    """
+    b = 2**np.floor(np.log2(n)).astype(np.int)
+    return np.where(n<=b, b, np.where(2*n<=3*b, 3*b//2, 2*b))
+
+def segm_crops(boxes, valid, shape, num_classes):
+    """Batches of the valid boxes whose padded crops fit in
+    SEGM_CROP_ELEMENTS. Yields the indices of the boxes, the flat B x h x w
+    pixel indices of their crops into an H x W map and the mask of the pixels
+    of each crop that are inside its box.
+    """
+    h, w = shape
+    bh = boxes[:,3]-boxes[:,1]+1
+    bw = boxes[:,2]-boxes[:,0]+1
+    ch = _crop_bucket(bh)
+    cw = _crop_bucket(bw)
+    keys = ch*(w+w)+cw
+    for key in np.unique(keys[valid]):
+        inds = np.where(valid & (keys==key))[0]
+        ph = ch[inds[0]]
+        pw = cw[inds[0]]
+        per_batch = max(1, SEGM_CROP_ELEMENTS//(num_classes*ph*pw))
+        dy = np.arange(ph)
+        dx = np.arange(pw)
+        for start in xrange(0, len(inds), per_batch):
+            sel = inds[start:start+per_batch]
+            mask = (dy[np.newaxis,:,np.newaxis]<bh[sel,np.newaxis,np.newaxis]) & \
+                   (dx[np.newaxis,np.newaxis,:]<bw[sel,np.newaxis,np.newaxis])
+            # padding pixels read (masked) pixels of the map inside the crop
+            ys = np.minimum(boxes[sel,1,np.newaxis]+dy, h-1)
+            xs = np.minimum(boxes[sel,0,np.newaxis]+dx, w-1)
+            yield sel, ys[:,:,np.newaxis]*w+xs[:,np.newaxis,:], mask
+
+def segm_softmax(segm, logits, pix, mask, beta):
+    """Scores and beta-softmax weights (betaweights2 over the pixels of each
+    box, per class) of a batch of crops, C x B x h x w in float32.
+    """
+    num_classes = segm.shape[0]
+    scores = segm.reshape(num_classes,-1)[:,pix]
+    x = logits.reshape(num_classes,-1)[:,pix]
+    x -= np.where(mask, x, -np.inf).max(axis=3,keepdims=True).max(axis=2,keepdims=True)
+    x[:,~mask] = 0
+    prob = np.exp(x*np.float32(np.log(beta)), out=x)
+    prob[:,~mask] = 0
+    prob /= prob.sum(axis=3,keepdims=True).sum(axis=2,keepdims=True)
+    return scores, prob
+
+def scatter_crops(values, pix, mask, shape):
+    """C x H x W map with the sum of the C x B x h x w crop values at their
+    pixels (the adjoint of gathering the crops).
+    """
+    num_classes = values.shape[0]
+    size = shape[0]*shape[1]
+    index = pix[mask][np.newaxis,:]+size*np.arange(num_classes)[:,np.newaxis]
+    out = np.bincount(index.ravel(), weights=values[:,mask].ravel(),
+                      minlength=num_classes*size)
+    return out.reshape((num_classes,)+shape)
+
+def _softmax_sums(segm, logits, boxes, valid, beta):
+    """The beta-softmax weights of the pixels of a box are e = beta**logits
+    up to a factor, normalized over the box, so the score of a box is the box
+    sum of segm*e over the box sum z of e, from summed-area tables. e is
+    shifted by the maximum of each class over the whole map.
+
+    Returns e, z, the scores and the valid boxes that need their crop
+    instead, because their z is tiny w.r.t. the whole map.
+    """
+    x = np.log(beta)*logits.astype(np.float64)
+    e = np.exp(x-x.max(axis=2,keepdims=True).max(axis=1,keepdims=True))
+    z = box_sums(integral_image(e), boxes)
+    num = box_sums(integral_image(e*segm), boxes)
+    crop = valid & np.any(z<SEGM_SAT_MIN*e.sum(axis=2).sum(axis=1), axis=1)
+    z = np.maximum(z, np.finfo(np.float64).tiny)
+    return e, z, num/z, crop
+
+def segm_softmax_scores(segm, logits, boxes, valid, beta):
+    """B x C scores of the softmax mode of ScoreSegmBoxesLayer (before mul):
+    the C x H x W segmentation averaged over each of the B boxes (inclusive
+    feature map coordinates) with the beta-softmax weights of the logits
+    inside the box, -inf for the boxes that are not valid.
+    """
+    h, w = segm.shape[1:]
+    e, z, scores, crop = _softmax_sums(segm, logits, boxes, valid, beta)
+    scores[~valid] = -np.inf
+    for sel, pix, mask in segm_crops(boxes, crop, (h,w), segm.shape[0]):
+        crop_scores, prob = segm_softmax(segm, logits, pix, mask, beta)
+        scores[sel] = (crop_scores*prob).sum(3).sum(2).T
+    return scores
+
+def segm_softmax_diff(segm, logits, boxes, valid, beta, grad):
+    """Gradients w.r.t. segm and logits of segm_softmax_scores, for the B x C
+    gradient grad of the scores. Everything is recomputed from the inputs,
+    nothing is kept from the forward pass.
+    """
+    h, w = segm.shape[1:]
+    e, z, scores, crop = _softmax_sums(segm, logits, boxes, valid, beta)
+    table_grad = np.where((valid&~crop)[:,np.newaxis], grad, 0)/z
+    u = box_scatter(table_grad, boxes, (h,w))
+    v = box_scatter(table_grad*scores, boxes, (h,w))
+    dsegm = e*u
+    dlogits = np.log(beta)*e*(segm*u-v)
+    log_beta = np.float32(np.log(beta))
+    for sel, pix, mask in segm_crops(boxes, crop, (h,w), segm.shape[0]):
+        crop_scores, prob = segm_softmax(segm, logits, pix, mask, beta)
+        crop_grad = grad[sel].T[:,:,np.newaxis,np.newaxis]
+        dsegm += scatter_crops(prob*crop_grad, pix, mask, (h,w))
+        diff = crop_grad*crop_scores
+        # the weights of a box are normalized over its pixels
+        aux = log_beta*prob*(diff-(diff*prob).sum(3,keepdims=True).sum(2,keepdims=True))
+        dlogits += scatter_crops(aux, pix, mask, (h,w))
+    return dsegm, dlogits
+
 class ScoreSegmBoxesLayer(caffe.Layer):
     """
     Compute multiclass Hinge Loss 
@@ -92,110 +218,183 @@ class ScoreSegmBoxesLayer(caffe.Layer):
         # check input dimensions match
         if bottom[0].count != bottom[1].count:
             raise Exception("Score and proposals should have the same num")
-        # difference is shape of inputs
-        self.diff = np.zeros_like(bottom[0].data, dtype=np.float32)
-        # loss output is scalar
         top[0].reshape(self.num_proposals,self.num_classes)
         #sdfsd
 
-    def forward(self, bottom, top):
-        #self.num_proposals = bottom[2].data.shape[0]
-        #self.num_classes = bottom[2].data.shape[1]
-        #top[0].reshape(self.num_proposals,self.num_classes)
+    def _boxes(self, bottom):
+        """Feature map boxes of the proposals, clipped to the map like the
+        slices of the per-box loop, and which of them are not empty.
+        """
         h=bottom[0].data.shape[2]
         w=bottom[0].data.shape[3]
         fbox = np.round(bottom[2].data[:,1:]*self.spatial_scale).astype(np.int)
-        #fbox=fbox.clip([0,0,0,0],[w,h,w,h])
-        self.fbox = fbox
-        self.pix_scores = []
-        self.pix_prob = []
-        #for each box
+        wb=fbox[:,2]-fbox[:,0]
+        hb=fbox[:,3]-fbox[:,1]
+        assert(np.all(wb<=w) and np.all(hb<=h))
+        valid = (hb!=0) & (wb!=0)
+        boxes = np.minimum(fbox, [w-1,h-1,w-1,h-1])
+        return fbox, boxes, valid
+
+    def _linear_scores(self, segm, boxes):
+        """Box scores of the mean, sum and mean-neg modes, which are linear
+        in the segmentation, from summed-area tables (see utils.integral).
+
+        mean-neg scores twice the mean inside the box minus the mean of the
+        one pixel ring around it, with the map padded with -1.
+
+        Returns the scores and the weights that box_scatter needs for their
+        gradient: one (boxes, weights) pair per region.
+        """
+        area = ((boxes[:,2]-boxes[:,0]+1)*(boxes[:,3]-boxes[:,1]+1)).astype(np.float64)
+        inner = box_sums(integral_image(segm), boxes)
+        if self.mode=='sum':
+            return inner, [(boxes, 1.)]
+        if self.mode=='mean':
+            return inner/area[:,np.newaxis], [(boxes, 1./area[:,np.newaxis])]
+        # mean-neg: the outer box in the coordinates of the padded map
+        padb = -1*np.ones((segm.shape[0],segm.shape[1]+2,segm.shape[2]+2),dtype=segm.dtype)
+        padb[:,1:-1,1:-1]=segm
+        outer_boxes = boxes+[0,0,2,2]
+        outer = box_sums(integral_image(padb), outer_boxes)
+        ring = (2*(boxes[:,3]-boxes[:,1]+2)+2*(boxes[:,2]-boxes[:,0]+2)).astype(np.float64)
+        scores = 2*inner/area[:,np.newaxis] - (outer-inner)/ring[:,np.newaxis]
+        return scores, [(boxes, (2./area+1./ring)[:,np.newaxis]),
+                        (outer_boxes, -1./ring[:,np.newaxis])]
+
+    def _linear_diff(self, regions, grad, shape):
+        """Gradient w.r.t. the segmentation of the linear modes, for the
+        gradient grad (boxes x classes) of the box scores.
+        """
+        h, w = shape
         if self.mode=='mean-neg':
-            #padding
-            padb = -1*np.ones((bottom[0].data.shape[1],h+2,w+2),dtype=bottom[0].data.dtype)
-            padb[:,1:-1,1:-1]=bottom[0].data[0]
-        for b in np.arange(self.num_proposals):
-            #for the moment assume only 1 image per batch            
-            wb=fbox[b,2]-fbox[b,0]
-            hb=fbox[b,3]-fbox[b,1]
-            assert(wb<=w and hb<=h)
-            if hb==0 or wb==0:
-                top[0].data[b] = -np.inf
-                self.pix_scores.append(None)
-                self.pix_prob.append(None)
-            else:
-                pix_scores = bottom[0].data[0,:,fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1]
-                if self.mode=='softmax':
-                    pix_prob = betaweights2((bottom[1].data[0,:,fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1]).reshape((self.num_classes,-1)),self.beta,1).reshape((self.num_classes,hb+1,wb+1))
-                elif self.mode=='mean':
-                    pix_prob = np.ones((self.num_classes,hb+1,wb+1))/((hb+1)*(wb+1))#bottom[1].data[0,:,fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1]
-                elif self.mode=='mean-neg':
-                    pix_scores = -padb[:,fbox[b,1]:fbox[b,3]+3,fbox[b,0]:fbox[b,2]+3]
-                    pix_scores[:,1:-1,1:-1] = 2*padb[:,fbox[b,1]+1:fbox[b,3]+2,fbox[b,0]+1:fbox[b,2]+2]
-                    pix_prob = np.ones((self.num_classes,hb+3,wb+3))/float(2*(hb+2)+2*(wb+2))
-                    pix_prob[:,1:-1,1:-1] = 1/float((hb+1)*(wb+1))
-                    #note: backward not implemented
-                elif self.mode=='sum':
-                    pix_prob = np.ones((self.num_classes,hb+1,wb+1))#bottom[1].data[0,:,fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1]
-                self.pix_scores.append(pix_scores)
-                self.pix_prob.append(pix_prob)
-                top[0].data[b] = (pix_scores*pix_prob).sum(2).sum(1)*self.mul
-                if np.any(np.isnan(pix_scores)) or np.any(np.isnan(pix_prob)) or np.any(np.isnan(top[0].data[b])):
-                    errorfsd
-                if 0:
-                    print "box",b,"score",top[0].data[b]
+            (boxes, inner_w), (outer_boxes, outer_w) = regions
+            diff = box_scatter(grad*outer_w, outer_boxes, (h+2,w+2))[:,1:-1,1:-1]
+            return diff + box_scatter(grad*inner_w, boxes, (h,w))
+        boxes, weights = regions[0]
+        return box_scatter(grad*weights, boxes, (h,w))
+
+    def forward(self, bottom, top):
+        #self.num_proposals = bottom[2].data.shape[0]
+        #self.num_classes = bottom[2].data.shape[1]
+        #top[0].reshape(self.num_proposals,self.num_classes)
+        fbox, boxes, valid = self._boxes(bottom)
+        self.valid = valid
+        if self.mode in ('mean','sum','mean-neg'):
+            scores, self.regions = self._linear_scores(bottom[0].data[0], boxes)
+            top[0].data[...] = scores*self.mul
+            top[0].data[~valid] = -np.inf
+            if np.any(np.isnan(top[0].data)):
+                raise Exception("NaN box scores in ScoreSegmBoxesLayer")
+            return
+        # softmax: from summed-area tables, and the few boxes they cannot
+        # resolve from padded crops, all recomputed in backward
+        top[0].data[...] = segm_softmax_scores(bottom[0].data[0], bottom[1].data[0],
+                                               boxes, valid, self.beta)*self.mul
+        top[0].data[~valid] = -np.inf
+        if np.any(np.isnan(top[0].data)):
+            raise Exception("NaN box scores in ScoreSegmBoxesLayer")
+        self.boxes = boxes
         #raw_input()
 
+    def _check_linear_grad(self, bottom, top, epsilon=1e-2, num_checks=20):
+        """Compare the gradient of the linear modes with finite differences
+        of the box scores on random pixels of the segmentation.
+        """
+        segm = bottom[0].data[0].astype(np.float64)
+        fbox, boxes, valid = self._boxes(bottom)
+        grad = np.where(valid[:,np.newaxis], top[0].diff, 0)
+        err = 0.
+        for _ in xrange(num_checks):
+            c, y, x = [np.random.randint(n) for n in segm.shape]
+            segm[c,y,x] += epsilon
+            fp = (self._linear_scores(segm, boxes)[0]*grad).sum()
+            segm[c,y,x] -= 2*epsilon
+            fn = (self._linear_scores(segm, boxes)[0]*grad).sum()
+            segm[c,y,x] += epsilon
+            num_diff = (fp-fn)/(2*epsilon)*self.mul
+            err += (num_diff-bottom[0].diff[0,c,y,x])**2
+        return err
 
     def backward(self, top, propagate_down, bottom):
         h=bottom[0].data.shape[2]
         w=bottom[0].data.shape[3]
         #num_proposals = bottom[1].data.shape[0]
-        fbox = self.fbox
         bottom[0].diff[...] = 0
         bottom[1].diff[...] = 0
-        for b in np.arange(self.num_proposals):
-            wb=fbox[b,2]-fbox[b,0]
-            hb=fbox[b,3]-fbox[b,1]
-            assert(wb<=w and hb<=h)
-            if hb==0 or wb==0 or np.any(top[0].data[b]==-np.inf):
-                continue
-            else:                
-                bottom[0].diff[0,:,fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1] += self.pix_prob[b]*top[0].diff[b][:,np.newaxis,np.newaxis]*self.mul#bottom[1].data[0,:,fbox[b,0]:fbox[b,2]+1,fbox[b,1]:fbox[b,3]+1]*top[0].diff[b]
-                if self.mode=='softmax':                    
-                    diff = top[0].diff[b][:,np.newaxis,np.newaxis] * self.pix_scores[b]
-                    aux = np.log(self.beta)*self.pix_prob[b] * (diff-(diff*self.pix_prob[b]).sum(0,keepdims=True))
-                    bottom[1].diff[0,:,fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1] += aux*self.mul
-                else:
-                    pass
-                    #bottom[1].diff[0,:,fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1] += self.pix_scores[b]*top[0].diff[b][:,np.newaxis,np.newaxis]
-                #bottom[1].diff[0,:,fbox[b,1]:fbox[b,3]+1,fbox[b,0]:fbox[b,2]+1] = self.pix_scores[b]*np.log(self.beta)*self.pix_prob[b] * (top[0].diff[b][:,np.newaxis,np.newaxis]-(top[0].diff[b][:,np.newaxis,np.newaxis]*self.pix_prob[b]).sum(0,keepdims=True))
-        #np.log(self.beta)*top[0].data * (top[0].diff-(top[0].diff*top[0].data).sum(0,keepdims=True))
-                if np.any(np.isnan(bottom[0].diff)) or np.any(np.isnan(bottom[1].diff)):
-                    errorfsd
-        if 0:
-            print "diff1",bottom[0].diff[0,1].squeeze() 
-            print "diff2",bottom[1].diff[0,1].squeeze()
-            print "topdiff",top[0].diff[0,1].squeeze()
-            #rsdffsd
+        if self.mode in ('mean','sum','mean-neg'):
+            grad = np.where(self.valid[:,np.newaxis], top[0].diff, 0)*self.mul
+            bottom[0].diff[0] = self._linear_diff(self.regions, grad, (h,w))
+            if np.any(np.isnan(bottom[0].diff)):
+                raise Exception("NaN gradient in ScoreSegmBoxesLayer")
+            if cfg.TRAIN.CHECK_GRAD:
+                err = self._check_linear_grad(bottom, top)
+                print "Testing Gradient ScoreSegmBoxes",self.mode,err
+                if err>1e-3:
+                    raise Exception("Error in the gradient!")
+            return
+        bottom[0].diff[0], bottom[1].diff[0] = segm_softmax_diff(
+            bottom[0].data[0], bottom[1].data[0], self.boxes, self.valid,
+            self.beta, top[0].diff*self.mul)
+        if np.any(np.isnan(bottom[0].diff)) or np.any(np.isnan(bottom[1].diff)):
+            raise Exception("NaN gradient in ScoreSegmBoxesLayer")
+        if cfg.TRAIN.CHECK_GRAD:
+            err = self._check_softmax_grad(bottom, top)
+            print "Testing Gradient ScoreSegmBoxes",self.mode,err
+            if err>1e-3:
+                raise Exception("Error in the gradient!")
+
+    def _check_softmax_grad(self, bottom, top, epsilon=1e-2, num_checks=20):
+        """Compare the gradient of the softmax mode w.r.t. both segmentations
+        with finite differences on random pixels.
+        """
+        h, w = bottom[0].data.shape[2:]
+        maps = [bottom[0].data[0].astype(np.float64),
+                bottom[1].data[0].astype(np.float64)]
+        grad = np.where(self.valid[:,np.newaxis], top[0].diff, 0)
+        def loss():
+            total = 0.
+            for sel, pix, mask in segm_crops(self.boxes, self.valid, (h,w), self.num_classes):
+                scores = maps[0].reshape(self.num_classes,-1)[:,pix]
+                x = maps[1].reshape(self.num_classes,-1)[:,pix]
+                prob = np.where(mask, self.beta**(x-x.max()), 0)
+                prob /= prob.sum(axis=3,keepdims=True).sum(axis=2,keepdims=True)
+                total += ((scores*prob).sum(3).sum(2)*grad[sel].T).sum()
+            return total*self.mul
+        err = 0.
+        for _ in xrange(num_checks):
+            k = np.random.randint(2)
+            c, y, x = [np.random.randint(n) for n in maps[k].shape]
+            maps[k][c,y,x] += epsilon
+            fp = loss()
+            maps[k][c,y,x] -= 2*epsilon
+            fn = loss()
+            maps[k][c,y,x] += epsilon
+            num_diff = (fp-fn)/(2*epsilon)
+            err += (num_diff-bottom[k].diff[0,c,y,x])**2
+        return err
 
-    
 class MySoftMaxLayer(caffe.Layer):
 
     def setup(self, bottom, top):
-        # check input pair
-        if len(bottom) != 1:
-            raise Exception("Only one input needed.")
+        # check input pair (the other bottoms are optional rois and RoI
+        # weights)
+        if len(bottom) not in (1, 2, 3):
+            raise Exception("One input (plus optional rois and RoI weights) needed.")
+        pools_images(self, bottom)
 
     def reshape(self, bottom, top):
-        top[0].reshape(1, bottom[0].channels,
+        top[0].reshape(len(roi_segments(bottom, self)), bottom[0].channels,
                 bottom[0].height, bottom[0].width)
         
     def forward(self, bottom, top):
-        #softmax in dimension 0 
-        max_cls = softmax(bottom[0].data,axis=0)
-        top[0].data[0,:,0,0] = max_cls
-        self.weights = weights(bottom[0].data,axis=0)
+        #softmax over the RoIs of each image
+        x = bottom[0].data.reshape(bottom[0].num,-1)
+        # a RoI standing for w copies adds w*exp(x) to the sum
+        w = roi_weights(bottom)
+        self.starts, self.ids = layer_segments(self, bottom)
+        _, max_cls = segment_softmax(x, self.starts, 1., w,
+                out=layer_buffer(self, 'weights', x.shape))
+        top[0].data.reshape(len(self.starts),-1)[...] = max_cls
         if 0:
             import pylab
             pylab.figure(1)
@@ -208,7 +407,10 @@ class MySoftMaxLayer(caffe.Layer):
      
     def backward(self, top, propagate_down, bottom):
         if propagate_down[0]:
-            bottom[0].diff[...] = top[0].diff.squeeze()*self.weights
+            diff = bottom[0].diff.reshape(bottom[0].num,-1)
+            np.take(top[0].diff.reshape(len(self.starts),-1),self.ids,axis=0,
+                    out=diff,mode='clip')
+            diff *= self.weights
 
 class MyDummyLayer(caffe.Layer):
     #used to not vbisualize milions of outputs...
@@ -306,23 +508,41 @@ class MyArgMaxLayer(caffe.Layer):
     def backward(self, top, propagate_down, bottom):
         pass
 
+def label_layer_classes(layer, default):
+    """num_classes of the param_str of the label layers, or default."""
+    layer_params = yaml.load(layer.param_str_) if layer.param_str_ else None
+    if layer_params!=None and layer_params.has_key('num_classes'):
+        return layer_params['num_classes']
+    return default
+
 class SparseInputLayer(caffe.Layer):
-    #used to not vbisualize milions of outputs...
+    """Image labels (N x C, non zero for the classes present) as the sorted
+    list of their classes, padded with -1.
+    """
 
     def setup(self, bottom, top):
         # check input pair
         self.it = 0
         if len(bottom) != 1:
             raise Exception("Only one input needed.")
+        self.num_classes = label_layer_classes(self, bottom[0].channels)
+        if bottom[0].channels != self.num_classes:
+            raise Exception("The labels should have num_classes channels.")
 
     def reshape(self, bottom, top):
         #bottom[0].data.argmax(1)[np.newaxis]
         top[0].reshape(bottom[0].num,bottom[0].channels,bottom[0].height,bottom[0].width)
         
     def forward(self, bottom, top):
-        top[0].data[...]=-1
-        cls = np.arange(bottom[0].channels)[bottom[0].data.squeeze()!=0]
-        top[0].data[0,:len(cls),0,0]=cls
+        # absent classes sort after all the present ones, then become -1
+        key = layer_buffer(self, 'key', (bottom[0].num, self.num_classes), np.int)
+        key[...] = self.num_classes
+        np.copyto(key, np.arange(self.num_classes),
+                  where=bottom[0].data.reshape(key.shape)!=0)
+        key.sort(axis=1)
+        out = top[0].data.reshape(key.shape)
+        np.copyto(out, key)
+        out[key==self.num_classes] = -1
         if 0:
             print "Sparse input:",top[0].data.squeeze()
 
@@ -330,23 +550,25 @@ class SparseInputLayer(caffe.Layer):
         pass
 
 class DenseInputLayer(caffe.Layer):
-    #used to not vbisualize milions of outputs...
+    """N x 1 x H x W map of class indices as a one-hot N x num_classes x H x W
+    map (indices out of range, like 255 for void, get no class).
+    """
 
     def setup(self, bottom, top):
         # check input pair
         self.it = 0
         if len(bottom) != 1:
             raise Exception("Only one input needed.")
+        self.num_classes = label_layer_classes(self, 21)
+        self.classes = np.arange(self.num_classes,
+                                 dtype=np.float32)[:,np.newaxis,np.newaxis]
 
     def reshape(self, bottom, top):
         #bottom[0].data.argmax(1)[np.newaxis]
-        top[0].reshape(bottom[0].num,21,bottom[0].height,bottom[0].width)
+        top[0].reshape(bottom[0].num,self.num_classes,bottom[0].height,bottom[0].width)
         
     def forward(self, bottom, top):
-        top[0].data[...]=0
-        for c in range(21):
-            aux = (bottom[0].data[0,0]==c)
-            top[0].data[0,c,aux]=1
+        np.equal(bottom[0].data, self.classes, out=top[0].data)
         if 0:
             print "Dense input:",top[0].data.squeeze()
 
@@ -354,26 +576,32 @@ class DenseInputLayer(caffe.Layer):
         pass
 
 class ConstrainedLayer(caffe.Layer):
-    #used to not vbisualize milions of outputs...
+    """Scores (bottom[0]) of the classes listed in the sparse labels of each
+    image (bottom[1], as given by SparseInputLayer), -inf for the others.
+    """
 
     def setup(self, bottom, top):
         # check input pair
         self.it = 0
         if len(bottom) != 2:
-            raise Exception("Only one input needed.")
+            raise Exception("Scores and sparse labels needed.")
+        self.num_classes = label_layer_classes(self, bottom[0].channels)
+        if bottom[0].channels != self.num_classes:
+            raise Exception("The scores should have num_classes channels.")
 
     def reshape(self, bottom, top):
         #bottom[0].data.argmax(1)[np.newaxis]
         top[0].reshape(bottom[0].num,bottom[0].channels,bottom[0].height,bottom[0].width)
         
     def forward(self, bottom, top):
-        top[0].data[...]=-np.inf#bottom[0].data
-        for c in range(bottom[1].channels):
-            if bottom[1].data[0,c]==-1:
-                continue
-            else:
-                lab=int(bottom[1].data[0,c,0,0])
-                top[0].data[0,lab]=bottom[0].data[0,lab]
+        keep = layer_buffer(self, 'keep', (bottom[0].num, self.num_classes), np.bool)
+        keep[...] = False
+        labels = bottom[1].data.reshape(bottom[1].num,-1)[:bottom[0].num]
+        images, slots = np.nonzero(labels!=-1)
+        keep[images, labels[images, slots].astype(np.int)] = True
+        keep = keep.reshape(keep.shape+(1,)*(bottom[0].data.ndim-2))
+        np.copyto(top[0].data, bottom[0].data, where=keep)
+        np.copyto(top[0].data, -np.inf, where=~keep)
         if 0:
             print "Dense input:",top[0].data.squeeze()
 
@@ -436,18 +664,25 @@ class MyExpConvLayer(caffe.Layer):
 class MyMaxLayer(caffe.Layer):
 
     def setup(self, bottom, top):
-        # check input pair
-        if len(bottom) != 1:
-            raise Exception("Only one input needed.")
+        # check input pair (the other bottom are optional rois)
+        if len(bottom) not in (1, 2):
+            raise Exception("One input (plus optional rois) needed.")
+        pools_images(self, bottom)
 
     def reshape(self, bottom, top):
-        top[0].reshape(1, bottom[0].channels,
+        top[0].reshape(len(roi_segments(bottom)), bottom[0].channels,
                 bottom[0].height, bottom[0].width)
         
     def forward(self, bottom, top):
-        #softmax in dimension 0 
-        top[0].data[0,:,0,0] = bottom[0].data.max(0)
-        self.argmax = bottom[0].data.argmax(0)
+        #max over the RoIs of each image
+        x = bottom[0].data.reshape(bottom[0].num,-1)
+        self.starts = roi_segments(bottom)
+        ids = segment_ids(self.starts, bottom[0].num)
+        max_cls = np.maximum.reduceat(x,self.starts,axis=0)
+        top[0].data.reshape(len(self.starts),-1)[...] = max_cls
+        # first RoI of each image that reaches the max, as argmax
+        rank = np.arange(x.shape[0],0,-1)[:,np.newaxis]*(x==max_cls[ids])
+        self.argmax = x.shape[0]-np.maximum.reduceat(rank,self.starts,axis=0)
         if 0:
             import pylab
             pylab.figure(1)
@@ -461,7 +696,9 @@ class MyMaxLayer(caffe.Layer):
 
     def backward(self, top, propagate_down, bottom):
         #for idcl,cl in enumerate(self.argmax):
-        bottom[0].diff[self.argmax,np.arange(self.argmax.shape[0])] = top[0].diff.squeeze()
+        diff = bottom[0].diff.reshape(bottom[0].num,-1)
+        diff[...] = 0
+        diff[self.argmax,np.arange(self.argmax.shape[1])] = top[0].diff.reshape(len(self.starts),-1)
         
                 
 #softmax as normalized exp
@@ -481,8 +718,10 @@ class ExpSoftMaxLayer(caffe.Layer):
         #        bottom[0].data.shape[2], bottom[0].data.shape[3])
         self.it=0
         #top[0].reshape(1, 21)
-        if len(bottom) != 1:
-            raise Exception("Only one input needed.")
+        # the other bottoms are optional rois and RoI weights
+        if len(bottom) not in (1, 2, 3):
+            raise Exception("One input (plus optional rois and RoI weights) needed.")
+        pools_images(self, bottom)
 
     def reshape(self, bottom, top):
     #    pass
@@ -512,8 +751,15 @@ class ExpSoftMaxLayer(caffe.Layer):
         #top[0].data[...] = np.sum(self.diff**2) / bottom[0].num / 2.
         self.it+=1
         #beta=10
-        p,ssum,entr = betaweights(bottom[0].data,self.beta,axis=0)
-        top[0].data[...] = p
+        # weights normalized over the RoIs of each image
+        x = bottom[0].data.reshape(bottom[0].num,-1)
+        w = roi_weights(bottom)
+        self.starts, self.ids = layer_segments(self, bottom)
+        # normalize by sum_s w_s*exp(beta*x_s), the sum over all copies
+        p, _ = segment_softmax(x, self.starts, self.beta, w,
+                               out=top[0].data.reshape(x.shape))
+        if w is not None:
+            p /= w.reshape(-1,1)
         #self.jacob = np.dot(p.T,p)
         #self.jacob = self.beta*(np.diag(p)-np.dot(p,p.T))/bottom[0].num
         #self.db = p/ssum*(bottom[0].data-)
@@ -534,7 +780,28 @@ class ExpSoftMaxLayer(caffe.Layer):
     def backward(self, top, propagate_down, bottom):
         #for l in range(21):
         #    bottom[0].diff[:,l] = top[0].data[:,l] * (top[0].diff[:,l]-np.dot(top[0].diff[:,l],top[0].data[:,l]))
-        bottom[0].diff[...] = self.beta*top[0].data * (top[0].diff-(top[0].diff*top[0].data).sum(0,keepdims=True))/bottom[0].num
+        # per image: N counts the RoIs of the image
+        p = top[0].data.reshape(bottom[0].num,-1)
+        d = top[0].diff.reshape(p.shape)
+        diff = bottom[0].diff.reshape(p.shape)
+        np.multiply(d, p, out=diff)
+        dp = layer_buffer(self, 'dp', p.shape)
+        np.take(segment_sums(diff, self.starts), self.ids, axis=0, out=dp,
+                mode='clip')
+        w = roi_weights(bottom)
+        if w is None:
+            n = np.diff(np.append(self.starts, bottom[0].num))
+        else:
+            # sum of the gradients of the copies, N counts all copies
+            w = w.reshape(-1,1)
+            dp *= w
+            n = np.add.reduceat(w.ravel(),self.starts)
+        np.subtract(d, dp, out=diff)
+        diff *= p
+        scale = layer_buffer(self, 'roi_scale', (p.shape[0], 1))
+        np.take((self.beta/n.astype(p.dtype)).reshape(-1,1), self.ids,
+                axis=0, out=scale, mode='clip')
+        diff *= scale
         #bottom[0].diff[...] = top[0].diff#np.dot(top[0].diff,top[0].data)
         #np.dot(top[0].diff,top[0].data)
         #if propagate_down[0]:
@@ -557,14 +824,17 @@ class BetaSoftMaxLayer(caffe.Layer):
         self.it=0
         if len(bottom) != 1:
             raise Exception("Only one input needed.")
+        pools_images(self, bottom)
 
     def reshape(self, bottom, top):
         top[0].reshape(bottom[0].num, bottom[0].channels)
 
     def forward(self, bottom, top):
         self.it+=1
-        p = betaweights2(bottom[0].data,self.beta,axis=0)
-        top[0].data[...] = p
+        # betaweights2 over axis 0: the whole batch is one segment
+        x = bottom[0].data.reshape(bottom[0].num,-1)
+        segment_softmax(x, np.zeros(1, dtype=np.int), np.log(self.beta),
+                        out=top[0].data.reshape(x.shape))
         if 0:
             import pylab
             pylab.figure(1)
@@ -579,6 +849,83 @@ class BetaSoftMaxLayer(caffe.Layer):
         #print "Size",bottom[0].num
         bottom[0].diff[...] = np.log(self.beta)*top[0].data * (top[0].diff-(top[0].diff*top[0].data).sum(0,keepdims=True))#/bottom[0].num
 
+class ExpSoftMaxSumLayer(caffe.Layer):
+    """ExpSoftMaxLayer (mode 'exp') or BetaSoftMaxLayer (mode 'beta'), the
+    elementwise product with the scores and MySumLayer in one layer: the
+    score of every image and class is sum_r q_r*x_r, with q the softmax of
+    s*x over the RoIs of the image (s = beta, or log(beta) in mode 'beta').
+
+    Takes the same optional rois and roi_weights bottoms as MySumLayer. The
+    softmax is computed in the log domain and only q is kept for the
+    backward pass, which gives the gradient of the three layers, including
+    the 1/N of the ExpSoftMaxLayer gradient.
+    """
+
+    def setup(self, bottom, top):
+        layer_params = yaml.load(self.param_str_) if self.param_str_ else {}
+        if layer_params is None:
+            layer_params = {}
+        if cfg.TRAIN.BETA==-1:
+            self.beta = layer_params['beta']
+        else:
+            self.beta = cfg.TRAIN.BETA
+        self.mode = layer_params.get('mode', 'exp')
+        if self.mode == 'exp':
+            self.scale = self.beta
+        elif self.mode == 'beta':
+            self.scale = np.log(self.beta)
+        else:
+            raise Exception("Unknown mode {}".format(self.mode))
+        print "Beta",self.beta,self.mode
+        # the other bottoms are optional rois and RoI weights
+        if len(bottom) not in (1, 2, 3):
+            raise Exception("One input (plus optional rois and RoI weights) needed.")
+        pools_images(self, bottom)
+
+    def reshape(self, bottom, top):
+        top[0].reshape(len(roi_segments(bottom, self)), bottom[0].channels,
+                bottom[0].height, bottom[0].width)
+
+    def forward(self, bottom, top):
+        x = bottom[0].data.reshape(bottom[0].num,-1)
+        self.starts, self.ids = layer_segments(self, bottom)
+        # each copy of a RoI counts in the normalizer
+        q, _ = segment_softmax(x, self.starts, self.scale, roi_weights(bottom),
+                               out=layer_buffer(self, 'q', x.shape))
+        qx = layer_buffer(self, 'qx', x.shape)
+        np.multiply(q, x, out=qx)
+        segment_sums(qx, self.starts,
+                     out=top[0].data.reshape(len(self.starts),-1))
+
+    def backward(self, top, propagate_down, bottom):
+        if not propagate_down[0]:
+            return
+        x = bottom[0].data.reshape(bottom[0].num,-1)
+        diff = bottom[0].diff.reshape(x.shape)
+        # x - the score of the image of every RoI
+        np.take(top[0].data.reshape(len(self.starts),-1), self.ids, axis=0,
+                out=diff, mode='clip')
+        np.subtract(x, diff, out=diff)
+        if self.mode == 'exp':
+            # ExpSoftMaxLayer divides its gradient by the RoIs of the image
+            w = roi_weights(bottom)
+            if w is None:
+                n = np.diff(np.append(self.starts, bottom[0].num))
+            else:
+                n = np.add.reduceat(w.reshape(-1),self.starts)
+            scale = layer_buffer(self, 'roi_scale', (x.shape[0], 1))
+            np.take((self.scale/n.astype(x.dtype)).reshape(-1,1), self.ids,
+                    axis=0, out=scale, mode='clip')
+            diff *= scale
+        else:
+            diff *= self.scale
+        diff += 1
+        diff *= self.q
+        g = layer_buffer(self, 'g', x.shape)
+        np.take(top[0].diff.reshape(len(self.starts),-1), self.ids, axis=0,
+                out=g, mode='clip')
+        diff *= g
+
 class BetaSoftMaxConvLayer(caffe.Layer):
 
     def setup(self, bottom, top):
@@ -12,10 +12,15 @@ RoIDataLayer implements a Caffe Python layer.
 
 #bottom[0]=(128,21,1,1) #classification scores
 #bottom[1]=(21) #image labels
-#for the moment I assume an image for each batch, but not a good assumption!!! 
+#several images per batch need the rois as an extra bottom (see roi_segments)
 
 import caffe
 import numpy as np
+from utils.buffers import layer_buffer
+try:
+    from utils import cython_layers
+except ImportError:
+    cython_layers = None
 
 def softmax(x,axis=-1):
     #e_x = np.exp(x - np.max(x,axis=axis))
@@ -31,15 +36,170 @@ def weights(x,axis=-1):
     out = e_x / e_x.sum(axis=axis,keepdims=True)
     return out
 
+def _rois_bottom(bottom):
+    """Position of the optional R x 5 rois bottom of the MIL layers, or
+    None.
+    """
+    for i in xrange(1, len(bottom)):
+        if bottom[i].data.ndim == 2 and bottom[i].data.shape[1] == 5:
+            return i
+    return None
+
+def roi_weights(bottom):
+    """Multiplicity of each RoI from the optional roi_weights bottom of the
+    MIL layers (see cfg.TRAIN.DEDUP_ROIS), shaped to broadcast against
+    bottom[0], or None when the layer has no such bottom.
+    """
+    rois = _rois_bottom(bottom)
+    for i in xrange(1, len(bottom)):
+        if i != rois:
+            shape = (bottom[0].data.shape[0],) + (1,) * (bottom[0].data.ndim - 1)
+            return bottom[i].data.reshape(shape)
+    return None
+
+def roi_segments(bottom, layer=None):
+    """Index of the first RoI of every image of the batch, from the batch
+    indices of the optional rois bottom of the MIL layers, which must be
+    sorted as get_minibatch builds them. Without rois the batch is one
+    image. The R-sized work array goes to a buffer of layer if given.
+
+    The MIL layers reduce each segment of RoIs with ufunc.reduceat into one
+    row of their N_images x K top.
+    """
+    i = _rois_bottom(bottom)
+    if i is None:
+        return np.zeros(1, dtype=np.int)
+    images = bottom[i].data[:,0]
+    if layer is None:
+        steps = np.diff(images)
+    else:
+        steps = layer_buffer(layer, 'steps', (max(len(images) - 1, 0),))
+        np.subtract(images[1:], images[:-1], out=steps)
+    if len(steps) > 0 and steps.min() < 0:
+        raise Exception("The RoIs must be sorted by batch index.")
+    if len(images) == 0 or images[0] != 0 or \
+            (len(steps) > 0 and steps.max() > 1):
+        raise Exception("Every image of the batch needs RoIs.")
+    # a new image starts wherever the batch index steps up
+    return np.append(0, np.flatnonzero(steps) + 1)
+
+def pools_images(layer, bottom):
+    """Mark a MIL layer as reducing over the RoIs of its batch
+    (layer.pools_rois), and record in layer.mixes_images whether it does so
+    over all of them as if they came from one image, because it has no rois
+    bottom. fast_rcnn.test then never packs several images into one forward
+    pass of the net, nor splits the RoIs of an image into chunks.
+    """
+    layer.pools_rois = True
+    layer.mixes_images = _rois_bottom(bottom) is None
+
+def segment_ids(starts, num_rois, out=None):
+    """Image (segment) of each of the num_rois RoIs, written to out if
+    given.
+    """
+    if out is None:
+        out = np.zeros(num_rois, dtype=np.int)
+    else:
+        out[...] = 0
+    out[starts[1:]] = 1
+    return np.cumsum(out, out=out)
+
+def layer_segments(layer, bottom):
+    """roi_segments and segment_ids of the RoIs of a MIL layer, with the
+    R-sized arrays in buffers of the layer (see utils.buffers).
+    """
+    starts = roi_segments(bottom, layer)
+    ids = segment_ids(starts, bottom[0].num,
+                      out=layer_buffer(layer, 'ids', (bottom[0].num,),
+                                       np.intp))
+    return starts, ids
+
+def _use_kernels(x, out):
+    """Whether the compiled kernels of utils.cython_layers can run on the
+    R x K x and write to out.
+    """
+    return cython_layers is not None and x.dtype == np.float32 and \
+            x.flags.c_contiguous and out.dtype == np.float32 and \
+            out.flags.c_contiguous
+
+def _kernel_weights(w):
+    if w is None:
+        return None
+    return np.ascontiguousarray(w.reshape(-1), dtype=np.float32)
+
+def segment_sums(x, starts, w=None, out=None):
+    """N x K sums over the RoIs of each image (from the N starts) of the
+    R x K x, every RoI counting w times (R x 1 multiplicities, or None).
+    Written to out if given.
+    """
+    if out is None:
+        out = np.zeros((len(starts), x.shape[1]), dtype=np.float32)
+    if _use_kernels(x, out):
+        return cython_layers.segment_sums(x, starts.astype(np.intp),
+                                          _kernel_weights(w), out)
+    return np_segment_sums(x, starts, w, out)
+
+def np_segment_sums(x, starts, w, out):
+    """NumPy version of segment_sums. The weighted sums are one product per
+    image, (1 x R_n) x (R_n x K), to avoid an R x K temporary.
+    """
+    if w is None:
+        return np.add.reduceat(x,starts,axis=0,out=out)
+    w = w.reshape(1,-1)
+    ends = np.append(starts[1:], x.shape[0])
+    for n in xrange(len(starts)):
+        np.dot(w[:,starts[n]:ends[n]], x[starts[n]:ends[n]],
+               out=out[n:n+1])
+    return out
+
+def segment_softmax(x, starts, scale, w=None, out=None):
+    """Softmax of scale*x over the RoIs of each image (from the N starts),
+    per column of the R x K x, every RoI counting w times in the normalizer
+    (R x 1 multiplicities, or None). Written to the R x K out if given.
+
+    Returns the softmax and the N x K log normalizers,
+    log(sum_r w_r*exp(scale*x_r)).
+    """
+    if out is None:
+        out = np.zeros(x.shape, dtype=np.float32)
+    if _use_kernels(x, out):
+        lse = cython_layers.segment_softmax(x, starts.astype(np.intp),
+                                            float(scale), _kernel_weights(w),
+                                            out)
+        return out, lse
+    return out, np_segment_softmax(x, starts, scale, w, out)
+
+def np_segment_softmax(x, starts, scale, w, out):
+    """NumPy version of segment_softmax, returns the log normalizers. Runs
+    image by image in out, so that the only temporaries are rows of K.
+    """
+    lse = np.zeros((len(starts), x.shape[1]))
+    ends = np.append(starts[1:], x.shape[0])
+    for n in xrange(len(starts)):
+        o = out[starts[n]:ends[n]]
+        np.multiply(x[starts[n]:ends[n]], scale, out=o)
+        mmax = o.max(axis=0)
+        o -= mmax
+        np.exp(o, out=o)
+        if w is not None:
+            # w*exp(a) = exp(a + log(w)), shifted by the unweighted max
+            o *= w.reshape(-1,1)[starts[n]:ends[n]]
+        ssum = o.sum(axis=0)
+        o /= ssum
+        lse[n] = mmax + np.log(ssum)
+    return lse
+
 class MyMeanLayer(caffe.Layer):
 
     def setup(self, bottom, top):
-        # check input pair
-        if len(bottom) != 1:
-            raise Exception("Only one input needed.")
+        # check input pair (the other bottoms are optional rois and RoI
+        # weights)
+        if len(bottom) not in (1, 2, 3):
+            raise Exception("One input (plus optional rois and RoI weights) needed.")
+        pools_images(self, bottom)
 
     def reshape(self, bottom, top):
-        top[0].reshape(1, bottom[0].channels,
+        top[0].reshape(len(roi_segments(bottom, self)), bottom[0].channels,
                 bottom[0].height, bottom[0].width)
         #print top[0].data.shape
         #sfsfd
@@ -56,16 +216,24 @@ class MyMeanLayer(caffe.Layer):
         #self.diff[...] = bottom[0].data - bottom[1].data
         #top[0].data[...] = np.sum(self.diff**2) / bottom[0].num / 2.
       
-        #softmax in dimension 0 
-        if 1: #mean
-            max_cls = np.mean(bottom[0].data,axis=0)
-            top[0].data[0,:,0,0] = max_cls
-            aux = np.ones(bottom[0].data.shape,dtype=bottom[0].data.dtype)
-            self.weights = aux/bottom[0].data.shape[0]#weights(bottom[0].data,axis=0)
-        else: #softmax
-            max_cls = softmax(bottom[0].data,axis=0)
-            top[0].data[0,:,0,0] = max_cls
-            self.weights = weights(bottom[0].data,axis=0)
+        #mean over the RoIs of each image
+        x = bottom[0].data.reshape(bottom[0].num,-1)
+        self.starts, self.ids = layer_segments(self, bottom)
+        max_cls = top[0].data.reshape(len(self.starts),-1)
+        w = roi_weights(bottom)
+        if w is None:
+            total = np.diff(np.append(self.starts, bottom[0].num))
+        else:
+            w = w.reshape(-1,1)
+            total = np.add.reduceat(w.ravel(),self.starts)
+        total = total.reshape(-1,1).astype(x.dtype)
+        segment_sums(x, self.starts, w, out=max_cls)
+        max_cls /= total
+        # R x 1 weight of each RoI, broadcast over the classes
+        self.weights = layer_buffer(self, 'weights', (x.shape[0], 1))
+        np.take(1/total, self.ids, axis=0, out=self.weights, mode='clip')
+        if w is not None:
+            self.weights *= w
         if 0:
             import pylab
             pylab.figure(1)
@@ -82,7 +250,10 @@ class MyMeanLayer(caffe.Layer):
 
     def backward(self, top, propagate_down, bottom):
         if propagate_down[0]:
-            bottom[0].diff[...] = top[0].diff.squeeze()*self.weights
+            diff = bottom[0].diff.reshape(bottom[0].num,-1)
+            np.take(top[0].diff.reshape(len(self.starts),-1),self.ids,axis=0,
+                    out=diff,mode='clip')
+            diff *= self.weights
             if 0:
                 print "delta",top[0].diff.squeeze()
                 print "weights",self.weights
@@ -96,20 +267,25 @@ class MyMeanLayer(caffe.Layer):
 class MySumLayer(caffe.Layer):
 
     def setup(self, bottom, top):
-        # check input pair
-        if len(bottom) != 1:
-            raise Exception("Only one input needed.")
+        # check input pair (the other bottoms are optional rois and RoI
+        # weights)
+        if len(bottom) not in (1, 2, 3):
+            raise Exception("One input (plus optional rois and RoI weights) needed.")
+        pools_images(self, bottom)
 
     def reshape(self, bottom, top):
-        top[0].reshape(1, bottom[0].channels,
+        top[0].reshape(len(roi_segments(bottom, self)), bottom[0].channels,
                 bottom[0].height, bottom[0].width)
 
     def forward(self, bottom, top):
         if 1: 
-            max_cls = np.sum(bottom[0].data,axis=0)
-            top[0].data[0,:,0,0] = max_cls
-            aux = np.ones(bottom[0].data.shape,dtype=bottom[0].data.dtype)
-            self.weights = aux#/bottom[0].data.shape[0]#weights(bottom[0].data,axis=0)
+            x = bottom[0].data.reshape(bottom[0].num,-1)
+            self.starts, self.ids = layer_segments(self, bottom)
+            max_cls = top[0].data.reshape(len(self.starts),-1)
+            w = roi_weights(bottom)
+            # R x 1 multiplicities, broadcast over the classes
+            self.weights = 1. if w is None else w.reshape(-1,1)
+            segment_sums(x, self.starts, w, out=max_cls)
         if 0:
             import pylab
             pylab.figure(1)
@@ -123,7 +299,10 @@ class MySumLayer(caffe.Layer):
 
     def backward(self, top, propagate_down, bottom):
         if propagate_down[0]:
-            bottom[0].diff[...] = top[0].diff.squeeze()*self.weights
+            diff = bottom[0].diff.reshape(bottom[0].num,-1)
+            np.take(top[0].diff.reshape(len(self.starts),-1),self.ids,axis=0,
+                    out=diff,mode='clip')
+            diff *= self.weights
             if 0:
                 print "delta",top[0].diff.squeeze()
                 print "weights",self.weights
@@ -142,9 +321,8 @@ class MySumConvLayer(caffe.Layer):
                 1,1)
 
     def forward(self, bottom, top):
-        top[0].data[:,:,0,0] = bottom[0].data.sum(axis=3).sum(axis=2)
-        aux = np.ones(bottom[0].data.shape,dtype=bottom[0].data.dtype)
-        self.weights = aux#/bottom[0].data.shape[0]#weights(bottom[0].data,axis=0)
+        bottom[0].data.reshape(bottom[0].num,bottom[0].channels,-1).sum(
+                axis=2,out=top[0].data.reshape(bottom[0].num,-1))
         if 0:
             import pylab
             pylab.figure(1)
@@ -158,10 +336,10 @@ class MySumConvLayer(caffe.Layer):
 
     def backward(self, top, propagate_down, bottom):
         if propagate_down[0]:
-            bottom[0].diff[...] = top[0].diff*self.weights
+            # the N x K x 1 x 1 gradient broadcasts over the pixels
+            bottom[0].diff[...] = top[0].diff
             if 0:
                 print "delta",top[0].diff.squeeze()
-                print "weights",self.weights
                 print "bottom",bottom[0].diff.squeeze()
                 raw_input()
 
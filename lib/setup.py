@@ -15,12 +15,24 @@ ext_modules = [
     Extension(
         "utils.cython_bbox",
         ["utils/bbox.pyx"],
-        extra_compile_args=["-Wno-cpp", "-Wno-unused-function"],
+        extra_compile_args=["-Wno-cpp", "-Wno-unused-function", "-fopenmp"],
+        extra_link_args=["-fopenmp"],
     ),
     Extension(
         "utils.cython_nms",
         ["utils/nms.pyx"],
         extra_compile_args=["-Wno-cpp", "-Wno-unused-function"],
+    ),
+    Extension(
+        "utils.cython_bitmask_nms",
+        ["utils/bitmask_nms.pyx"],
+        extra_compile_args=["-Wno-cpp", "-Wno-unused-function"],
+    ),
+    Extension(
+        "utils.cython_layers",
+        ["utils/layers.pyx"],
+        extra_compile_args=["-Wno-cpp", "-Wno-unused-function", "-fopenmp"],
+        extra_link_args=["-fopenmp"],
     )
 ]
 cmdclass.update({'build_ext': build_ext})
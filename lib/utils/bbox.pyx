@@ -8,48 +8,227 @@
 cimport cython
 import numpy as np
 cimport numpy as np
+from cython cimport floating
+from cython.parallel cimport prange
 
-DTYPE = np.float
-ctypedef np.float_t DTYPE_t
+# rows of boxes handed to an OpenMP thread at a time, and the number of query
+# boxes per block (a block of query coordinates stays in L1 cache while the
+# rows go over it)
+DEF ROW_BLOCK = 64
+DEF QUERY_BLOCK = 512
+# below this many pairs the overlaps are computed on the calling thread
+DEF PARALLEL_MIN = 65536
+
+cdef inline floating _min(floating a, floating b) nogil:
+    return a if a <= b else b
+
+cdef inline floating _max(floating a, floating b) nogil:
+    return a if a >= b else b
+
+cdef inline Py_ssize_t _imin(Py_ssize_t a, Py_ssize_t b) nogil:
+    return a if a <= b else b
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _overlap_rows(floating *boxes, floating *query, Py_ssize_t K,
+                        floating *overlaps, Py_ssize_t n0,
+                        Py_ssize_t n1) nogil:
+    """Rows n0 to n1 of the overlaps. boxes holds (x1, y1, x2, y2, area)
+    per box, query the same five quantities as rows of K columns.
+
+    Disjoint pairs get iw * ih = 0 without a branch, the others the
+    arithmetic of the original serial loop.
+    """
+    cdef floating *qx1 = query
+    cdef floating *qy1 = query + K
+    cdef floating *qx2 = query + 2 * K
+    cdef floating *qy2 = query + 3 * K
+    cdef floating *qarea = query + 4 * K
+    cdef floating x1, y1, x2, y2, area, iw, ih, inter, ovr
+    cdef floating *row
+    cdef Py_ssize_t n, k, k0, kend
+    for k0 in range(0, K, QUERY_BLOCK):
+        kend = _imin(k0 + QUERY_BLOCK, K)
+        for n in range(n0, n1):
+            x1 = boxes[5 * n]
+            y1 = boxes[5 * n + 1]
+            x2 = boxes[5 * n + 2]
+            y2 = boxes[5 * n + 3]
+            area = boxes[5 * n + 4]
+            row = overlaps + n * K
+            for k in range(k0, kend):
+                iw = _min(x2, qx2[k]) - _max(x1, qx1[k]) + 1
+                if iw > 0:
+                    ih = _min(y2, qy2[k]) - _max(y1, qy1[k]) + 1
+                    if ih > 0:
+                        row[k] = iw * ih / (area + qarea[k] - iw * ih)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef Py_ssize_t _thresh_row(floating *boxes, floating *query, Py_ssize_t K,
+                            Py_ssize_t n, floating thresh, np.intp_t *cols,
+                            floating *ious) nogil:
+    """Count the query boxes whose overlap with boxes[n] is at least thresh
+    and, unless cols is NULL, write their indices and overlaps.
+    """
+    cdef floating *qx1 = query
+    cdef floating *qy1 = query + K
+    cdef floating *qx2 = query + 2 * K
+    cdef floating *qy2 = query + 3 * K
+    cdef floating *qarea = query + 4 * K
+    cdef floating x1 = boxes[5 * n], y1 = boxes[5 * n + 1]
+    cdef floating x2 = boxes[5 * n + 2], y2 = boxes[5 * n + 3]
+    cdef floating area = boxes[5 * n + 4], iw, ih, ovr
+    cdef Py_ssize_t k, count = 0
+    for k in range(K):
+        # the overlap is at most the ratio of the smaller to the larger area
+        # (with some slack for rounding)
+        if _min(area, qarea[k]) * 1.0001 < thresh * _max(area, qarea[k]):
+            continue
+        iw = _min(x2, qx2[k]) - _max(x1, qx1[k]) + 1
+        if iw <= 0:
+            continue
+        ih = _min(y2, qy2[k]) - _max(y1, qy1[k]) + 1
+        if ih <= 0:
+            continue
+        ovr = iw * ih / (area + qarea[k] - iw * ih)
+        if ovr >= thresh:
+            if cols != NULL:
+                cols[count] = k
+                ious[count] = ovr
+            count += 1
+    return count
+
+cdef void _thresh_rows(floating *boxes, floating *query, Py_ssize_t N,
+                       Py_ssize_t K, floating thresh, np.intp_t *counts,
+                       np.intp_t *offsets, np.intp_t *cols,
+                       floating *ious) nogil:
+    """Counts of all rows (offsets NULL) or their pairs at the offsets."""
+    cdef Py_ssize_t n
+    if N * K < PARALLEL_MIN:
+        for n in range(N):
+            if offsets == NULL:
+                counts[n] = _thresh_row(boxes, query, K, n, thresh,
+                                        NULL, NULL)
+            else:
+                _thresh_row(boxes, query, K, n, thresh, cols + offsets[n],
+                            ious + offsets[n])
+    else:
+        for n in prange(N, schedule='dynamic', chunksize=ROW_BLOCK):
+            if offsets == NULL:
+                counts[n] = _thresh_row(boxes, query, K, n, thresh,
+                                        NULL, NULL)
+            else:
+                _thresh_row(boxes, query, K, n, thresh, cols + offsets[n],
+                            ious + offsets[n])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _pack(np.ndarray[floating, ndim=2] boxes, bint columns):
+    """Contiguous coordinates and areas of boxes: (N, 5), or (5, N) with
+    columns.
+    """
+    cdef Py_ssize_t N = boxes.shape[0], n, j
+    cdef np.ndarray[floating, ndim=2] packed
+    if columns:
+        packed = np.empty((5, N), dtype=boxes.dtype)
+    else:
+        packed = np.empty((N, 5), dtype=boxes.dtype)
+    cdef floating c[5]
+    for n in range(N):
+        for j in range(4):
+            c[j] = boxes[n, j]
+        c[4] = (c[2] - c[0] + 1) * (c[3] - c[1] + 1)
+        for j in range(5):
+            if columns:
+                packed[j, n] = c[j]
+            else:
+                packed[n, j] = c[j]
+    return packed
 
 def bbox_overlaps(
-        np.ndarray[DTYPE_t, ndim=2] boxes,
-        np.ndarray[DTYPE_t, ndim=2] query_boxes):
+        np.ndarray[floating, ndim=2] boxes,
+        np.ndarray[floating, ndim=2] query_boxes):
     """
     Parameters
     ----------
-    boxes: (N, 4) ndarray of float
+    boxes: (N, 4) ndarray of float (float64, or float32 for a faster
+        float32 result; both arguments must have the same dtype)
     query_boxes: (K, 4) ndarray of float
     Returns
     -------
-    overlaps: (N, K) ndarray of overlap between boxes and query_boxes
+    overlaps: (N, K) ndarray of overlap between boxes and query_boxes, of the
+        dtype of the inputs
+
+    Large problems are split into blocks of rows computed by OpenMP threads
+    without the GIL.
     """
-    cdef unsigned int N = boxes.shape[0]
-    cdef unsigned int K = query_boxes.shape[0]
-    cdef np.ndarray[DTYPE_t, ndim=2] overlaps = np.zeros((N, K), dtype=DTYPE)
-    cdef DTYPE_t iw, ih, box_area
-    cdef DTYPE_t ua
-    cdef unsigned int k, n
-    for k in range(K):
-        box_area = (
-            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
-            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
-        )
-        for n in range(N):
-            iw = (
-                min(boxes[n, 2], query_boxes[k, 2]) -
-                max(boxes[n, 0], query_boxes[k, 0]) + 1
-            )
-            if iw > 0:
-                ih = (
-                    min(boxes[n, 3], query_boxes[k, 3]) -
-                    max(boxes[n, 1], query_boxes[k, 1]) + 1
-                )
-                if ih > 0:
-                    ua = float(
-                        (boxes[n, 2] - boxes[n, 0] + 1) *
-                        (boxes[n, 3] - boxes[n, 1] + 1) +
-                        box_area - iw * ih
-                    )
-                    overlaps[n, k] = iw * ih / ua
+    cdef Py_ssize_t N = boxes.shape[0]
+    cdef Py_ssize_t K = query_boxes.shape[0]
+    cdef np.ndarray[floating, ndim=2] overlaps = \
+            np.zeros((N, K), dtype=boxes.dtype)
+    if N == 0 or K == 0:
+        return overlaps
+    cdef np.ndarray[floating, ndim=2] b = _pack(boxes, False)
+    cdef np.ndarray[floating, ndim=2] q = _pack(query_boxes, True)
+    cdef floating *b_ptr = &b[0, 0]
+    cdef floating *q_ptr = &q[0, 0]
+    cdef floating *o_ptr = &overlaps[0, 0]
+    cdef Py_ssize_t block
+    cdef Py_ssize_t nblocks = (N + ROW_BLOCK - 1) / ROW_BLOCK
+    if N * K < PARALLEL_MIN:
+        with nogil:
+            _overlap_rows(b_ptr, q_ptr, K, o_ptr, 0, N)
+    else:
+        for block in prange(nblocks, nogil=True, schedule='dynamic'):
+            _overlap_rows(b_ptr, q_ptr, K, o_ptr, block * ROW_BLOCK,
+                          _imin(block * ROW_BLOCK + ROW_BLOCK, N))
     return overlaps
+
+def bbox_overlaps_thresh(
+        np.ndarray[floating, ndim=2] boxes,
+        np.ndarray[floating, ndim=2] query_boxes,
+        double thresh):
+    """
+    Sparse bbox_overlaps: only the pairs with an overlap of at least thresh
+    (and above 0), without building the N x K matrix. Pairs whose areas alone
+    rule that out skip the intersection.
+
+    Returns
+    -------
+    rows: (M,) ndarray of indices into boxes, in increasing order
+    cols: (M,) ndarray of indices into query_boxes
+    ious: (M,) ndarray of the overlaps, of the dtype of the inputs
+    """
+    cdef Py_ssize_t N = boxes.shape[0]
+    cdef Py_ssize_t K = query_boxes.shape[0]
+    if N == 0 or K == 0:
+        return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),
+                np.zeros(0, dtype=boxes.dtype))
+    cdef np.ndarray[floating, ndim=2] b = _pack(boxes, False)
+    cdef np.ndarray[floating, ndim=2] q = _pack(query_boxes, True)
+    # smallest value of the dtype that is not below thresh, so that float32
+    # overlaps are compared as if against the double thresh
+    t_arr = np.array(thresh, dtype=boxes.dtype)
+    if t_arr < thresh:
+        t_arr = np.nextafter(t_arr, np.array(np.inf, dtype=boxes.dtype))
+    cdef floating t = t_arr
+    cdef np.ndarray[np.intp_t, ndim=1] counts = np.zeros(N, dtype=np.intp)
+
+    # count the pairs of every row, then write them at the row offsets
+    with nogil:
+        _thresh_rows(&b[0, 0], &q[0, 0], N, K, t, &counts[0], NULL, NULL,
+                     NULL)
+    cdef np.ndarray[np.intp_t, ndim=1] offsets = np.cumsum(counts) - counts
+    cdef Py_ssize_t total = offsets[N - 1] + counts[N - 1]
+    cdef np.ndarray[np.intp_t, ndim=1] cols = np.zeros(total + 1,
+                                                       dtype=np.intp)
+    cdef np.ndarray[floating, ndim=1] ious = np.zeros(total + 1,
+                                                      dtype=boxes.dtype)
+    with nogil:
+        _thresh_rows(&b[0, 0], &q[0, 0], N, K, t, &counts[0], &offsets[0],
+                     &cols[0], &ious[0])
+    rows = np.repeat(np.arange(N, dtype=np.intp), counts)
+    return rows, cols[:total], ious[:total]
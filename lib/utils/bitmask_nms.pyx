@@ -0,0 +1,163 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Non-maximum suppression with a packed suppression bitmask.
+
+Gives the same result as utils.cython_nms.nms: boxes are visited in the same
+order and the overlaps use the same float32 arithmetic. The boxes are
+gathered into contiguous arrays in visiting order once, and every kept box
+computes its overlaps with all later boxes in blocks of 64, setting bits of
+a uint64 suppression mask instead of branching on each pair; blocks whose
+boxes are all suppressed are skipped. The loops run without the GIL.
+"""
+
+import numpy as np
+cimport numpy as np
+cimport cython
+from libc.stdint cimport uint64_t
+from libc.stdlib cimport malloc, free
+
+cdef inline np.float32_t max(np.float32_t a, np.float32_t b) nogil:
+    return a if a >= b else b
+
+cdef inline np.float32_t min(np.float32_t a, np.float32_t b) nogil:
+    return a if a <= b else b
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef np.intp_t _suppress(np.float32_t *x1, np.float32_t *y1,
+                         np.float32_t *x2, np.float32_t *y2,
+                         np.float32_t *areas, np.intp_t n,
+                         np.float32_t thresh, uint64_t *removed,
+                         np.intp_t *keep) nogil:
+    """NMS over n boxes given in visiting order. Writes the positions of the
+    kept boxes to keep and returns their number; removed must hold
+    (n + 63) / 64 words.
+    """
+    cdef np.intp_t nblocks = (n + 63) / 64
+    cdef np.intp_t i, j, b, k, jstart, jend, nkeep = 0
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t xx1, yy1, xx2, yy2, w, h, inter, ovr
+    cdef uint64_t bits
+    # overlap tests of one block, in a separate array so that the loop
+    # computing them has no dependency between iterations
+    cdef np.uint8_t over[64]
+
+    for b in range(nblocks):
+        removed[b] = 0
+
+    for i in range(n):
+        if (removed[i / 64] >> (i % 64)) & 1:
+            continue
+        keep[nkeep] = i
+        nkeep += 1
+        ix1 = x1[i]
+        iy1 = y1[i]
+        ix2 = x2[i]
+        iy2 = y2[i]
+        iarea = areas[i]
+        for b in range(i / 64, nblocks):
+            if removed[b] == <uint64_t>(-1):
+                # every box of the block is already suppressed
+                continue
+            jstart = b * 64
+            jend = jstart + 64
+            if jend > n:
+                jend = n
+            for j in range(jstart, jend):
+                xx1 = max(ix1, x1[j])
+                yy1 = max(iy1, y1[j])
+                xx2 = min(ix2, x2[j])
+                yy2 = min(iy2, y2[j])
+                w = max(0.0, xx2 - xx1 + 1)
+                h = max(0.0, yy2 - yy1 + 1)
+                inter = w * h
+                ovr = inter / (iarea + areas[j] - inter)
+                over[j - jstart] = ovr >= thresh
+            bits = 0
+            for j in range(jend - jstart):
+                bits |= (<uint64_t>over[j]) << j
+            if b == i / 64:
+                # only boxes after i can be suppressed by it
+                k = i % 64
+                if k == 63:
+                    bits = 0
+                else:
+                    bits &= ~((((<uint64_t>1) << (k + 1))) - 1)
+            removed[b] |= bits
+    return nkeep
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def nms_segments(np.ndarray[np.float32_t, ndim=2] dets,
+                 np.ndarray[np.intp_t, ndim=1] order,
+                 np.ndarray[np.intp_t, ndim=1] starts, double thresh):
+    """Run nms independently on several segments of dets in one call.
+
+    order[starts[s]:starts[s + 1]] holds the indices of the dets of segment s
+    in the order nms visits them (decreasing score). Boxes are only compared
+    within a segment.
+
+    Returns:
+        keep (ndarray): indices of the kept dets, segment by segment and in
+            visiting order within a segment
+        num_keep (ndarray): number of kept dets of each segment
+    """
+    cdef np.ndarray[np.float32_t, ndim=2] sorted_dets = \
+            np.ascontiguousarray(dets[order, :4].T)
+    cdef np.ndarray[np.float32_t, ndim=1] areas = \
+            (sorted_dets[2] - sorted_dets[0] + 1) * \
+            (sorted_dets[3] - sorted_dets[1] + 1)
+    cdef np.intp_t n = order.shape[0]
+    cdef int nsegments = starts.shape[0] - 1
+    cdef np.ndarray[np.intp_t, ndim=1] keep = np.zeros((n), dtype=np.intp)
+    cdef np.ndarray[np.intp_t, ndim=1] num_keep = \
+            np.zeros((nsegments), dtype=np.intp)
+    cdef np.float32_t *x1 = &sorted_dets[0, 0] if n > 0 else NULL
+    cdef np.float32_t *y1 = &sorted_dets[1, 0] if n > 0 else NULL
+    cdef np.float32_t *x2 = &sorted_dets[2, 0] if n > 0 else NULL
+    cdef np.float32_t *y2 = &sorted_dets[3, 0] if n > 0 else NULL
+    cdef np.float32_t *area = &areas[0] if n > 0 else NULL
+    cdef np.intp_t *keep_ptr = &keep[0] if n > 0 else NULL
+    cdef np.intp_t *starts_ptr = &starts[0]
+    cdef np.intp_t *num_keep_ptr = &num_keep[0] if nsegments > 0 else NULL
+    cdef uint64_t *removed = <uint64_t *>malloc(((n + 63) / 64 + 1) *
+                                                sizeof(uint64_t))
+    cdef np.intp_t s, start, size, nkeep = 0, k
+    # float32 threshold with the same outcome as comparing the float32
+    # overlap against the double thresh, as cython_nms does
+    # (the smallest float32 >= thresh; the step is taken in float32, as
+    # fthresh would be passed to nextafter as a double)
+    cdef np.float32_t fthresh = np.float32(thresh)
+    if fthresh < thresh:
+        fthresh = np.nextafter(np.float32(fthresh), np.float32(np.inf))
+    if removed == NULL:
+        raise MemoryError()
+
+    with nogil:
+        for s in range(nsegments):
+            start = starts_ptr[s]
+            size = starts_ptr[s + 1] - start
+            num_keep_ptr[s] = _suppress(x1 + start, y1 + start, x2 + start,
+                                        y2 + start, area + start, size,
+                                        fthresh, removed, keep_ptr + nkeep)
+            # positions within the segment to positions in order
+            for k in range(nkeep, nkeep + num_keep_ptr[s]):
+                keep_ptr[k] += start
+            nkeep += num_keep_ptr[s]
+    free(removed)
+
+    return order[keep[:nkeep]], num_keep
+
+def nms(np.ndarray[np.float32_t, ndim=2] dets, double thresh):
+    """Same as utils.cython_nms.nms, returning an array of kept indices."""
+    cdef np.ndarray[np.intp_t, ndim=1] order = \
+            dets[:, 4].argsort()[::-1].astype(np.intp)
+    keep, num_keep = nms_segments(dets, order,
+                                  np.array([0, dets.shape[0]], dtype=np.intp),
+                                  thresh)
+    return keep
@@ -0,0 +1,30 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Persistent work arrays of the Python layers.
+
+Caffe calls reshape before every forward pass, so a layer that builds its
+temporaries there (or in forward and backward) allocates them at every
+iteration. layer_buffer keeps them as attributes of the layer instead and
+only reallocates one when its shape changes, counting the allocations in
+layer.allocations. tools/benchmark.py buffers checks that this count stays
+at 0, and that NumPy allocates no array at all during an iteration.
+"""
+
+import numpy as np
+
+def layer_buffer(layer, name, shape, dtype=np.float32):
+    """Attribute name of layer as an array of the given shape and dtype,
+    reused from the previous call when it matches and zero-filled when it
+    is (re)allocated.
+    """
+    shape = tuple(int(n) for n in shape)
+    buf = getattr(layer, name, None)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.zeros(shape, dtype=dtype)
+        setattr(layer, name, buf)
+        layer.allocations = getattr(layer, 'allocations', 0) + 1
+    return buf
@@ -0,0 +1,58 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Exact deduplication of RoIs on the feature map grid."""
+
+import numpy as np
+
+def unique_rois(rois, scale):
+    """Find the RoIs that map to the same feature map RoI.
+
+    Arguments:
+        rois (ndarray): R x 5 array of (level, x1, y1, x2, y2) RoIs with
+            non-negative coordinates, as built by _get_rois_blob
+        scale (float): image to feature map scale (cfg.DEDUP_BOXES)
+
+    Returns:
+        index (ndarray): indices of the first RoI of each distinct feature
+            map RoI, so that rois[index] are the unique RoIs
+        inv_index (ndarray): R array such that rois[index][inv_index] maps
+            every RoI to its unique copy
+    """
+    num_rois = rois.shape[0]
+    if num_rois == 0:
+        return np.zeros(0, dtype=np.int), np.zeros(0, dtype=np.int)
+    # integer keys: the pyramid level (or batch index) as is, the
+    # coordinates on the grid, rounded half away from zero like the RoI
+    # pooling layer does
+    keys = np.empty((num_rois, rois.shape[1]), dtype=np.int64)
+    keys[:, 0] = rois[:, 0]
+    keys[:, 1:] = np.floor(rois[:, 1:] * scale + 0.5)
+
+    # pack the keys into one int64 by mixed radix when their ranges allow
+    # it, which is exact and sorts much faster than a lexsort on columns
+    keys -= keys.min(axis=0)
+    spans = keys.max(axis=0) + 1
+    first = np.ones(num_rois, dtype=np.bool)
+    if np.prod(spans.astype(np.float)) < 2. ** 62:
+        packed = keys[:, 0].copy()
+        for col in xrange(1, keys.shape[1]):
+            packed *= spans[col]
+            packed += keys[:, col]
+        order = np.argsort(packed)
+        sorted_keys = packed[order]
+        first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    else:
+        order = np.lexsort(keys.T[::-1])
+        sorted_keys = keys[order]
+        first[1:] = np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)
+
+    # the sorts need not be stable: the smallest index of each group is its
+    # first occurrence in the input order
+    index = np.minimum.reduceat(order, np.where(first)[0])
+    inv_index = np.empty(num_rois, dtype=np.int)
+    inv_index[order] = np.cumsum(first) - 1
+    return index, inv_index
@@ -0,0 +1,85 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Sums of multi-channel maps over many boxes with summed-area tables.
+
+Boxes are (x1, y1, x2, y2) integer arrays with inclusive coordinates inside
+the map. box_sums scores all boxes with four gathers, whatever their area,
+and box_scatter is its adjoint (the gradient of box_sums), built with a 2D
+difference array and one cumulative sum per axis.
+
+Both run in the compiled kernels of utils.cython_layers when the extension is
+built (see lib/setup.py), and in NumPy (np_box_sums, np_box_scatter)
+otherwise.
+"""
+
+import numpy as np
+try:
+    from utils import cython_layers
+except ImportError:
+    cython_layers = None
+
+def integral_image(x):
+    """C x (H + 1) x (W + 1) summed-area table of a C x H x W map, in float64
+    (float32 tables lose the small boxes of large maps to rounding).
+    """
+    sat = np.zeros((x.shape[0], x.shape[1] + 1, x.shape[2] + 1),
+                   dtype=np.float64)
+    np.cumsum(x, axis=1, dtype=np.float64, out=sat[:, 1:, 1:])
+    np.cumsum(sat[:, 1:, 1:], axis=2, out=sat[:, 1:, 1:])
+    return sat
+
+def _corners(boxes, width):
+    """Flat indices into a (H + 1) x width table of the four corners of the
+    boxes: top-left, top-right, bottom-left and bottom-right (exclusive).
+    """
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2] + 1
+    y2 = boxes[:, 3] + 1
+    return (y1 * width + x1, y1 * width + x2,
+            y2 * width + x1, y2 * width + x2)
+
+def _kernel_boxes(boxes):
+    return np.ascontiguousarray(boxes[:, :4], dtype=np.intp)
+
+def box_sums(sat, boxes):
+    """B x C sums over the B boxes of the map of a summed-area table."""
+    if cython_layers is not None:
+        return cython_layers.box_sums(
+            np.ascontiguousarray(sat, dtype=np.float64), _kernel_boxes(boxes))
+    return np_box_sums(sat, boxes)
+
+def np_box_sums(sat, boxes):
+    """NumPy version of box_sums."""
+    flat = sat.reshape(sat.shape[0], -1)
+    tl, tr, bl, br = _corners(boxes, sat.shape[2])
+    return (flat[:, br] - flat[:, tr] - flat[:, bl] + flat[:, tl]).T
+
+def box_scatter(values, boxes, shape):
+    """C x H x W map that adds values[b, c] to every pixel of box b in
+    channel c: the gradient of box_sums for the output gradient values.
+    """
+    if cython_layers is not None:
+        return cython_layers.box_scatter(
+            np.ascontiguousarray(values, dtype=np.float64),
+            _kernel_boxes(boxes), shape[0], shape[1])
+    return np_box_scatter(values, boxes, shape)
+
+def np_box_scatter(values, boxes, shape):
+    """NumPy version of box_scatter."""
+    height, width = shape
+    diff = np.zeros(((height + 1) * (width + 1), values.shape[1]),
+                    dtype=np.float64)
+    tl, tr, bl, br = _corners(boxes, width + 1)
+    np.add.at(diff, tl, values)
+    np.add.at(diff, tr, -values)
+    np.add.at(diff, bl, -values)
+    np.add.at(diff, br, values)
+    diff = diff.reshape(height + 1, width + 1, -1)
+    np.cumsum(diff, axis=0, out=diff)
+    np.cumsum(diff, axis=1, out=diff)
+    return diff[:height, :width].transpose(2, 0, 1)
@@ -0,0 +1,290 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Compiled kernels of the Python layers of roi_data_layer.
+
+utils.integral and roi_data_layer.sum use them when this extension is built
+and fall back to NumPy otherwise, with the same results up to rounding:
+    box_sums, box_scatter    summed-area table box sums and their adjoint
+    segment_sums             weighted sums over the RoIs of each image
+    segment_softmax          softmax over the RoIs of each image (axis 0)
+Large problems are split over OpenMP threads without the GIL.
+
+count_allocations counts the NumPy array buffers a call allocates, to check
+that the layers run without temporaries (see tools/benchmark.py buffers).
+"""
+
+cimport cython
+import numpy as np
+cimport numpy as np
+from cython.parallel cimport prange
+from libc.math cimport exp, log, INFINITY
+
+cdef extern from "numpy/arrayobject.h":
+    ctypedef void PyDataMem_EventHookFunc(void *inp, void *outp, size_t size,
+                                          void *user_data) nogil
+    PyDataMem_EventHookFunc *PyDataMem_SetEventHook(
+            PyDataMem_EventHookFunc *newhook, void *user_data,
+            void **old_data)
+
+np.import_array()
+
+# below this many elements a kernel runs on the calling thread
+DEF PARALLEL_MIN = 65536
+
+cdef void _count_allocation(void *inp, void *outp, size_t size,
+                            void *user_data) nogil:
+    # inp is NULL for a malloc, outp for a free, both are set for a realloc
+    if outp != NULL:
+        (<Py_ssize_t *>user_data)[0] += 1
+
+def count_allocations(func, *args):
+    """Number of NumPy array buffers that func(*args) allocates or
+    reallocates, from the data memory event hook of NumPy. Buffers below
+    1 KB are only counted when NumPy cannot take them from its cache.
+    """
+    cdef Py_ssize_t count = 0
+    cdef void *old_data = NULL
+    cdef PyDataMem_EventHookFunc *old_hook = \
+            PyDataMem_SetEventHook(_count_allocation, &count, &old_data)
+    try:
+        func(*args)
+    finally:
+        PyDataMem_SetEventHook(old_hook, old_data, NULL)
+    return count
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _box_sum(double *sat, Py_ssize_t C, Py_ssize_t plane,
+                   Py_ssize_t stride, np.intp_t *box, double *out) nogil:
+    """Sums of the C channels of a C x (H + 1) x stride table over the
+    inclusive box (x1, y1, x2, y2).
+    """
+    cdef Py_ssize_t tl = box[1] * stride + box[0]
+    cdef Py_ssize_t tr = box[1] * stride + box[2] + 1
+    cdef Py_ssize_t bl = (box[3] + 1) * stride + box[0]
+    cdef Py_ssize_t br = (box[3] + 1) * stride + box[2] + 1
+    cdef Py_ssize_t c
+    cdef double *s
+    for c in range(C):
+        s = sat + c * plane
+        out[c] = s[br] - s[tr] - s[bl] + s[tl]
+
+def box_sums(np.ndarray[np.float64_t, ndim=3] sat,
+             np.ndarray[np.intp_t, ndim=2] boxes):
+    """B x C sums over the B x 4 boxes of the map of a C-contiguous
+    C x (H + 1) x (W + 1) summed-area table.
+    """
+    cdef Py_ssize_t C = sat.shape[0]
+    cdef Py_ssize_t stride = sat.shape[2]
+    cdef Py_ssize_t plane = sat.shape[1] * stride
+    cdef Py_ssize_t B = boxes.shape[0], b
+    cdef np.ndarray[np.float64_t, ndim=2] out = np.zeros((B, C),
+                                                         dtype=np.float64)
+    if B == 0 or C == 0:
+        return out
+    cdef double *s_ptr = &sat[0, 0, 0]
+    cdef np.intp_t *b_ptr = &boxes[0, 0]
+    cdef double *o_ptr = &out[0, 0]
+    if B * C < PARALLEL_MIN:
+        with nogil:
+            for b in range(B):
+                _box_sum(s_ptr, C, plane, stride, b_ptr + 4 * b,
+                         o_ptr + C * b)
+    else:
+        for b in prange(B, nogil=True, schedule='static'):
+            _box_sum(s_ptr, C, plane, stride, b_ptr + 4 * b, o_ptr + C * b)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _integrate(double *d, Py_ssize_t height, Py_ssize_t stride) nogil:
+    """In-place cumulative sums of a height x stride plane along y, then
+    along x (the order of the NumPy version).
+    """
+    cdef Py_ssize_t y, x
+    for y in range(1, height):
+        for x in range(stride):
+            d[y * stride + x] += d[(y - 1) * stride + x]
+    for y in range(height):
+        for x in range(1, stride):
+            d[y * stride + x] += d[y * stride + x - 1]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def box_scatter(np.ndarray[np.float64_t, ndim=2] values,
+                np.ndarray[np.intp_t, ndim=2] boxes,
+                Py_ssize_t height, Py_ssize_t width):
+    """C x H x W map that adds values[b, c] to every pixel of box b in
+    channel c: the adjoint of box_sums. The corners of the boxes go into a
+    difference array, integrated one channel per thread.
+    """
+    cdef Py_ssize_t B = values.shape[0], C = values.shape[1]
+    cdef Py_ssize_t stride = width + 1
+    cdef Py_ssize_t plane = (height + 1) * stride
+    cdef np.ndarray[np.float64_t, ndim=3] out = \
+            np.zeros((C, height + 1, stride), dtype=np.float64)
+    cdef Py_ssize_t b, c, tl, tr, bl, br
+    cdef double v
+    cdef double *o_ptr
+    cdef np.intp_t *box
+    if B > 0 and C > 0:
+        o_ptr = &out[0, 0, 0]
+        with nogil:
+            for b in range(B):
+                box = &boxes[b, 0]
+                tl = box[1] * stride + box[0]
+                tr = box[1] * stride + box[2] + 1
+                bl = (box[3] + 1) * stride + box[0]
+                br = (box[3] + 1) * stride + box[2] + 1
+                for c in range(C):
+                    v = values[b, c]
+                    o_ptr[c * plane + tl] += v
+                    o_ptr[c * plane + tr] -= v
+                    o_ptr[c * plane + bl] -= v
+                    o_ptr[c * plane + br] += v
+        if C * plane < PARALLEL_MIN:
+            with nogil:
+                for c in range(C):
+                    _integrate(o_ptr + c * plane, height + 1, stride)
+        else:
+            for c in prange(C, nogil=True, schedule='static'):
+                _integrate(o_ptr + c * plane, height + 1, stride)
+    return out[:, :height, :width]
+
+cdef inline Py_ssize_t _segment_end(np.intp_t *starts, Py_ssize_t N,
+                                    Py_ssize_t R, Py_ssize_t n) nogil:
+    return starts[n + 1] if n + 1 < N else R
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _segment_sum(float *x, Py_ssize_t K, Py_ssize_t r0, Py_ssize_t r1,
+                       float *w, double *acc, float *out) nogil:
+    """Sums of the K columns of the rows r0 to r1 of x, weighted by w (unless
+    NULL), accumulated in double.
+    """
+    cdef Py_ssize_t r, k
+    cdef double v = 1
+    for k in range(K):
+        acc[k] = 0
+    for r in range(r0, r1):
+        if w != NULL:
+            v = w[r]
+        for k in range(K):
+            acc[k] += v * x[r * K + k]
+    for k in range(K):
+        out[k] = <float>acc[k]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def segment_sums(np.ndarray[np.float32_t, ndim=2] x,
+                 np.ndarray[np.intp_t, ndim=1] starts,
+                 np.ndarray[np.float32_t, ndim=1] weights,
+                 np.ndarray[np.float32_t, ndim=2] out):
+    """Write to the N x K out the sums of the rows of the R x K x from
+    each of the N starts to the next, weighted by the R weights (or None),
+    as np.add.reduceat(x * weights[:, None], starts, axis=0).
+    """
+    cdef Py_ssize_t R = x.shape[0], K = x.shape[1], N = starts.shape[0]
+    cdef Py_ssize_t n
+    if N == 0 or K == 0 or R == 0:
+        return out
+    cdef np.ndarray[np.float64_t, ndim=2] acc = np.zeros((N, K),
+                                                         dtype=np.float64)
+    cdef float *x_ptr = &x[0, 0]
+    cdef float *w_ptr = NULL
+    if weights is not None:
+        w_ptr = &weights[0]
+    cdef np.intp_t *s_ptr = &starts[0]
+    cdef double *a_ptr = &acc[0, 0]
+    cdef float *o_ptr = &out[0, 0]
+    if R * K < PARALLEL_MIN:
+        with nogil:
+            for n in range(N):
+                _segment_sum(x_ptr, K, s_ptr[n], _segment_end(s_ptr, N, R, n),
+                             w_ptr, a_ptr + n * K, o_ptr + n * K)
+    else:
+        # one image per thread
+        for n in prange(N, nogil=True, schedule='dynamic'):
+            _segment_sum(x_ptr, K, s_ptr[n], _segment_end(s_ptr, N, R, n),
+                         w_ptr, a_ptr + n * K, o_ptr + n * K)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _segment_softmax(float *x, Py_ssize_t K, Py_ssize_t r0,
+                           Py_ssize_t r1, double scale, float *w, float *out,
+                           double *lse, double *total) nogil:
+    """Softmax of a = scale * x + log(w) over the rows r0 to r1, per column,
+    and the logs of the K normalizers. The rows are read in order, lse
+    holding the maxima until the end.
+    """
+    cdef double a, e, log_w = 0
+    cdef Py_ssize_t r, k
+    for k in range(K):
+        lse[k] = -INFINITY
+        total[k] = 0
+    for r in range(r0, r1):
+        if w != NULL:
+            log_w = log(w[r])
+        for k in range(K):
+            a = scale * x[r * K + k] + log_w
+            if a > lse[k]:
+                lse[k] = a
+    for r in range(r0, r1):
+        if w != NULL:
+            log_w = log(w[r])
+        for k in range(K):
+            e = exp(scale * x[r * K + k] + log_w - lse[k])
+            out[r * K + k] = <float>e
+            total[k] += e
+    for k in range(K):
+        lse[k] += log(total[k])
+        total[k] = 1 / total[k]
+    for r in range(r0, r1):
+        for k in range(K):
+            out[r * K + k] = <float>(out[r * K + k] * total[k])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def segment_softmax(np.ndarray[np.float32_t, ndim=2] x,
+                    np.ndarray[np.intp_t, ndim=1] starts, double scale,
+                    np.ndarray[np.float32_t, ndim=1] weights,
+                    np.ndarray[np.float32_t, ndim=2] out):
+    """Write to the R x K out the softmax of scale * x over the rows of
+    each segment (the RoIs of an image, from the N starts), every row
+    counting weights[r] times (unless weights is None). Returns the N x K
+    logs of the normalizers, sum_r weights[r] * exp(scale * x[r]).
+    """
+    cdef Py_ssize_t R = x.shape[0], K = x.shape[1], N = starts.shape[0]
+    cdef Py_ssize_t n
+    cdef np.ndarray[np.float64_t, ndim=2] lse = np.zeros((N, K),
+                                                         dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=2] total = np.zeros((N, K),
+                                                           dtype=np.float64)
+    if N == 0 or K == 0 or R == 0:
+        return lse
+    cdef float *x_ptr = &x[0, 0]
+    cdef float *w_ptr = NULL
+    if weights is not None:
+        w_ptr = &weights[0]
+    cdef np.intp_t *s_ptr = &starts[0]
+    cdef float *o_ptr = &out[0, 0]
+    cdef double *l_ptr = &lse[0, 0]
+    cdef double *t_ptr = &total[0, 0]
+    if R * K < PARALLEL_MIN:
+        with nogil:
+            for n in range(N):
+                _segment_softmax(x_ptr, K, s_ptr[n],
+                                 _segment_end(s_ptr, N, R, n), scale, w_ptr,
+                                 o_ptr, l_ptr + n * K, t_ptr + n * K)
+    else:
+        # one image per thread
+        for n in prange(N, nogil=True, schedule='dynamic'):
+            _segment_softmax(x_ptr, K, s_ptr[n],
+                             _segment_end(s_ptr, N, R, n), scale, w_ptr,
+                             o_ptr, l_ptr + n * K, t_ptr + n * K)
+    return lse
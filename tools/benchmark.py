@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Micro-benchmarks of Fast R-CNN hot paths on synthetic data."""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from utils.dedup import unique_rois
+from utils.nms import nms as py_nms
+from utils.cython_nms import nms as cython_nms
+from utils.cython_bitmask_nms import nms as bitmask_nms
+from utils.cython_bbox import bbox_overlaps, bbox_overlaps_thresh
+from roi_data_layer.softmax import betaweights2, segm_softmax_scores, \
+        segm_softmax_diff
+import roi_data_layer.softmax
+import roi_data_layer.sum
+import roi_data_layer.pyloss
+import utils.integral
+import argparse
+import time
+import sys
+import numpy as np
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Run a micro-benchmark')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()),
+                        help='benchmark to run')
+    parser.add_argument('--sizes', dest='sizes',
+                        help='comma separated problem sizes (default depends '
+                             'on the benchmark)',
+                        default=None, type=str)
+    parser.add_argument('--repeat', dest='repeat',
+                        help='number of timed runs (the best one is reported)',
+                        default=10, type=int)
+    parser.add_argument('--seed', dest='seed', help='random seed',
+                        default=cfg.RNG_SEED, type=int)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+def _sizes(args, default):
+    if args.sizes is None:
+        return default
+    return [int(x) for x in args.sizes.split(',')]
+
+def _best_time(fn, repeat):
+    """Best wall clock time of fn() over repeat runs, in ms."""
+    best = np.inf
+    for _ in xrange(repeat):
+        start = time.time()
+        fn()
+        best = min(best, time.time() - start)
+    return best * 1000.
+
+def _random_boxes(num, rng, width=1000, height=600):
+    """num x 4 boxes with proposal-like sizes inside a width x height image."""
+    w = np.minimum(np.exp(rng.uniform(np.log(16), np.log(width), num)), width)
+    h = np.minimum(np.exp(rng.uniform(np.log(16), np.log(height), num)),
+                   height)
+    x1 = rng.uniform(0, width - w)
+    y1 = rng.uniform(0, height - h)
+    return np.vstack((x1, y1, x1 + w - 1, y1 + h - 1)).T
+
+def _legacy_dedup(rois, scale):
+    v = np.array([1, 1e3, 1e6, 1e9, 1e12])
+    hashes = np.round(rois * scale).dot(v)
+    _, index, inv_index = np.unique(hashes, return_index=True,
+                                    return_inverse=True)
+    return index, inv_index
+
+def bench_dedup(args):
+    """Float hash vs. exact integer key RoI deduplication (im_detect)."""
+    rng = np.random.RandomState(args.seed)
+    print '{:>8s} {:>8s} {:>10s} {:>10s}'.format('rois', 'unique',
+                                                 'hash ms', 'exact ms')
+    for num in _sizes(args, [2000, 10000]):
+        rois = np.hstack((np.zeros((num, 1)), _random_boxes(num, rng)))
+        rois = rois.astype(np.float32)
+        index, inv_index = unique_rois(rois, cfg.DEDUP_BOXES)
+        assert np.all(np.round(rois[index][inv_index, 1:] * cfg.DEDUP_BOXES)
+                      == np.round(rois[:, 1:] * cfg.DEDUP_BOXES))
+        t_hash = _best_time(lambda: _legacy_dedup(rois, cfg.DEDUP_BOXES),
+                            args.repeat)
+        t_exact = _best_time(lambda: unique_rois(rois, cfg.DEDUP_BOXES),
+                             args.repeat)
+        print '{:8d} {:7.1%} {:10.3f} {:10.3f}'.format(
+            num, len(index) / float(num), t_hash, t_exact)
+
+def _random_dets(num, rng, num_objects=20):
+    """num x 5 detections clustered around num_objects objects, like the
+    detections of one class before NMS.
+    """
+    objects = _random_boxes(num_objects, rng)
+    boxes = objects[rng.randint(0, num_objects, num)]
+    sizes = np.hstack((boxes[:, 2:] - boxes[:, :2],) * 2)
+    boxes = boxes + rng.normal(0, 0.1, (num, 4)) * sizes
+    scores = rng.uniform(0, 1, (num, 1))
+    return np.hstack((boxes, scores)).astype(np.float32)
+
+# two integer boxes whose float32 overlap is exactly float32(0.7), which
+# cython_nms keeps (0.69999999 < 0.7 in double)
+NMS_TIE = (np.array([[25, 11, 39, 36, .5], [26, 11, 38, 31, .3]],
+                    dtype=np.float32), 0.7)
+
+def _check_nms(dets, thresh):
+    assert list(bitmask_nms(dets, thresh)) == \
+            list(cython_nms(dets, thresh)), (dets, thresh)
+
+def _check_nms_ties(rng, trials=2000):
+    """Bitmask against Cython NMS on small integer boxes (the proposals of
+    the weakly supervised setup), where overlaps often equal the threshold.
+    """
+    _check_nms(*NMS_TIE)
+    for _ in xrange(trials):
+        x1y1 = rng.randint(0, 30, (8, 2))
+        x2y2 = x1y1 + rng.randint(0, 20, (8, 2))
+        dets = np.hstack((x1y1, x2y2, rng.uniform(0, 1, (8, 1))))
+        for thresh in [0.3, 0.5, 0.7, cfg.TEST.NMS]:
+            _check_nms(dets.astype(np.float32), thresh)
+
+def bench_nms(args):
+    """NumPy, Cython and bitmask Cython NMS on one class of detections."""
+    rng = np.random.RandomState(args.seed)
+    _check_nms_ties(rng)
+    print '{:>8s} {:>8s} {:>10s} {:>10s} {:>10s}'.format(
+        'dets', 'kept', 'numpy ms', 'cython ms', 'bitmask ms')
+    for num in _sizes(args, [300, 2000, 10000]):
+        dets = _random_dets(num, rng)
+        _check_nms(np.round(dets), cfg.TEST.NMS)
+        keep = bitmask_nms(dets, cfg.TEST.NMS)
+        assert list(keep) == list(cython_nms(dets, cfg.TEST.NMS))
+        t_py = _best_time(lambda: py_nms(dets, cfg.TEST.NMS), args.repeat)
+        t_cy = _best_time(lambda: cython_nms(dets, cfg.TEST.NMS), args.repeat)
+        t_bm = _best_time(lambda: bitmask_nms(dets, cfg.TEST.NMS),
+                          args.repeat)
+        print '{:8d} {:8d} {:10.3f} {:10.3f} {:10.3f}'.format(
+            num, len(keep), t_py, t_cy, t_bm)
+
+# (boxes, query boxes) of the bbox_overlaps call sites: proposals against the
+# ground truth of an image (create_roidb_from_box_list, _compute_targets,
+# evaluate_recall on the top_10000 proposals), detections against the ground
+# truth (voc_eval), the ground truth against one class of detections
+# (evalCorLoc) and all pairs of proposals
+OVERLAP_SHAPES = [(2000, 3), (10000, 3), (300, 3), (3, 300), (2000, 2000)]
+
+def bench_overlaps(args):
+    """Dense float64 and float32 and sparse thresholded bbox_overlaps."""
+    rng = np.random.RandomState(args.seed)
+    if args.sizes is None:
+        shapes = OVERLAP_SHAPES
+    else:
+        shapes = [(num, 3) for num in _sizes(args, None)]
+    print '{:>6s} {:>6s} {:>10s} {:>10s} {:>10s}'.format(
+        'boxes', 'query', 'f64 ms', 'f32 ms', 'thresh ms')
+    for num, num_query in shapes:
+        boxes = _random_boxes(num, rng)
+        query = _random_boxes(num_query, rng)
+        boxes32 = boxes.astype(np.float32)
+        query32 = query.astype(np.float32)
+        overlaps = bbox_overlaps(boxes, query)
+        rows, cols, ious = bbox_overlaps_thresh(boxes, query,
+                                                cfg.TRAIN.FG_THRESH)
+        assert np.array_equal(np.vstack((rows, cols)),
+                              np.vstack(np.where(overlaps >=
+                                                 cfg.TRAIN.FG_THRESH)))
+        assert np.array_equal(ious, overlaps[rows, cols])
+        assert np.allclose(bbox_overlaps(boxes32, query32), overlaps,
+                           atol=1e-5)
+        t_64 = _best_time(lambda: bbox_overlaps(boxes, query), args.repeat)
+        t_32 = _best_time(lambda: bbox_overlaps(boxes32, query32),
+                          args.repeat)
+        t_th = _best_time(lambda: bbox_overlaps_thresh(boxes, query,
+                                                       cfg.TRAIN.FG_THRESH),
+                          args.repeat)
+        print '{:6d} {:6d} {:10.3f} {:10.3f} {:10.3f}'.format(
+            num, num_query, t_64, t_32, t_th)
+
+# feature map (conv5 of a 600 x 800 image), classes and beta of the softmax
+# mode of ScoreSegmBoxesLayer
+SEGM_SHAPE = (21, 38, 50)
+SEGM_BETA = 3.0
+
+def _legacy_segm_softmax(segm, logits, boxes, beta, grad):
+    """Per-box softmax mode of ScoreSegmBoxesLayer: scores, gradient w.r.t.
+    segm and the per-box weights the forward pass kept for backward.
+    """
+    num_classes = segm.shape[0]
+    scores = np.zeros((boxes.shape[0], num_classes), dtype=np.float32)
+    dsegm = np.zeros_like(segm)
+    kept = []
+    for b in xrange(boxes.shape[0]):
+        x1, y1, x2, y2 = boxes[b]
+        pix_scores = segm[:, y1:y2 + 1, x1:x2 + 1]
+        pix_prob = betaweights2(logits[:, y1:y2 + 1, x1:x2 + 1]
+                                .reshape((num_classes, -1)), beta, 1) \
+                .reshape(pix_scores.shape)
+        kept.append(pix_prob)
+        scores[b] = (pix_scores * pix_prob).sum(2).sum(1)
+    for b in xrange(boxes.shape[0]):
+        x1, y1, x2, y2 = boxes[b]
+        dsegm[:, y1:y2 + 1, x1:x2 + 1] += \
+                kept[b] * grad[b][:, np.newaxis, np.newaxis]
+    return scores, dsegm, kept
+
+def bench_segm(args):
+    """Per-box vs. summed-area table softmax mode of ScoreSegmBoxesLayer
+    (forward and backward), and the memory kept from forward to backward.
+    """
+    rng = np.random.RandomState(args.seed)
+    num_classes, height, width = SEGM_SHAPE
+    segm = rng.normal(0, 1, SEGM_SHAPE).astype(np.float32)
+    logits = rng.normal(0, 1, SEGM_SHAPE).astype(np.float32)
+    print '{:>6s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+        'boxes', 'loop ms', 'table ms', 'loop MB', 'table MB')
+    for num in _sizes(args, [128, 2000]):
+        boxes = np.round(_random_boxes(num, rng, width * 16, height * 16) /
+                         16).astype(np.int)
+        boxes = np.minimum(boxes, [width - 1, height - 1] * 2)
+        valid = np.ones(num, dtype=np.bool)
+        grad = rng.normal(0, 1, (num, num_classes)).astype(np.float32)
+
+        scores, dsegm, kept = _legacy_segm_softmax(segm, logits, boxes,
+                                                   SEGM_BETA, grad)
+        assert np.allclose(segm_softmax_scores(segm, logits, boxes, valid,
+                                               SEGM_BETA),
+                           scores, rtol=1e-4, atol=1e-5)
+        assert np.allclose(segm_softmax_diff(segm, logits, boxes, valid,
+                                             SEGM_BETA, grad)[0],
+                           dsegm, rtol=1e-4, atol=1e-5)
+        t_loop = _best_time(lambda: _legacy_segm_softmax(
+            segm, logits, boxes, SEGM_BETA, grad), args.repeat)
+        t_table = _best_time(lambda: (
+            segm_softmax_scores(segm, logits, boxes, valid, SEGM_BETA),
+            segm_softmax_diff(segm, logits, boxes, valid, SEGM_BETA, grad)),
+            args.repeat)
+        kept_loop = sum(p.nbytes for p in kept)
+        kept_table = boxes.nbytes + valid.nbytes
+        print '{:6d} {:10.3f} {:10.3f} {:10.3f} {:10.3f}'.format(
+            num, t_loop, t_table, kept_loop / 1e6, kept_table / 1e6)
+
+class _Blob(object):
+    """Stand-in for a caffe blob: data and diff arrays and the legacy 4D
+    shape accessors.
+    """
+
+    def __init__(self, data):
+        self.data = np.array(data, dtype=np.float32)
+        self.diff = np.zeros_like(self.data)
+
+    def _dim(self, axis):
+        return self.data.shape[axis] if self.data.ndim > axis else 1
+
+    num = property(lambda self: self._dim(0))
+    channels = property(lambda self: self._dim(1))
+    height = property(lambda self: self._dim(2))
+    width = property(lambda self: self._dim(3))
+    count = property(lambda self: self.data.size)
+
+    def reshape(self, *shape):
+        if self.data.shape != shape:
+            self.data = np.zeros(shape, dtype=np.float32)
+            self.diff = np.zeros(shape, dtype=np.float32)
+
+def _buffer_layers(rng, num_rois, num_classes=21, num_images=2):
+    """(module, layer, param_str, bottoms) of the MIL layers and losses of
+    the weakly supervised nets, on a batch of num_images images.
+    """
+    scores = rng.normal(0, 1, (num_rois, num_classes))
+    rois = np.zeros((num_rois, 5))
+    rois[:, 0] = np.sort(rng.randint(num_images, size=num_rois))
+    rois[:num_images, 0] = np.arange(num_images)
+    rois = rois[np.argsort(rois[:, 0], kind='mergesort')]
+    counts = rng.randint(1, 4, num_rois)
+    im_scores = rng.normal(0, 1, (num_images, num_classes))
+    labels = (rng.uniform(size=(num_images, num_classes)) > 0.8) * \
+            rng.uniform(size=(num_images, num_classes))
+    sm = roi_data_layer.softmax
+    beta = "{'beta': 2.0}"
+    return [(roi_data_layer.sum, 'MySumLayer', '', [scores, rois]),
+            (roi_data_layer.sum, 'MySumLayer', '', [scores, rois, counts]),
+            (roi_data_layer.sum, 'MyMeanLayer', '', [scores, rois]),
+            (sm, 'MySoftMaxLayer', '', [scores, rois, counts]),
+            (sm, 'ExpSoftMaxLayer', beta, [scores, rois, counts]),
+            (sm, 'ExpSoftMaxSumLayer', beta, [scores, rois, counts]),
+            (roi_data_layer.pyloss, 'HingeLoss', '', [im_scores, labels]),
+            (roi_data_layer.pyloss, 'HingeLoss2', '', [im_scores, labels]),
+            (roi_data_layer.pyloss, 'HingeLossNorm', '', [im_scores, labels]),
+            (roi_data_layer.pyloss, 'SoftMaxLogLoss', '',
+             [im_scores, labels + 0.1])]
+
+def _layer_step(layer, bottom, top):
+    layer.reshape(bottom, top)
+    layer.forward(bottom, top)
+    layer.backward(top, [True] * len(bottom), bottom)
+
+def bench_buffers(args):
+    """Forward and backward time of the Python layers, the number of
+    buffers (see utils.buffers) they reallocate after the first iteration
+    and the number of NumPy arrays a whole iteration allocates, counted by
+    utils.cython_layers.count_allocations; both must be 0 while the shapes
+    do not change. With the extension built, the layers run with its
+    kernels and then with their NumPy versions.
+    """
+    kernels = utils.integral.cython_layers
+    if kernels is None:
+        print 'utils.cython_layers is not built (run make in lib/): only ' \
+              'the buffers are counted'
+        backends = [None]
+    else:
+        backends = [kernels, None]
+    print '{:>6s} {:>20s} {:>8s} {:>10s} {:>8s} {:>8s}'.format(
+        'rois', 'layer', 'kernels', 'ms', 'buffers', 'allocs')
+    for backend in backends:
+        roi_data_layer.sum.cython_layers = backend
+        rng = np.random.RandomState(args.seed)
+        for num in _sizes(args, [128, 512]):
+            for module, name, param_str, bottoms in _buffer_layers(rng, num):
+                cls = getattr(module, name)
+                layer = cls.__new__(cls)
+                layer.param_str_ = param_str
+                bottom = [_Blob(x) for x in bottoms]
+                top = [_Blob(0)]
+                layer.setup(bottom, top)
+                _layer_step(layer, bottom, top)
+                first = getattr(layer, 'allocations', 0)
+                labels = [b.data.copy() for b in bottom[1:]]
+                t = _best_time(lambda: _layer_step(layer, bottom, top),
+                               args.repeat)
+                buffers = getattr(layer, 'allocations', 0) - first
+                assert buffers == 0, \
+                    '{} reallocated {:d} buffers'.format(name, buffers)
+                allocs = '-'
+                if kernels is not None:
+                    allocs = kernels.count_allocations(_layer_step, layer,
+                                                       bottom, top)
+                    assert allocs == 0, \
+                        '{} allocated {:d} arrays'.format(name, allocs)
+                assert all(np.array_equal(b.data, x)
+                           for b, x in zip(bottom[1:], labels)), \
+                    '{} changed its bottoms'.format(name)
+                print '{:6d} {:>20s} {:>8s} {:10.3f} {:8d} {:>8}'.format(
+                    num, name, 'no' if backend is None else 'yes', t,
+                    buffers, allocs)
+    roi_data_layer.sum.cython_layers = kernels
+
+def bench_kernels(args):
+    """NumPy vs. compiled (utils.cython_layers) kernels of the Python
+    layers: box sums and their scatter on a segmentation map, softmax and
+    sums over the RoIs of the images of a batch.
+    """
+    integral = utils.integral
+    segments = roi_data_layer.sum
+    if integral.cython_layers is None:
+        print 'utils.cython_layers is not built (run make in lib/)'
+        return
+    rng = np.random.RandomState(args.seed)
+    num_classes, height, width = SEGM_SHAPE
+    segm = rng.normal(0, 1, SEGM_SHAPE).astype(np.float32)
+    sat = integral.integral_image(segm)
+    print '{:>6s} {:>16s} {:>10s} {:>10s}'.format('size', 'kernel',
+                                                  'numpy ms', 'cython ms')
+    for num in _sizes(args, [128, 2000]):
+        boxes = np.round(_random_boxes(num, rng, width * 16, height * 16) /
+                         16).astype(np.int)
+        boxes = np.minimum(boxes, [width - 1, height - 1] * 2)
+        values = rng.normal(0, 1, (num, num_classes))
+        x = rng.normal(0, 1, (num, num_classes)).astype(np.float32)
+        w = rng.randint(1, 4, (num, 1)).astype(np.float32)
+        starts = np.array([0, num // 3, num // 2])
+        out = np.zeros((len(starts), num_classes), dtype=np.float32)
+        q_numpy = np.zeros(x.shape, dtype=np.float32)
+        q_kernel = np.zeros(x.shape, dtype=np.float32)
+        runs = [
+            ('box_sums',
+             lambda: integral.np_box_sums(sat, boxes),
+             lambda: integral.box_sums(sat, boxes)),
+            ('box_scatter',
+             lambda: integral.np_box_scatter(values, boxes, (height, width)),
+             lambda: integral.box_scatter(values, boxes, (height, width))),
+            ('segment_sums',
+             lambda: segments.np_segment_sums(x, starts, w, out).copy(),
+             lambda: segments.segment_sums(x, starts, w, out).copy()),
+            ('segment_softmax',
+             lambda: (q_numpy, segments.np_segment_softmax(
+                 x, starts, SEGM_BETA, w, q_numpy)),
+             lambda: segments.segment_softmax(x, starts, SEGM_BETA, w,
+                                              q_kernel)),
+        ]
+        for name, numpy_fn, kernel_fn in runs:
+            for a, b in zip(np.atleast_1d(numpy_fn()),
+                            np.atleast_1d(kernel_fn())):
+                assert np.allclose(a, b, rtol=1e-4, atol=1e-5), name
+            print '{:6d} {:>16s} {:10.3f} {:10.3f}'.format(
+                num, name, _best_time(numpy_fn, args.repeat),
+                _best_time(kernel_fn, args.repeat))
+
+PAIR_DIM = 4096
+PAIR_CLASSES = 20
+PAIR_WEIGHT = 0.7
+
+def _legacy_pair_distance(feats, weights, images, acl, loss_weight):
+    """Per-class loop of MyDistance: loss and gradients w.r.t. feats and
+    weights. Each class's distance adds up the diffs of all the classes
+    before it, so with several shared classes the loss is not the one the
+    gradients belong to.
+    """
+    num_cl = weights.shape[1]
+    channels = feats.shape[1]
+    diff = np.zeros((num_cl, channels, 1))
+    dist = np.zeros(num_cl)
+    for cl in np.flatnonzero(acl):
+        aux = (feats.T * weights[:, cl]).T
+        diff[cl] = (aux[images == 0].sum(0) -
+                    aux[images == 1].sum(0)).reshape((-1, 1))
+        dist[cl] = 0.5 * np.sum(diff ** 2)
+    dfeats = np.zeros(feats.shape, dtype=np.float32)
+    dweights = np.zeros(weights.shape, dtype=np.float32)
+    for cl in np.flatnonzero(acl):
+        dfeats += loss_weight * np.dot(weights[:, cl].reshape((-1, 1)),
+                                       diff[cl].T) / channels
+        dweights[:, cl] += loss_weight * \
+                np.dot(feats, diff[cl])[:, 0] / channels
+    dfeats[images == 1] = -dfeats[images == 1]
+    dweights[images == 1] = -dweights[images == 1]
+    return loss_weight * dist.sum() / channels, dfeats, dweights
+
+def _legacy_pair_cossim(feats, weights, images, acl, loss_weight):
+    """Per-class loop of MyCosSim: loss and gradients w.r.t. feats and
+    weights. The gradients divide by na**2./3. (na^2 / 3) where the
+    derivative of the cosine has na^1.5 * nb^0.5.
+    """
+    loss = 0.
+    dfeats = np.zeros(feats.shape, dtype=np.float32)
+    dweights = np.zeros(weights.shape, dtype=np.float32)
+    for cl in np.flatnonzero(acl):
+        aux = (feats.T * weights[:, cl]).T
+        a = aux[images == 0].sum(0)
+        b = aux[images == 1].sum(0)
+        ab = np.dot(a, b)
+        na = np.dot(a, a) + 1e-8
+        nb = np.dot(b, b) + 1e-8
+        sqab = np.sqrt(na) * np.sqrt(nb)
+        grads = [-(-a * ab / (na ** 2. / 3. * nb) + b / sqab),
+                 -(-b * ab / (nb ** 2. / 3. * na) + a / sqab)]
+        loss += 1 - ab / sqab
+        for i, grad in enumerate(grads):
+            sel = images == i
+            dfeats[sel] += loss_weight * np.outer(weights[sel, cl], grad)
+            dweights[sel, cl] += loss_weight * np.dot(feats[sel], grad)
+    return loss_weight * loss, dfeats, dweights
+
+def bench_pairs(args):
+    """Per-class loops vs. one GEMM per image of the pairwise losses
+    MyDistance and MyCosSim (forward and backward). Against the loops,
+    MyDistance must give the same gradients, and the same loss with one
+    shared class, and MyCosSim the same loss. The terms the loops got
+    wrong (MyDistance's loss with several shared classes, MyCosSim's
+    gradients) are checked against finite differences instead.
+    """
+    pyloss = roi_data_layer.pyloss
+    rng = np.random.RandomState(args.seed)
+    np.random.seed(args.seed)
+    cfg.TRAIN.PAIRWISE_WEIGHT = PAIR_WEIGHT
+    legacy = {'MyDistance' : _legacy_pair_distance,
+              'MyCosSim' : _legacy_pair_cossim}
+    print '{:>6s} {:>12s} {:>7s} {:>10s} {:>10s} {:>10s}'.format(
+        'rois', 'layer', 'shared', 'loop ms', 'gemm ms', 'fd error')
+    for num in _sizes(args, [256, 1024]):
+        feats = rng.uniform(size=(num, PAIR_DIM, 1, 1)).astype(np.float32)
+        weights = (rng.uniform(size=(num, PAIR_CLASSES)) /
+                   PAIR_CLASSES).astype(np.float32)
+        rois = np.zeros((num, 5))
+        rois[num // 2:, 0] = 1
+        images = rois[:, 0]
+        for shared in ([3], [1, 4, 7, 11]):
+            labels = np.zeros((2, PAIR_CLASSES))
+            labels[:, shared] = 1
+            labels[0, 5] = 1
+            acl = labels.sum(0) == 2
+            for name in ('MyDistance', 'MyCosSim'):
+                cls = getattr(pyloss, name)
+                layer = cls.__new__(cls)
+                layer.param_str_ = "{{'myloss_weight': {}}}".format(
+                    PAIR_WEIGHT)
+                bottom = [_Blob(x) for x in (feats, weights, rois, labels)]
+                top = [_Blob(0)]
+                layer.setup(bottom, top)
+                _layer_step(layer, bottom, top)
+                loss = top[0].data[0]
+                dfeats = bottom[0].diff[:, :, 0, 0]
+                dweights = bottom[1].diff
+                old_loss, old_dfeats, old_dweights = legacy[name](
+                    feats[:, :, 0, 0], weights, images, acl, PAIR_WEIGHT)
+                close = lambda x, y: np.allclose(
+                    x, y, rtol=1e-4, atol=1e-4 * np.abs(y).max())
+                if name == 'MyDistance':
+                    assert close(dfeats, old_dfeats), name
+                    assert close(dweights, old_dweights), name
+                    if len(shared) == 1:
+                        assert close(loss, old_loss), (name, loss, old_loss)
+                else:
+                    # 1 - cos of nearly parallel sums: float32 rounding of
+                    # the cosines, not of the loss
+                    assert abs(loss - old_loss) < \
+                            1e-5 * PAIR_WEIGHT * len(shared), name
+                f, w, _ = pyloss._pair_inputs(bottom, acl)
+                pair_loss = lambda f, w: layer._loss(
+                    *pyloss.image_class_sums(f, w, images))[0]
+                err = pyloss.check_pair_grad(pair_loss, f, w,
+                                             dfeats.reshape(f.shape),
+                                             dweights[:, acl])
+                assert err < 1e-3, \
+                    '{} gradient error {:g}'.format(name, err)
+                t_loop = _best_time(lambda: legacy[name](
+                    feats[:, :, 0, 0], weights, images, acl, PAIR_WEIGHT),
+                    args.repeat)
+                t_gemm = _best_time(lambda: _layer_step(layer, bottom, top),
+                                    args.repeat)
+                print '{:6d} {:>12s} {:7d} {:10.3f} {:10.3f} {:10.2g}'.format(
+                    num, name, len(shared), t_loop, t_gemm, err)
+
+BENCHMARKS = {
+    'buffers' : bench_buffers,
+    'kernels' : bench_kernels,
+    'dedup' : bench_dedup,
+    'nms' : bench_nms,
+    'overlaps' : bench_overlaps,
+    'pairs' : bench_pairs,
+    'segm' : bench_segm,
+}
+
+if __name__ == '__main__':
+    args = parse_args()
+    BENCHMARKS[args.benchmark](args)
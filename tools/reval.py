@@ -10,9 +10,11 @@
 """Reval = re-eval. Re-evaluate saved detections."""
 
 import _init_paths
-from fast_rcnn.test import apply_nms
+from fast_rcnn.test import apply_nms, nms_keep
 from fast_rcnn.config import cfg
 from datasets.factory import get_imdb
+from datasets.voc_eval import DetectionEval
+from multiprocessing import Pool
 import cPickle
 import os, sys, argparse
 import numpy as np
@@ -33,6 +35,22 @@ def parse_args():
                         default='voc_2007_test', type=str)
     parser.add_argument('--comp', dest='comp_mode', help='competition mode',
                         action='store_true')
+    parser.add_argument('--dets', dest='det_file',
+                        help='detections file inside the results directory',
+                        default='detections.pkl', type=str)
+    parser.add_argument('--sweep', dest='sweep',
+                        help=('evaluate every (NMS, overlap) pair of the '
+                              'grids below in one process'),
+                        action='store_true')
+    parser.add_argument('--nms', dest='nms_grid',
+                        help='comma separated NMS thresholds for --sweep',
+                        default='0.2,0.3,0.4,0.5', type=str)
+    parser.add_argument('--overlaps', dest='overlap_grid',
+                        help='comma separated overlap thresholds for --sweep',
+                        default='0.3,0.4,0.5,0.6,0.7', type=str)
+    parser.add_argument('--workers', dest='workers',
+                        help='number of worker processes for --sweep',
+                        default=4, type=int)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -63,10 +81,10 @@ def from_mats(imdb_name, output_dir):
     print '~~~~~~~~~~~~~~~~~~~'
 
 
-def from_dets(imdb_name, output_dir, comp_mode):
+def from_dets(imdb_name, output_dir, comp_mode, det_file):
     imdb = get_imdb(imdb_name)
     imdb.competition_mode(comp_mode)
-    with open(os.path.join(output_dir, 'detections.pkl'), 'rb') as f:
+    with open(os.path.join(output_dir, det_file), 'rb') as f:
         dets = cPickle.load(f)
 
     print 'Applying NMS to all detections'
@@ -75,6 +93,51 @@ def from_dets(imdb_name, output_dir, comp_mode):
     print 'Evaluating detections'
     imdb.evaluate_detections(nms_dets, output_dir)
 
+# Shared with the sweep workers through fork
+_sweep = {}
+
+def _sweep_nms(thresh):
+    """Evaluate every overlap threshold at one NMS threshold."""
+    keep = nms_keep(_sweep['dets'], thresh)
+    return [(thresh, overlap, _sweep['eval'].evaluate(keep, overlap))
+            for overlap in _sweep['overlaps']]
+
+def sweep_dets(imdb_name, output_dir, det_file, nms_grid, overlap_grid,
+               workers):
+    imdb = get_imdb(imdb_name)
+    with open(os.path.join(output_dir, det_file), 'rb') as f:
+        dets = cPickle.load(f)
+
+    print 'Caching detection / ground-truth overlaps'
+    _sweep['dets'] = dets
+    _sweep['eval'] = DetectionEval(imdb, dets)
+    _sweep['overlaps'] = overlap_grid
+
+    print 'Evaluating {:d} NMS x {:d} overlap settings'.format(
+        len(nms_grid), len(overlap_grid))
+    if workers > 1:
+        pool = Pool(min(workers, len(nms_grid)))
+        results = pool.map(_sweep_nms, nms_grid)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_sweep_nms, nms_grid)
+
+    header = '{:>5s} {:>7s} {:>6s} '.format('nms', 'overlap', 'mAP') + \
+             ' '.join(['{:>5.5s}'.format(cls) for cls in imdb.classes[1:]])
+    lines = [header]
+    for rows in results:
+        for thresh, overlap, aps in rows:
+            lines.append('{:5.2f} {:7.2f} {:6.1f} '.format(
+                thresh, overlap, 100 * aps.mean()) +
+                ' '.join(['{:5.1f}'.format(100 * ap) for ap in aps]))
+    table = '\n'.join(lines)
+    print '~~~~~~~~~~~~~~~~~~~'
+    print table
+    print '~~~~~~~~~~~~~~~~~~~'
+    with open(os.path.join(output_dir, 'sweep.txt'), 'w') as f:
+        f.write(table + '\n')
+
 if __name__ == '__main__':
     args = parse_args()
 
@@ -84,7 +147,12 @@ if __name__ == '__main__':
     if args.comp_mode and not args.rerun:
         raise ValueError('--rerun must be used with --comp')
 
-    if args.rerun:
-        from_dets(imdb_name, output_dir, args.comp_mode)
+    if args.sweep:
+        sweep_dets(imdb_name, output_dir, args.det_file,
+                   [float(x) for x in args.nms_grid.split(',')],
+                   [float(x) for x in args.overlap_grid.split(',')],
+                   args.workers)
+    elif args.rerun:
+        from_dets(imdb_name, output_dir, args.comp_mode, args.det_file)
     else:
         from_mats(imdb_name, output_dir)
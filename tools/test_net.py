@@ -42,7 +42,8 @@ def parse_args():
                         help='reuse the detection scores already saved in detections.pkl file',
                         default=False, action='store_true')
     parser.add_argument('--feat', dest='feat_file',
-                        help='Name of the file to save the features',
+                        help='Name of the directory (in the output dir) to stream the '
+                             'features to, see fast_rcnn.featstore',
                         default=None, type=str)
     parser.add_argument('--visdet', dest='visdet',
                         help='Visualize Detections',
@@ -51,7 +52,8 @@ def parse_args():
                         help='dataset to test',
                         default='voc_2007_test', type=str)
     parser.add_argument('--flip', dest='use_flip',
-                        help='use flipped images at test time',
+                        help='also detect on the mirror images at test time '
+                             '(sets TEST.USE_FLIPPED)',
                         default=False, action='store_true')
     parser.add_argument('--segm', dest='eval_segm',
                         help='Evaluate segmentation',
@@ -79,6 +81,8 @@ if __name__ == '__main__':
         cfg_from_file(args.cfg_file)
     if args.set_cfgs is not None:
         cfg_from_list(args.set_cfgs)
+    if args.use_flip:
+        cfg.TEST.USE_FLIPPED = True
 
     print('Using config:')
     pprint.pprint(cfg)
@@ -93,8 +97,6 @@ if __name__ == '__main__':
     net.name = os.path.splitext(os.path.basename(args.caffemodel))[0]
 
     imdb = get_imdb(args.imdb_name)
-    if args.use_flip:
-        imdb.append_flipped_images()
     imdb.competition_mode(args.comp_mode)
 
     test_net(net, imdb, args)
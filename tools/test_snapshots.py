@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Test several snapshots of a Fast R-CNN network on an image database in
+one pass over the images."""
+
+import _init_paths
+from fast_rcnn.test import test_snapshots
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list, \
+    get_output_dir
+from datasets.factory import get_imdb
+import caffe
+import argparse
+import pprint
+import os, sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Test snapshots of a Fast R-CNN network')
+    parser.add_argument('--gpu', dest='gpu_id', help='GPU id to use',
+                        default=0, type=int)
+    parser.add_argument('--def', dest='prototxt',
+                        help='prototxt file defining the network',
+                        default=None, type=str)
+    parser.add_argument('--net', dest='caffemodels',
+                        help='snapshots to test (sharing the --def network)',
+                        default=None, nargs='+', type=str)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--imdb', dest='imdb_name',
+                        help='dataset to test',
+                        default='voc_2007_test', type=str)
+    parser.add_argument('--chunk', dest='chunk_size',
+                        help='images whose input blobs are kept in memory '
+                             'while all snapshots run on them',
+                        default=100, type=int)
+    parser.add_argument('--num-images', dest='num_images',
+                        help='only test the first NUM_IMAGES images',
+                        default=None, type=int)
+    parser.add_argument('--summary', dest='summary_file',
+                        help='file to write the mAP / CorLoc table to '
+                             '(default: snapshots.txt in the output dir)',
+                        default=None, type=str)
+    parser.add_argument('--flip', dest='use_flip',
+                        help='also detect on the mirror images at test time '
+                             '(sets TEST.USE_FLIPPED)',
+                        default=False, action='store_true')
+    parser.add_argument('--comp', dest='comp_mode', help='competition mode',
+                        action='store_true')
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+    if args.use_flip:
+        cfg.TEST.USE_FLIPPED = True
+
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    caffe.set_mode_gpu()
+    caffe.set_device(args.gpu_id)
+    # the weights of every snapshot are copied into this net in turn
+    net = caffe.Net(args.prototxt, args.caffemodels[0], caffe.TEST)
+
+    imdb = get_imdb(args.imdb_name)
+    imdb.competition_mode(args.comp_mode)
+
+    # the adaptive thresholds are off on trainval, as in test_net
+    results = test_snapshots(net, imdb, args.prototxt, args.caffemodels,
+                             args.chunk_size, args.num_images,
+                             args.imdb_name != 'voc_2007_trainval')
+
+    lines = ['{:<40s} {:>6s} {:>7s}'.format('snapshot', 'mAP', 'CorLoc')]
+    for name, ap, corloc in results:
+        lines.append('{:<40s} {:6.1f} {:7.1f}'.format(name, 100 * ap,
+                                                      100 * corloc))
+    table = '\n'.join(lines)
+    print '~~~~~~~~~~~~~~~~~~~'
+    print table
+    print '~~~~~~~~~~~~~~~~~~~'
+    summary_file = args.summary_file
+    if summary_file is None:
+        summary_file = os.path.join(get_output_dir(imdb, None),
+                                    'snapshots.txt')
+    with open(summary_file, 'w') as f:
+        f.write(table + '\n')
+    print 'Summary written to {}'.format(summary_file)
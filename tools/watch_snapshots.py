@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Evaluate the snapshots of a training run as they are written.
+
+Polls a training output directory for new *_iter_*.caffemodel files and runs
+tools/test_snapshots.py on each of them in a separate process, at most --jobs
+at a time. Finished snapshots are recorded in a state file, so a restarted
+watcher only evaluates what is left, and their mAP and CorLoc are appended to
+a time-series log, e.g. to decide when to stop training:
+
+    ./tools/watch_snapshots.py output/default/voc_2007_trainval \\
+        --def models/CaffeNet/no_bbox_reg/test.prototxt --imdb voc_2007_test \\
+        --until 40000 &
+    ./tools/train_net.py ...
+"""
+
+import _init_paths
+from fast_rcnn.detstore import read_index
+import argparse
+import glob
+import re
+import subprocess
+import time
+import os, sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Evaluate snapshots as training writes them')
+    parser.add_argument('snapshot_dir', help='directory the snapshots are '
+                        'written to (the output dir of train_net.py)',
+                        type=str)
+    parser.add_argument('--def', dest='prototxt',
+                        help='prototxt file defining the test network',
+                        default=None, type=str)
+    parser.add_argument('--imdb', dest='imdb_name',
+                        help='dataset to test',
+                        default='voc_2007_test', type=str)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--pattern', dest='pattern',
+                        help='snapshot file name pattern',
+                        default='*_iter_*.caffemodel', type=str)
+    parser.add_argument('--num-images', dest='num_images',
+                        help='evaluate on the first NUM_IMAGES images only',
+                        default=None, type=int)
+    parser.add_argument('--gpus', dest='gpus',
+                        help='comma separated GPU ids the jobs run on',
+                        default='0', type=str)
+    parser.add_argument('--jobs', dest='jobs',
+                        help='maximum number of evaluations running at once',
+                        default=1, type=int)
+    parser.add_argument('--poll', dest='poll',
+                        help='seconds between two scans of the directory',
+                        default=10, type=int)
+    parser.add_argument('--until', dest='until',
+                        help='exit once the snapshot of this iteration '
+                             'and the ones before it have been evaluated '
+                             '(default: run forever)',
+                        default=None, type=int)
+    parser.add_argument('--once', dest='once',
+                        help='evaluate the snapshots already there and exit',
+                        action='store_true')
+    parser.add_argument('--retry', dest='retry',
+                        help='evaluate again the snapshots that failed',
+                        action='store_true')
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+def snapshot_iter(filename):
+    """Training iteration of a snapshot file, from its _iter_<N> suffix."""
+    match = re.search(r'_iter_(\d+)\.caffemodel$', filename)
+    return int(match.group(1)) if match is not None else -1
+
+def read_state(state_file):
+    """{snapshot: status} of the snapshots evaluated by earlier runs.
+
+    A partially written last line is cut off the file (see
+    fast_rcnn.detstore.read_index), so that the next status appended to it
+    starts on a line of its own.
+    """
+    return dict((name, status)
+                for status, name in read_index(state_file, 2))
+
+def append_line(filename, line):
+    with open(filename, 'a') as f:
+        f.write(line + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_summary(summary_file):
+    """(mAP, CorLoc) from the table written by test_snapshots.py."""
+    with open(summary_file, 'r') as f:
+        fields = f.readlines()[1].split()
+    return float(fields[-2]), float(fields[-1])
+
+class Watcher(object):
+    """Launches and collects one test_snapshots.py process per snapshot."""
+
+    def __init__(self, args):
+        self._args = args
+        self._dir = os.path.abspath(args.snapshot_dir)
+        suffix = '' if args.num_images is None \
+                else '_{:d}'.format(args.num_images)
+        self._state_file = os.path.join(
+            self._dir, 'watch_{}{}.state'.format(args.imdb_name, suffix))
+        self._log_file = os.path.join(
+            self._dir, 'watch_{}{}.log'.format(args.imdb_name, suffix))
+        self._state = read_state(self._state_file)
+        if args.retry:
+            self._state = dict((name, status) for name, status
+                               in self._state.iteritems()
+                               if status != 'failed')
+        self._gpus = [int(x) for x in args.gpus.split(',')]
+        # slot -> (snapshot, process, summary file, start time)
+        self._running = {}
+        self._best = None
+
+    def _pending(self):
+        snapshots = sorted(glob.glob(os.path.join(self._dir,
+                                                  self._args.pattern)),
+                           key=snapshot_iter)
+        running = set(job[0] for job in self._running.itervalues())
+        pending = []
+        for snapshot in snapshots:
+            name = os.path.basename(snapshot)
+            status = self._state.get(name)
+            if snapshot in running or status is not None:
+                continue
+            pending.append(snapshot)
+        return pending
+
+    def _launch(self, slot, snapshot):
+        args = self._args
+        name = os.path.splitext(os.path.basename(snapshot))[0]
+        summary_file = os.path.join(self._dir, 'watch_{}.txt'.format(name))
+        if os.path.exists(summary_file):
+            # left over from an earlier attempt
+            os.remove(summary_file)
+        cmd = [sys.executable,
+               os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'test_snapshots.py'),
+               '--gpu', str(self._gpus[slot % len(self._gpus)]),
+               '--def', args.prototxt, '--net', snapshot,
+               '--imdb', args.imdb_name, '--summary', summary_file]
+        if args.num_images is not None:
+            cmd += ['--num-images', str(args.num_images)]
+        if args.cfg_file is not None:
+            cmd += ['--cfg', args.cfg_file]
+        if args.set_cfgs is not None:
+            cmd += ['--set'] + args.set_cfgs
+        log = open(os.path.join(self._dir, 'watch_{}.out'.format(name)), 'w')
+        print 'Evaluating {} on GPU {:d}'.format(
+            name, self._gpus[slot % len(self._gpus)])
+        process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        self._running[slot] = (snapshot, process, summary_file, time.time())
+
+    def _collect(self):
+        for slot, (snapshot, process, summary_file, start) in \
+                self._running.items():
+            if process.poll() is None:
+                continue
+            del self._running[slot]
+            name = os.path.basename(snapshot)
+            if process.returncode != 0 or not os.path.exists(summary_file):
+                print '{} failed (exit code {:d})'.format(name,
+                                                          process.returncode)
+                self._state[name] = 'failed'
+                append_line(self._state_file, 'failed ' + name)
+                continue
+            ap, corloc = read_summary(summary_file)
+            append_line(self._log_file, '{:.0f} {:d} {:.1f} {:.1f} {} {:.0f}'
+                        .format(time.time(), snapshot_iter(name), ap, corloc,
+                                name, time.time() - start))
+            self._state[name] = 'done'
+            append_line(self._state_file, 'done ' + name)
+            if self._best is None or ap > self._best[1]:
+                self._best = (snapshot_iter(name), ap)
+            print '{}: mAP {:.1f} CorLoc {:.1f} (best mAP {:.1f} at iter {:d})' \
+                  .format(name, ap, corloc, self._best[1], self._best[0])
+
+    def _finished(self):
+        """Whether the --until snapshot has been evaluated, successfully or
+        not, and no other evaluation is left running or waiting.
+        """
+        if self._args.until is None:
+            return False
+        if not any(snapshot_iter(name) >= self._args.until and
+                   status in ('done', 'failed')
+                   for name, status in self._state.iteritems()):
+            return False
+        return len(self._running) == 0 and len(self._pending()) == 0
+
+    def run(self):
+        print 'Watching {} (state in {}, results in {})'.format(
+            self._dir, self._state_file, self._log_file)
+        while True:
+            self._collect()
+            if self._finished():
+                break
+            pending = self._pending()
+            for slot in xrange(self._args.jobs):
+                if slot not in self._running and len(pending) > 0:
+                    self._launch(slot, pending.pop(0))
+            if self._args.once and len(self._running) == 0 and \
+                    len(pending) == 0:
+                break
+            time.sleep(self._args.poll)
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    Watcher(args).run()